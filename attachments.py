@@ -0,0 +1,389 @@
+import asyncio
+import hashlib
+import os
+import re
+import secrets
+
+from protocol import Envelope, MessageType
+
+ATTACHMENT_ROOT = 'attachments'
+DOWNLOAD_ROOT = 'downloads'  # Client-side cache of attachments fetched from the server
+CHUNK_SIZE = 64 * 1024
+WINDOW_CHUNKS = 8  # Unacknowledged chunks a sender may have in flight
+MAX_ATTACHMENT_BYTES = 200 * 1024 * 1024
+PROOF_BYTES = CHUNK_SIZE  # Bytes of an already stored file a sender must send to attach it
+ATTACHMENT_KINDS = ("IMAGE", "AUDIO", "VIDEO", "FILE")
+
+_SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+
+# Transfer flow (see protocol.MessageType):
+#   client -> server  FILE_BEGIN (key=sha256, id=size, kind, body=name), then FILE_CHUNKs
+#   server -> client  FILE_OFFSET range to send (resume point to the end; for content already
+#                     stored, a random PROOF_BYTES range), FILE_ACK bytes accepted so far,
+#                     FILE_DONE stored path, or FILE_ERROR reason
+#   client -> server  FILE_GET (key=sha256, id=offset) for an attachment of its conversation
+#   server -> client  FILE_DATAs from that offset to the end, or FILE_ERROR reason
+
+
+def file_sha256(path):
+    """Hash a file in CHUNK_SIZE reads so it is never held in memory at once."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def attachment_kind(path):
+    """Message prefix for a file, based on its extension."""
+    lowered = path.lower()
+    if lowered.endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp")):
+        return "IMAGE"
+    if lowered.endswith((".mp3", ".wav", ".ogg")):
+        return "AUDIO"
+    if lowered.endswith((".mp4", ".mov", ".avi", ".mkv")):
+        return "VIDEO"
+    return "FILE"  # Fallback for other media types.
+
+
+def attachment_message(kind, path):
+    """Chat text recorded for a stored attachment: "<KIND>: <stored path>"."""
+    return f"{kind}: {path}"
+
+
+def parse_attachment_message(text):
+    """(kind, path, sha) if text was made by attachment_message(), else None."""
+    kind, _, path = text.partition(": ")
+    sha = os.path.basename(path)
+    if kind in ATTACHMENT_KINDS and _SHA256_HEX.match(sha):
+        return kind, path, sha
+    return None
+
+
+class AttachmentError(Exception):
+    """An upload was rejected (bad header, size, offset or checksum)."""
+
+
+class AttachmentStore:
+    """Content-addressed store: files live at <root>/<sha[:2]>/<sha>, one copy per content.
+
+    Uploads are written straight to a per-sender .part file as chunks arrive, so a transfer
+    can resume from the part file's size after a reconnect and nothing is buffered whole.
+    Each in-progress upload belongs to one connection; the same sender uploading the same
+    content from a second connection (another tab) is refused until the first one ends,
+    so two writers never share a part file.
+
+    Content already in the store is not uploaded again, but knowing its hash is not enough
+    to attach it: the sender must send a randomly placed range of it, checked against the
+    stored copy.
+    """
+
+    def __init__(self, root=ATTACHMENT_ROOT, max_bytes=MAX_ATTACHMENT_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.uploads = {}  # (owner, sha) -> {"size", "kind", "name", "received", "stop", "conn", "proof"}
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+
+    def path_for(self, sha):
+        return os.path.join(self.root, sha[:2], sha)
+
+    def part_path(self, owner, sha):
+        owner_key = hashlib.sha256(owner.encode()).hexdigest()[:16]
+        return os.path.join(self.root, "tmp", f"{owner_key}-{sha}.part")
+
+    async def begin(self, owner, sha, size, kind, name, conn=None):
+        """Register an upload from connection conn; returns the (start, stop) byte range the
+        sender must send next."""
+        if not _SHA256_HEX.match(sha) or kind not in ATTACHMENT_KINDS:
+            raise AttachmentError("bad header")
+        if not 0 < size <= self.max_bytes:
+            raise AttachmentError("size out of range")
+        current = self.uploads.get((owner, sha))
+        if current is not None and current["conn"] != conn:
+            raise AttachmentError("already being uploaded from another connection")
+
+        stored = await asyncio.to_thread(lambda: os.path.getsize(self.path_for(sha))
+                                         if os.path.exists(self.path_for(sha)) else None)
+        if stored is not None:
+            # 🔹 Dedup: the content is already in the store, so only ask for proof of having it
+            if stored != size:
+                raise AttachmentError("size does not match the stored content")
+            received = secrets.randbelow(size - min(PROOF_BYTES, size) + 1)
+            stop = received + min(PROOF_BYTES, size)
+        else:
+            part = self.part_path(owner, sha)
+            received = await asyncio.to_thread(lambda: os.path.getsize(part) if os.path.exists(part) else 0)
+            if received > size:
+                await asyncio.to_thread(os.remove, part)
+                received = 0
+            stop = size
+        self.uploads[(owner, sha)] = {"size": size, "kind": kind, "name": os.path.basename(name), "received": received,
+                                      "stop": stop, "conn": conn, "proof": stored is not None}
+        return received, stop
+
+    async def write_chunk(self, owner, sha, offset, data, conn=None):
+        """Append one chunk at offset; returns the bytes received so far."""
+        upload = self.uploads.get((owner, sha))
+        if upload is None or upload["conn"] != conn:
+            raise AttachmentError("unknown upload")
+        if offset != upload["received"] or offset + len(data) > upload["stop"]:
+            raise AttachmentError(f"unexpected offset {offset}")
+        if upload["proof"]:
+            if not await asyncio.to_thread(self._matches, self.path_for(sha), offset, data):
+                raise AttachmentError("content does not match")
+        else:
+            await asyncio.to_thread(_append, self.part_path(owner, sha), data)
+        upload["received"] += len(data)
+        return upload["received"]
+
+    def is_complete(self, owner, sha):
+        upload = self.uploads.get((owner, sha))
+        return upload is not None and upload["received"] == upload["stop"]
+
+    async def finish(self, owner, sha):
+        """Verify the checksum and move the part file into the store; returns the upload info."""
+        upload = self.uploads.pop((owner, sha))
+        if not upload["proof"]:  # A proven range was already compared with the stored copy
+            await asyncio.to_thread(self._commit, self.part_path(owner, sha), sha)
+        upload["path"] = self.path_for(sha)
+        return upload
+
+    def cancel(self, owner, sha, conn=None):
+        """Forget one upload if conn owns it (its part file stays for resumption)."""
+        upload = self.uploads.get((owner, sha))
+        if upload is not None and upload["conn"] == conn:
+            del self.uploads[(owner, sha)]
+
+    def discard(self, owner, conn=None):
+        """Forget the in-progress uploads of one of an owner's connections (part files stay)."""
+        for key in [key for key, upload in self.uploads.items() if key[0] == owner and upload["conn"] == conn]:
+            del self.uploads[key]
+
+    def _matches(self, path, offset, data):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(len(data)) == data
+
+    def _commit(self, part, sha):
+        if file_sha256(part) != sha:
+            os.remove(part)
+            raise AttachmentError("checksum mismatch")
+        final = self.path_for(sha)
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        if os.path.exists(final):
+            os.remove(part)  # Someone else stored the same content meanwhile
+        else:
+            os.replace(part, final)
+
+
+class AttachmentUploader:
+    """Client side of the transfer: streams a file in windowed chunks and resumes by offset.
+
+    Transfers survive reconnects: link_down() fails the current attempt of each one, and
+    after link_up() it sends FILE_BEGIN again and carries on from the server's offset.
+    """
+
+    CONTROL_TYPES = (MessageType.FILE_OFFSET, MessageType.FILE_ACK, MessageType.FILE_DONE, MessageType.FILE_ERROR)
+
+    def __init__(self, send, link_errors=(ConnectionError,)):
+        self.send = send  # async callable taking an Envelope
+        self.link_errors = link_errors  # What send raises when the connection is gone
+        self.transfers = {}  # sha -> {"start": Future, "done": Future, "acked": int, "progress": Event}
+        self.online = asyncio.Event()  # Set while the connection is authenticated
+        self.closed = False
+
+    def link_up(self):
+        self.online.set()
+
+    def link_down(self):
+        """The connection dropped: end every transfer's current attempt so it can resume."""
+        self.online.clear()
+        for transfer in self.transfers.values():
+            _fail(transfer, ConnectionError("connection lost"))
+
+    def close(self):
+        """No more reconnects: fail every transfer for good."""
+        self.closed = True
+        self.online.set()  # Wake uploads waiting for a connection so they see closed
+        for transfer in self.transfers.values():
+            _fail(transfer, AttachmentError("connection closed"))
+
+    def handle_control(self, envelope):
+        """Feed FILE_* envelopes from the server; returns True if the envelope was one."""
+        if envelope.type not in self.CONTROL_TYPES:
+            return False
+        transfer = self.transfers.get(envelope.key)
+        if transfer is None:
+            return True
+        if envelope.type == MessageType.FILE_OFFSET:
+            _resolve(transfer["start"], (envelope.id, envelope.ack))
+        elif envelope.type == MessageType.FILE_ACK:
+            transfer["acked"] = envelope.id
+            transfer["progress"].set()
+        elif envelope.type == MessageType.FILE_DONE:
+            _resolve(transfer["start"], None)
+            _resolve(transfer["done"], envelope.text)
+            transfer["progress"].set()
+        else:
+            _fail(transfer, AttachmentError(envelope.text))
+        return True
+
+    async def upload(self, path, kind=None):
+        """Send a file and wait until the server has stored it; returns its stored path."""
+        kind = kind or attachment_kind(path)
+        size = await asyncio.to_thread(os.path.getsize, path)
+        sha = await asyncio.to_thread(file_sha256, path)
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.online.wait()
+            if self.closed:
+                raise AttachmentError("connection closed")
+            transfer = {"start": loop.create_future(), "done": loop.create_future(), "acked": 0,
+                        "progress": asyncio.Event()}
+            self.transfers[sha] = transfer
+            try:
+                await self.send(Envelope(MessageType.FILE_BEGIN, id=size, kind=kind, key=sha,
+                                         body=os.path.basename(path)))
+                requested = await transfer["start"]
+                if requested is not None:
+                    offset, stop = requested
+                    transfer["acked"] = offset
+                    await self._stream(path, sha, stop or size, offset, transfer)
+                return await transfer["done"]
+            except self.link_errors:
+                self.online.clear()  # The link is gone even if link_down() has not been called yet
+                print(f"🔄 Upload of {os.path.basename(path)} interrupted, resuming after reconnect")
+            finally:
+                self.transfers.pop(sha, None)
+                for key in ("start", "done"):
+                    if transfer[key].done() and not transfer[key].cancelled():
+                        transfer[key].exception()  # Mark a failure as retrieved if the other raised first
+
+    async def _stream(self, path, sha, stop, offset, transfer):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while offset < stop:
+                # 🔹 Flow control: stay within WINDOW_CHUNKS of the last acknowledged byte
+                while offset - transfer["acked"] >= WINDOW_CHUNKS * CHUNK_SIZE:
+                    transfer["progress"].clear()
+                    await transfer["progress"].wait()
+                    if transfer["done"].done():
+                        return
+                data = await asyncio.to_thread(f.read, min(CHUNK_SIZE, stop - offset))
+                if not data:
+                    raise AttachmentError("file shrank during upload")
+                await self.send(Envelope(MessageType.FILE_CHUNK, id=offset, key=sha, body=data))
+                offset += len(data)
+
+
+class AttachmentDownloader:
+    """Client side of fetching stored attachments into a local content-addressed cache.
+
+    History names an attachment by its path on the server, which is only readable there,
+    so the bytes are fetched with FILE_GET the first time the attachment is shown. A
+    download interrupted by a reconnect resumes from its part file, and the content is
+    checked against its hash before it is used.
+    """
+
+    CONTROL_TYPES = (MessageType.FILE_DATA, MessageType.FILE_ERROR)
+
+    def __init__(self, send, root=DOWNLOAD_ROOT, link_errors=(ConnectionError,)):
+        self.send = send  # async callable taking an Envelope
+        self.root = os.path.abspath(root)
+        self.link_errors = link_errors  # What send raises when the connection is gone
+        self.transfers = {}  # sha -> Queue of FILE_DATA envelopes and errors for the current attempt
+        self.fetching = {}  # sha -> Future of the download in flight, shared by concurrent fetches
+        self.online = asyncio.Event()  # Set while the connection is authenticated
+        self.closed = False
+
+    def path_for(self, sha):
+        return os.path.join(self.root, sha[:2], sha)
+
+    def link_up(self):
+        self.online.set()
+
+    def link_down(self):
+        """The connection dropped: end every download's current attempt so it can resume."""
+        self.online.clear()
+        for queue in self.transfers.values():
+            queue.put_nowait(ConnectionError("connection lost"))
+
+    def close(self):
+        """No more reconnects: fail every download for good."""
+        self.closed = True
+        self.online.set()  # Wake downloads waiting for a connection so they see closed
+        for queue in self.transfers.values():
+            queue.put_nowait(AttachmentError("connection closed"))
+
+    def handle_control(self, envelope):
+        """Feed FILE_DATA/FILE_ERROR envelopes; returns True if one belonged to a download."""
+        if envelope.type not in self.CONTROL_TYPES:
+            return False
+        queue = self.transfers.get(envelope.key)
+        if queue is None:
+            return False  # A FILE_ERROR may be about an upload instead
+        queue.put_nowait(envelope if envelope.type == MessageType.FILE_DATA else AttachmentError(envelope.text))
+        return True
+
+    async def fetch(self, sha):
+        """Local path of a stored attachment, downloading it on first use."""
+        if await asyncio.to_thread(os.path.exists, self.path_for(sha)):
+            return self.path_for(sha)
+        future = self.fetching.get(sha)
+        if future is None:
+            future = self.fetching[sha] = asyncio.ensure_future(self._download(sha))
+            future.add_done_callback(lambda _: self.fetching.pop(sha, None))
+        return await asyncio.shield(future)
+
+    async def _download(self, sha):
+        part = self.path_for(sha) + ".part"
+        await asyncio.to_thread(os.makedirs, os.path.dirname(part), exist_ok=True)
+        while True:
+            await self.online.wait()
+            if self.closed:
+                raise AttachmentError("connection closed")
+            queue = self.transfers[sha] = asyncio.Queue()
+            try:
+                received = await asyncio.to_thread(lambda: os.path.getsize(part) if os.path.exists(part) else 0)
+                await self.send(Envelope(MessageType.FILE_GET, id=received, key=sha))
+                size = None
+                while size is None or received < size:
+                    item = await queue.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    if item.id != received:
+                        raise AttachmentError(f"unexpected offset {item.id}")
+                    await asyncio.to_thread(_append, part, item.body)
+                    received, size = received + len(item.body), item.ack
+                await asyncio.to_thread(self._commit, part, sha)
+                return self.path_for(sha)
+            except self.link_errors:
+                self.online.clear()  # The link is gone even if link_down() has not been called yet
+                print(f"🔄 Download of {sha[:12]} interrupted, resuming after reconnect")
+            except AttachmentError:
+                await asyncio.to_thread(lambda: os.path.exists(part) and os.remove(part))  # Start over next time
+                raise
+            finally:
+                self.transfers.pop(sha, None)
+
+    def _commit(self, part, sha):
+        if file_sha256(part) != sha:
+            raise AttachmentError("checksum mismatch")
+        os.replace(part, self.path_for(sha))
+
+
+def _append(path, data):
+    with open(path, 'ab') as f:
+        f.write(data)
+
+
+def _fail(transfer, error):
+    for key in ("start", "done"):
+        if not transfer[key].done():
+            transfer[key].set_exception(error)
+    transfer["progress"].set()
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.set_result(value)
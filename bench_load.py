@@ -0,0 +1,314 @@
+"""Load and latency benchmark for the connection tier, without any Flet UI.
+
+Starts a ConnectionServer in a child process with an echo agent in place of the admin
+dashboard, seeds a scratch session_tokens.db with synthetic users, then drives thousands of
+simulated WebSocketClients through auth, message bursts and reconnects. Every reply makes
+the full trip: client -> server -> chat_messages.db commit -> inbox -> agent -> outbox
+queue -> client, and its round trip is recorded as the delivery latency.
+
+    python bench_load.py --clients 2000 --bursts 5 --burst-size 10 --reconnect-fraction 0.1
+
+Reports connect rate, messages/sec, p50/p99/p999 delivery latency, DB write throughput and
+server memory per connection, both process RSS and the session registry's own share.
+--tabs N gives each user N sockets at once (browser tabs, devices). --max-p99-ms and
+--max-session-bytes make the run exit non-zero on a regression.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import secrets
+import sqlite3
+import sys
+import tempfile
+import time
+
+from chat_bus import create_bus
+from client_side import WebSocketClient
+from connection_server import ConnectionServer
+from message_store import chatDatabase
+
+
+def rss_bytes():
+    """Resident memory of this process (Linux /proc; peak RSS elsewhere)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def raise_fd_limit():
+    """Thousands of sockets need more than the usual 1024 descriptors."""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def seed_sessions(db_path, users):
+    """Insert N synthetic users; returns [(username, token)]."""
+    credentials = [(f"loaduser{i}", secrets.token_hex(16)) for i in range(users)]
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS Sessions (
+                id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL,
+                session_token TEXT NOT NULL
+            )
+        ''')
+        conn.executemany("INSERT INTO Sessions (username, session_token) VALUES (?, ?)", credentials)
+    conn.close()
+    return credentials
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+# 🔹 Server side (child process)
+def run_server(port, workdir, conn):
+    os.chdir(workdir)
+    raise_fd_limit()
+    sys.stdout = open(os.devnull, "w")  # Per-connection logging would dominate the profile
+    asyncio.run(serve(port, conn))
+
+
+async def serve(port, conn):
+    chatDatabase()
+    bus = create_bus("memory")
+    server = ConnectionServer(bus, message_rate=None)  # Measure the tier itself, not the per-client limit
+    await server.start("localhost", port)
+
+    async def echo_agent(event):
+        # Stands in for an agent answering from the dashboard (see ServerApp.send_message)
+        sender = event["sender"]
+        await bus.drain(f"unread:{sender}")  # Answered at once, as in the agent's open conversation
+        if await bus.enqueue(f"outbox:{sender}", {"text": event["text"]}) is not None:
+            await bus.publish(f"deliver:{server.node_id}", {"receiver": sender})
+
+    bus.subscribe("inbox", echo_agent)
+    conn.send("ready")
+    while True:
+        command = await asyncio.to_thread(conn.recv)
+        if command == "stop":
+            break
+        conn.send({
+            "rss": rss_bytes(),
+            "connections": len(server.sessions),
+            "sessions": server.sessions.memory(),
+            "writer": server.message_writer.snapshot(),
+            "auth": server.authenticator.snapshot(),
+        })
+    await server.close()
+    conn.send("stopped")
+
+
+class ServerProcess:
+    def __init__(self, port, workdir):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=run_server, args=(port, workdir, child_conn), daemon=True)
+
+    async def start(self):
+        self.process.start()
+        await asyncio.to_thread(self.conn.recv)
+
+    async def stats(self):
+        self.conn.send("stats")
+        return await asyncio.to_thread(self.conn.recv)
+
+    async def stop(self):
+        self.conn.send("stop")
+        await asyncio.to_thread(self.conn.recv)
+        self.process.join(5)
+
+
+# 🔹 Client side (this process)
+class LoadRun:
+    def __init__(self, args, credentials):
+        self.args = args
+        self.credentials = credentials
+        self.uri = f"ws://localhost:{args.port}"
+        self.sent_at = {}  # message text -> perf_counter when sent
+        self.latencies_ms = []
+        self.sent = 0
+        self.received = 0
+        self.connect_failures = 0
+        self.reconnects = 0
+        self.all_delivered = asyncio.Event()
+
+    def on_message(self, envelope):
+        started = self.sent_at.pop(envelope.text, None)
+        if started is None:
+            return  # A replay after reconnect that was already counted
+        self.latencies_ms.append((time.perf_counter() - started) * 1000)
+        self.received += 1
+        if self.received == self.expected:
+            self.all_delivered.set()
+
+    @property
+    def expected(self):
+        return self.args.clients * self.args.bursts * self.args.burst_size
+
+    async def connect(self, client, gate):
+        async with gate:
+            await client.connect()
+            try:
+                await asyncio.wait_for(client.authenticated.wait(), self.args.timeout)
+            except asyncio.TimeoutError:
+                self.connect_failures += 1
+
+    async def converse(self, index, client):
+        reconnect_at = self.args.bursts // 2 if random.random() < self.args.reconnect_fraction else None
+        for burst in range(self.args.bursts):
+            if burst == reconnect_at:
+                # Drop the link; the client's connection manager brings it back on its own
+                client.authenticated.clear()
+                await client.websocket.close()
+                await asyncio.wait_for(client.authenticated.wait(), self.args.timeout)
+                self.reconnects += 1
+            for n in range(self.args.burst_size):
+                text = f"{index}:{burst}:{n}"
+                self.sent_at[text] = time.perf_counter()
+                await client.send_message(text)
+                self.sent += 1
+            await asyncio.sleep(random.uniform(0, 2 * self.args.think_time))
+
+    async def run(self, server):
+        clients = []
+        for index in range(self.args.clients):
+            username, token = self.credentials[index // self.args.tabs]  # Consecutive clients share a user
+            client = WebSocketClient(self.uri, self.on_message)
+            client.username, client.session_token = username, token
+            clients.append(client)
+
+        baseline = await server.stats()
+        gate = asyncio.Semaphore(self.args.connect_concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(self.connect(client, gate) for client in clients))
+        connect_seconds = time.perf_counter() - started
+        connected = await server.stats()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(self.converse(index, client) for index, client in enumerate(clients)))
+        try:
+            await asyncio.wait_for(self.all_delivered.wait(), self.args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        message_seconds = time.perf_counter() - started
+        finished = await server.stats()
+
+        await asyncio.gather(*(client.close() for client in clients))
+        return self.report(baseline, connected, finished, connect_seconds, message_seconds)
+
+    def report(self, baseline, connected, finished, connect_seconds, message_seconds):
+        latencies = sorted(self.latencies_ms)
+        written = finished["writer"]["written"] - connected["writer"]["written"]
+        commits = finished["writer"]["commits"] - connected["writer"]["commits"]
+        clients = self.args.clients
+        return {
+            "clients": clients,
+            "connected": connected["connections"],
+            "users_online": connected["sessions"]["users"],
+            "connect_failures": self.connect_failures,
+            "connect_rate": clients / connect_seconds if connect_seconds else 0.0,
+            "reconnects": self.reconnects,
+            "sent": self.sent,
+            "delivered": self.received,
+            "lost": self.sent - self.received,
+            "messages_per_second": self.received / message_seconds if message_seconds else 0.0,
+            "latency_p50_ms": percentile(latencies, 0.50),
+            "latency_p99_ms": percentile(latencies, 0.99),
+            "latency_p999_ms": percentile(latencies, 0.999),
+            "latency_max_ms": latencies[-1] if latencies else 0.0,
+            "db_rows_per_second": written / message_seconds if message_seconds else 0.0,
+            "db_rows_per_commit": written / commits if commits else 0.0,
+            "db_avg_commit_ms": finished["writer"]["avg_commit_ms"],
+            "auth_avg_ms": finished["auth"]["avg_latency_ms"],
+            "memory_per_connection_kb": (connected["rss"] - baseline["rss"]) / clients / 1024 if clients else 0.0,
+            "session_bytes_per_connection": connected["sessions"]["bytes_per_session"],
+            "server_rss_mb": finished["rss"] / 1024 / 1024,
+        }
+
+
+def print_report(report):
+    print(f"👥 Clients: {report['connected']}/{report['clients']} connected as {report['users_online']} users, "
+          f"{report['connect_failures']} failed, {report['reconnects']} reconnects")
+    print(f"🔌 Connect rate: {report['connect_rate']:.0f} conn/s")
+    print(f"💬 Messages: {report['delivered']}/{report['sent']} delivered, {report['messages_per_second']:.0f} msg/s")
+    print(f"⏱ Delivery latency: p50 {report['latency_p50_ms']:.1f} ms · p99 {report['latency_p99_ms']:.1f} ms · "
+          f"p999 {report['latency_p999_ms']:.1f} ms · max {report['latency_max_ms']:.1f} ms")
+    print(f"🗃 DB writes: {report['db_rows_per_second']:.0f} rows/s, {report['db_rows_per_commit']:.1f} rows/commit, "
+          f"{report['db_avg_commit_ms']:.2f} ms/commit")
+    print(f"🔐 Auth: {report['auth_avg_ms']:.3f} ms avg")
+    print(f"🧠 Memory: {report['memory_per_connection_kb']:.1f} KiB/connection, "
+          f"{report['session_bytes_per_connection']:.0f} B/connection in the session registry, "
+          f"server RSS {report['server_rss_mb']:.0f} MiB")
+
+
+async def main_async(args, workdir):
+    credentials = seed_sessions(os.path.join(workdir, "session_tokens.db"),
+                                max(args.users, -(-args.clients // args.tabs)))
+    server = ServerProcess(args.port, workdir)
+    await server.start()
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            report = await LoadRun(args, credentials).run(server)
+    finally:
+        await server.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless load/latency benchmark for the WebSocket server.")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=0, help="users to seed (default: one per client)")
+    parser.add_argument("--tabs", type=int, default=1, help="sockets each user holds open at once")
+    parser.add_argument("--bursts", type=int, default=5, help="message bursts per client")
+    parser.add_argument("--burst-size", type=int, default=10, help="messages sent back to back per burst")
+    parser.add_argument("--think-time", type=float, default=0.2, help="mean pause between bursts (seconds)")
+    parser.add_argument("--reconnect-fraction", type=float, default=0.1,
+                        help="share of clients that drop and reconnect halfway through")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="handshakes in flight at once")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--workdir", help="where the scratch databases go (default: a temp dir)")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--max-p99-ms", type=float, help="exit 1 if p99 delivery latency exceeds this")
+    parser.add_argument("--max-session-bytes", type=float,
+                        help="exit 1 if the session registry holds more than this many bytes per connection")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    with tempfile.TemporaryDirectory(prefix="chat-bench-") as scratch:
+        workdir = args.workdir or scratch
+        os.makedirs(workdir, exist_ok=True)
+        report = asyncio.run(main_async(args, workdir))
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.max_p99_ms is not None and report["latency_p99_ms"] > args.max_p99_ms:
+        print(f"🔴 p99 {report['latency_p99_ms']:.1f} ms exceeds {args.max_p99_ms} ms")
+        sys.exit(1)
+    if args.max_session_bytes is not None and report["session_bytes_per_connection"] > args.max_session_bytes:
+        print(f"🔴 Session registry uses {report['session_bytes_per_connection']:.0f} B/connection, "
+              f"over {args.max_session_bytes:.0f}")
+        sys.exit(1)
+    if report["lost"] or report["connect_failures"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
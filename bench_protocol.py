@@ -0,0 +1,96 @@
+"""Microbenchmark: legacy pipe-delimited strings vs. the binary envelope codec.
+
+Run with `python bench_protocol.py [--number N]`. For each typical frame it reports the
+encode and decode cost in nanoseconds per operation and the bytes sent on the wire.
+"""
+import argparse
+import os
+import time
+import timeit
+
+from protocol import Codec, Envelope, MessageType, chat
+
+SHORT_TEXT = "Hi, my order #4821 has not arrived yet, can you check?"
+LONG_TEXT = ("Thanks for waiting. I checked the courier's tracking page and the parcel is held at the "
+             "regional depot because the address label was damaged. ") * 12
+CHUNK = os.urandom(64 * 1024)
+
+
+# 🔹 Today's string format, encoded and parsed exactly as the old client/server did
+def legacy_auth():
+    return "alice|3f9c2a7e1b8d4c6f".encode()
+
+
+def legacy_auth_decode(frame):
+    username, session_token = frame.decode().split("|", 1)
+    return username, session_token
+
+
+def legacy_chat(text):
+    return lambda: f"alice|server|{text}".encode()
+
+
+def legacy_chat_decode(frame):
+    sender, receiver, message_text = frame.decode().split("|", 2)
+    return sender, receiver, message_text
+
+
+def legacy_reply(text):
+    return lambda: f"Server: {text}".encode()
+
+
+def legacy_reply_decode(frame):
+    sender, text = frame.decode().split(":", 1)
+    return sender.strip(), text.strip()
+
+
+def cases():
+    plain = Codec()
+    packed = Codec(compress=True)
+    hello = Envelope(MessageType.HELLO, sender="alice", body="3f9c2a7e1b8d4c6f")
+    chunk = Envelope(MessageType.FILE_CHUNK, id=65536, key="ab" * 32, body=CHUNK)
+    return [
+        ("auth", legacy_auth, legacy_auth_decode, plain, lambda: hello),
+        ("short chat", legacy_chat(SHORT_TEXT), legacy_chat_decode, plain,
+         lambda: chat("alice", "server", SHORT_TEXT)),
+        ("long chat", legacy_chat(LONG_TEXT), legacy_chat_decode, plain,
+         lambda: chat("alice", "server", LONG_TEXT)),
+        ("long chat+zlib", legacy_chat(LONG_TEXT), legacy_chat_decode, packed,
+         lambda: chat("alice", "server", LONG_TEXT)),
+        ("server reply", legacy_reply(SHORT_TEXT), legacy_reply_decode, plain,
+         lambda: chat("server", "alice", SHORT_TEXT, id=42)),
+        # The old format had no chunked upload; a 64 KiB chunk is shown for the new codec only
+        ("64K file chunk", None, None, plain, lambda: chunk),
+    ]
+
+
+def per_op_ns(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare wire formats for encode/decode cost and size.")
+    parser.add_argument("--number", type=int, default=20000, help="iterations per measurement")
+    args = parser.parse_args()
+
+    print(f"{'frame':<16}{'format':<8}{'encode ns':>12}{'decode ns':>12}{'bytes':>10}")
+    started = time.perf_counter()
+    for name, legacy_encode, legacy_decode, codec, make in cases():
+        # Chunks are large; fewer iterations keep the run short without changing ns/op much
+        number = args.number if name != "64K file chunk" else max(args.number // 100, 10)
+        if legacy_encode is not None:
+            frame = legacy_encode()
+            encode_ns = per_op_ns(legacy_encode, number)
+            decode_ns = per_op_ns(lambda: legacy_decode(frame), number)
+            print(f"{name:<16}{'legacy':<8}{encode_ns:>12.0f}{decode_ns:>12.0f}{len(frame):>10}")
+
+        envelope = make()
+        frame = codec.encode(envelope)
+        encode_ns = per_op_ns(lambda: codec.encode(make()), number)
+        decode_ns = per_op_ns(lambda: codec.decode(frame), number)
+        print(f"{name:<16}{'binary':<8}{encode_ns:>12.0f}{decode_ns:>12.0f}{len(frame):>10}")
+    print(f"⏱ Finished in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import sqlite3
+
+DB_PATH = 'chat_messages.db'
+AUDIENCE_PREFIXES = ("broadcast:", "group:")  # Receiver labels of broadcast rows in Messages
+
+
+def is_audience(name):
+    """True for a broadcast's audience label, as opposed to a customer name."""
+    return name.startswith(AUDIENCE_PREFIXES)
+
+
+def create_broadcast_tables(conn):
+    """Recipient sets for broadcast messages, and named groups to broadcast to.
+
+    A broadcast is stored once in Messages, addressed to its audience label (for example
+    "group:outage"); MessageRecipients lists who it went to. Keyed by (receiver, message_id),
+    a client's history reads its broadcasts with the same range scan as its direct messages.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS MessageRecipients (
+            receiver TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (receiver, message_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messagerecipients_message ON MessageRecipients (message_id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS GroupMembers (
+            group_name TEXT NOT NULL,
+            member TEXT NOT NULL,
+            PRIMARY KEY (group_name, member)
+        ) WITHOUT ROWID
+    ''')
+    conn.commit()
+
+
+class GroupDirectory:
+    """Named customer groups (outage notices, group rooms) kept in chat_messages.db."""
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+
+    def fetch_groups(self):
+        """{group name: member count}."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return dict(conn.execute(
+                'SELECT group_name, COUNT(*) FROM GroupMembers GROUP BY group_name ORDER BY group_name').fetchall())
+        finally:
+            conn.close()
+
+    def fetch_members(self, group_name):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return [member for member, in conn.execute(
+                'SELECT member FROM GroupMembers WHERE group_name = ? ORDER BY member', (group_name,))]
+        finally:
+            conn.close()
+
+    def add(self, group_name, members):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO GroupMembers VALUES (?, ?)',
+                                 [(group_name, member) for member in members])
+        finally:
+            conn.close()
+
+    def remove(self, group_name, members=None):
+        """Remove members from a group, or the whole group when members is None."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                if members is None:
+                    conn.execute('DELETE FROM GroupMembers WHERE group_name = ?', (group_name,))
+                else:
+                    conn.executemany('DELETE FROM GroupMembers WHERE group_name = ? AND member = ?',
+                                     [(group_name, member) for member in members])
+        finally:
+            conn.close()
+
+    # 🔹 Worker-thread versions for the dashboard's event loop
+    async def load_groups(self):
+        return await asyncio.to_thread(self.fetch_groups)
+
+    async def load_members(self, group_name):
+        return await asyncio.to_thread(self.fetch_members, group_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the customer groups agents can broadcast to.")
+    parser.add_argument("--db", default=DB_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="show every group and its size")
+    show = commands.add_parser("show", help="list one group's members")
+    show.add_argument("group")
+    add = commands.add_parser("add", help="add customers to a group (created on first use)")
+    add.add_argument("group")
+    add.add_argument("members", nargs="+")
+    remove = commands.add_parser("remove", help="remove customers, or the whole group if none are given")
+    remove.add_argument("group")
+    remove.add_argument("members", nargs="*")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    create_broadcast_tables(conn)
+    conn.close()
+    groups = GroupDirectory(args.db)
+    if args.command == "list":
+        for name, count in groups.fetch_groups().items():
+            print(f"{name:<30} {count:>8} members")
+    elif args.command == "show":
+        for member in groups.fetch_members(args.group):
+            print(member)
+    elif args.command == "add":
+        groups.add(args.group, args.members)
+        print(f"✅ {args.group}: {len(groups.fetch_members(args.group))} members")
+    elif args.command == "remove":
+        groups.remove(args.group, args.members or None)
+        print(f"🗑 {args.group}: {len(groups.fetch_members(args.group))} members")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+
+from offline_queue import OfflineQueueStore
+
+BUS_DB_PATH = 'chat_bus.db'
+PUBLISH_RETRY_DELAY = 0.5  # Seconds before retrying a batch of events the database refused
+
+
+class ChatBus(ABC):
+    """Pub/sub, presence and queue state shared by the connection workers and the admin UI.
+
+    Channels used by the server:
+      - "presence"          {"username", "node", "online"}
+      - "inbox"             customer messages for the agents {"id", "sender", "receiver", "text"}
+      - "deliver:<node_id>" agent replies routed to the worker holding the customer's socket
+      - "broadcast"         a stored broadcast {"id", "receiver", "text", "recipients"}, fanned
+                            out by every worker to the recipients it holds
+    Queues live in a bounded, durable OfflineQueueStore and hold per-customer unread
+    messages for the agents ("unread:<username>") and replies waiting to be acknowledged
+    by a customer ("outbox:<username>").
+    """
+
+    def __init__(self, queue_store=None):
+        self.subscribers = {}
+        self.queue_store = queue_store or OfflineQueueStore()
+
+    async def start(self):
+        await self.queue_store.open()
+
+    async def close(self):
+        await self.queue_store.close()
+
+    def subscribe(self, channel, callback):
+        """Register callback(message) for a channel; coroutine callbacks run as tasks."""
+        self.subscribers.setdefault(channel, []).append(callback)
+
+    def unsubscribe(self, channel, callback):
+        callbacks = self.subscribers.get(channel, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def dispatch(self, channel, message):
+        for callback in list(self.subscribers.get(channel, [])):
+            try:
+                result = callback(message)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception as e:
+                print(f"🔥 Bus subscriber error on {channel}: {e}")
+
+    @abstractmethod
+    async def publish(self, channel, message):
+        ...
+
+    @abstractmethod
+    async def set_presence(self, username, node_id):
+        ...
+
+    @abstractmethod
+    async def clear_presence(self, username, node_id):
+        ...
+
+    async def touch_presence(self, node_id):
+        """Heartbeat every customer held by node_id (only needed by shared backends)."""
+        pass
+
+    @abstractmethod
+    async def presence(self):
+        """Return (username, node_id) pairs for every connected customer on any node; a customer
+        with sockets on several nodes appears once per node."""
+
+    async def enqueue(self, queue_name, item):
+        """Append to a queue; returns the item's sequence number or None if it was refused."""
+        return await self.queue_store.push(queue_name, item)
+
+    async def pending(self, queue_name, after_seq=0, limit=500):
+        """Unacknowledged (seq, item) pairs after after_seq, oldest first."""
+        return await self.queue_store.pending(queue_name, after_seq, limit)
+
+    async def ack(self, queue_name, upto_seq):
+        await self.queue_store.ack(queue_name, upto_seq)
+
+    async def drain(self, queue_name):
+        """Pop and return every item in a queue, oldest first."""
+        return await self.queue_store.drain(queue_name)
+
+    async def queue_sizes(self):
+        return await self.queue_store.sizes()
+
+
+class InProcessBus(ChatBus):
+    """Everything in one process: the default when the UI embeds the connection server."""
+
+    def __init__(self, queue_store=None):
+        super().__init__(queue_store)
+        self.online = {}
+
+    async def publish(self, channel, message):
+        self.dispatch(channel, message)
+
+    async def set_presence(self, username, node_id):
+        self.online[username] = node_id
+
+    async def clear_presence(self, username, node_id):
+        if self.online.get(username) == node_id:
+            del self.online[username]
+
+    async def presence(self):
+        return list(self.online.items())
+
+
+class SQLiteBus(ChatBus):
+    """Local broker stand-in: a WAL SQLite file shared by worker processes on one box.
+
+    Published events are appended to BusEvents in batches by a single flusher task and
+    every process polls for rows past the last id it has seen. Presence rows carry a
+    heartbeat so a crashed worker's customers drop out after presence_ttl seconds.
+    """
+
+    def __init__(self, db_path=BUS_DB_PATH, poll_interval=0.02, presence_ttl=30.0, event_ttl=60.0,
+                 queue_store=None):
+        # Queues are shared by every process, so they are always read from disk
+        super().__init__(queue_store or OfflineQueueStore(memory_budget=0))
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self.presence_ttl = presence_ttl
+        self.event_ttl = event_ttl
+        self.last_event_id = 0
+        self.outbox = []
+        self.outbox_ready = None
+        self.tasks = []
+        self._conn = None
+        self._lock = threading.Lock()
+
+    async def start(self):
+        if self.tasks:
+            return  # Already started by another component in this process
+        await super().start()
+        self.outbox_ready = asyncio.Event()
+        self.last_event_id = await self._run(self._setup)
+        self.tasks = [
+            asyncio.create_task(self._poll_loop()),
+            asyncio.create_task(self._flush_loop()),
+        ]
+
+    async def close(self):
+        await self._flush_outbox()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        await super().close()
+
+    async def publish(self, channel, message):
+        self.outbox.append((channel, json.dumps(message), time.time()))
+        self.outbox_ready.set()
+
+    async def set_presence(self, username, node_id):
+        await self._execute('INSERT OR REPLACE INTO Presence (username, node_id, updated) VALUES (?, ?, ?)',
+                            (username, node_id, time.time()))
+
+    async def clear_presence(self, username, node_id):
+        await self._execute('DELETE FROM Presence WHERE username = ? AND node_id = ?', (username, node_id))
+
+    async def touch_presence(self, node_id):
+        """Heartbeat every customer held by node_id."""
+        await self._execute('UPDATE Presence SET updated = ? WHERE node_id = ?', (time.time(), node_id))
+
+    async def presence(self):
+        rows = await self._query('SELECT username, node_id FROM Presence WHERE updated > ? ORDER BY updated',
+                                 (time.time() - self.presence_ttl,))
+        return [tuple(row) for row in rows]
+
+    def _setup(self):
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS BusEvents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS Presence (
+                username TEXT NOT NULL,
+                node_id TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (username, node_id)
+            );
+        ''')
+        return self._conn.execute('SELECT COALESCE(MAX(id), 0) FROM BusEvents').fetchone()[0]
+
+    async def _run(self, func, *args):
+        def locked():
+            with self._lock:
+                return func(*args)
+        return await asyncio.to_thread(locked)
+
+    async def _execute(self, sql, params=()):
+        await self._run(self._conn.execute, sql, params)
+
+    async def _query(self, sql, params=()):
+        return await self._run(lambda: self._conn.execute(sql, params).fetchall())
+
+    def _insert_events(self, events):
+        self._conn.execute('BEGIN')
+        try:
+            self._conn.executemany('INSERT INTO BusEvents (channel, payload, created) VALUES (?, ?, ?)', events)
+            self._conn.execute('DELETE FROM BusEvents WHERE created < ?', (time.time() - self.event_ttl,))
+            self._conn.execute('COMMIT')
+        except Exception:
+            if self._conn.in_transaction:
+                self._conn.execute('ROLLBACK')
+            raise
+
+    async def _flush_outbox(self):
+        if self.outbox:
+            events, self.outbox = self.outbox, []
+            try:
+                await self._run(self._insert_events, events)
+            except Exception:
+                self.outbox[:0] = events  # Put the batch back ahead of anything published meanwhile
+                raise
+
+    async def _flush_loop(self):
+        while True:
+            await self.outbox_ready.wait()
+            self.outbox_ready.clear()
+            try:
+                await self._flush_outbox()
+            except Exception as e:
+                # Keep the flusher alive whatever failed; the batch is retried, not dropped
+                print(f"🔥 Bus publish error, retrying in {PUBLISH_RETRY_DELAY}s: {e!r}")
+                await asyncio.sleep(PUBLISH_RETRY_DELAY)
+                self.outbox_ready.set()
+
+    async def _poll_loop(self):
+        while True:
+            try:
+                rows = await self._query('SELECT id, channel, payload FROM BusEvents WHERE id > ? ORDER BY id',
+                                         (self.last_event_id,))
+            except sqlite3.Error as e:
+                print("🔥 Bus poll error:", e)
+                rows = []
+            for event_id, channel, payload in rows:
+                self.last_event_id = event_id
+                if channel in self.subscribers:
+                    self.dispatch(channel, json.loads(payload))
+            await asyncio.sleep(self.poll_interval)
+
+
+def create_bus(kind="memory", **options):
+    """Build a bus backend by name: "memory" (single process) or "sqlite" (multi-process)."""
+    if kind == "memory":
+        return InProcessBus()
+    if kind == "sqlite":
+        return SQLiteBus(**options)
+    raise ValueError(f"Unknown bus backend: {kind}")
@@ -1,49 +1,239 @@
 
 import flet as ft
 import asyncio
+import os
+import random
 import websockets
 import sys
+from collections import deque
+from attachments import (AttachmentDownloader, AttachmentError, AttachmentUploader, attachment_kind, file_sha256,
+                         parse_attachment_message)
+from history_cache import HistoryCache
+from media_previews import MediaPreviewer
+from protocol import FLAG_COMPRESS_OK, FLAG_SYNC, Codec, Envelope, MessageType, ProtocolError, chat, unpack_batch
+from render_scheduler import RenderScheduler
+from transcript import Transcript
+
+MAX_TRANSCRIPT_ROWS = 200  # Cached messages shown when the app opens
 
 class WebSocketClient:
-    def __init__(self, uri, message_callback):
+    """Keeps one authenticated connection alive for the life of the app.
+
+    Failed connects and dropped links are retried in a loop with exponential backoff and
+    full jitter, so a server restart does not bring every client back in lockstep.
+    WebSocket pings detect a dead link within ping_interval + ping_timeout. The HELLO
+    carries the last server message id we acknowledged, so the server resumes after it.
+    Chat typed while offline is held (up to max_outgoing messages, then refused) and sent
+    after the next AUTH_OK. An AUTH_FAILED answer stops retrying, since the same
+    credentials would be rejected again; any other error is retried. A server that is
+    restarting sends RECONNECT with the delay it assigned this client, which is
+    used instead of the backoff so the clients of a drained server return staggered.
+
+    With a history_cache, the HELLO also asks for stored messages newer than the last
+    cached id; they arrive in HISTORY batches before any queued reply, are saved to the
+    cache and passed to history_callback(rows).
+    """
+
+    def __init__(self, uri, message_callback, status_callback=None, backoff_base=0.5, backoff_max=30.0,
+                 ping_interval=10.0, ping_timeout=10.0, open_timeout=10.0, max_outgoing=1000,
+                 history_cache=None, history_callback=None):
         self.uri = uri
         self.websocket = None
-        self.message_callback = message_callback
+        self.message_callback = message_callback  # Called with each CHAT Envelope
+        self.status_callback = status_callback  # Optional: called with connection status text
         self.username = None  # These will be automatically set.
         self.session_token = None
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.open_timeout = open_timeout
+        self.codec = Codec()
+        self.last_seq = 0  # Highest queued server message acknowledged and shown
+        self.authenticated = asyncio.Event()  # Set while the server has accepted us
+        self.auth_failed = False
+        self.reconnect_after = None  # Seconds the server asked us to wait before reconnecting
+        self.closed = False
+        self.outgoing = deque()  # Chat envelopes waiting for a connection
+        self.max_outgoing = max_outgoing  # Beyond this, new messages are refused rather than held
+        self.task = None
+        self.stats = {"connects": 0, "failures": 0, "drops": 0}
+        self.uploader = AttachmentUploader(self.send_envelope,
+                                           link_errors=(ConnectionError, websockets.ConnectionClosed))
+        self.downloader = AttachmentDownloader(self.send_envelope,
+                                               link_errors=(ConnectionError, websockets.ConnectionClosed))
+        self.history_cache = history_cache
+        self.history_callback = history_callback  # Optional: called with each synced batch of rows
+        self.synced_id = None  # Highest stored message id in the cache (None until read)
+        self.history_synced = False  # A full catch-up has completed since the app started
 
     async def connect(self):
-        """Connect to the WebSocket server and authenticate."""
-        try:
-            self.websocket = await websockets.connect(self.uri)
+        """Start the connection manager in the background (idempotent)."""
+        if self.task is None or self.task.done():
+            self.closed = False
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def close(self):
+        """Stop reconnecting and close the current socket."""
+        self.closed = True
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def backoff(self, attempt):
+        """Full jitter: uniform in [0, min(max, base * 2**attempt)]."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def run(self):
+        attempt = 0
+        self.uploader.closed = self.downloader.closed = False
+        while not self.closed:
+            try:
+                await self.open_session()
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                self.stats["failures"] += 1
+                print(f"🔴 Connection failed ({e}).")
+            except Exception as e:
+                # A bug in decoding or a UI callback must not end reconnecting for good
+                self.stats["failures"] += 1
+                print(f"🔥 Session ended by an unexpected error: {e!r}")
+            else:
+                if self.auth_failed:
+                    self.closed = True
+                    self.report_status("Authentication failed. Please log in again.")
+                    break
+                if self.closed:
+                    break
+                self.stats["drops"] += 1
+                self.report_status("Connection lost. Reconnecting...")
+                attempt = 0  # We were connected: start the backoff over
+            finally:
+                self.authenticated.clear()
+                self.uploader.link_down()  # Uploads resume from the server's offset after the next AUTH_OK
+                self.downloader.link_down()
+                self.websocket = None
+
+            delay = self.backoff(attempt) if self.reconnect_after is None else self.reconnect_after
+            self.reconnect_after = None
+            attempt += 1
+            print(f"🔄 Reconnecting in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+        self.uploader.close()  # Not reconnecting: transfers still waiting would wait forever
+        self.downloader.close()
+
+    async def open_session(self):
+        """Connect, authenticate and receive until the link drops."""
+        async with websockets.connect(self.uri, open_timeout=self.open_timeout, ping_interval=self.ping_interval,
+                                      ping_timeout=self.ping_timeout) as websocket:
+            self.websocket = websocket
+            self.codec = Codec()
+            self.stats["connects"] += 1
             print("✅ Connected to WebSocket server.")
-        
-            # Immediately send auth credentials in the format "username|session_token"
-            auth_message = f"{self.username}|{self.session_token}"
-            await self.websocket.send(auth_message)
-            print("✅ Sent authentication message:", auth_message)
-        
-            # Now start listening for incoming messages
-            asyncio.create_task(self.receive_messages())
-        except Exception as e:
-            print("🔴 Connection failed. Retrying...")
-            await asyncio.sleep(3)
-            await self.connect()
 
-    async def send_message(self, message):
-        """Send a message to the server."""
-        if self.websocket:
-            await self.websocket.send(message)
+            # Immediately send a HELLO with our credentials and resume points, offering compressed bodies
+            flags = FLAG_COMPRESS_OK
+            if self.history_cache is not None:
+                if self.synced_id is None:
+                    self.synced_id = await self.history_cache.load_last_id()
+                flags |= FLAG_SYNC
+            await self.send_envelope(Envelope(MessageType.HELLO, ack=self.last_seq, id=self.synced_id or 0,
+                                              sender=self.username, body=self.session_token, flags=flags))
+            print("✅ Sent authentication message for", self.username)
+            await self.receive_messages()
 
-    async def receive_messages(self):
-        """Listen for messages from the server."""
-        while True:
+    def report_status(self, text):
+        if self.status_callback is not None:
+            self.status_callback(text)
+
+    async def send_envelope(self, envelope):
+        """Encode and send one protocol message."""
+        if self.websocket is None:
+            raise ConnectionError("not connected")
+        await self.websocket.send(self.codec.encode(envelope))
+
+    async def send_message(self, text, receiver="server"):
+        """Send a chat message to the server, or hold it until we are back online.
+
+        Returns False if it was refused because max_outgoing messages are already held.
+        """
+        envelope = chat(self.username, receiver, text)
+        if self.authenticated.is_set():
             try:
-                message = await self.websocket.recv()
-                self.message_callback(message)  # Send message to UI
-            except websockets.exceptions.ConnectionClosed:
-                print("⚠️ Connection closed.")
-                break
+                await self.send_envelope(envelope)
+                return True
+            except (ConnectionError, websockets.ConnectionClosed):
+                pass
+        if len(self.outgoing) >= self.max_outgoing:
+            self.report_status(f"Not sent: {len(self.outgoing)} messages are already waiting for the connection.")
+            return False
+        self.outgoing.append(envelope)
+        return True
+
+    async def flush_outgoing(self):
+        """Send chat held while offline, oldest first."""
+        while self.outgoing:
+            await self.send_envelope(self.outgoing[0])
+            self.outgoing.popleft()
+
+    async def receive_messages(self):
+        """Listen for messages from the server until the connection closes."""
+        try:
+            async for frame in self.websocket:
+                try:
+                    envelope = self.codec.decode(frame)
+                except ProtocolError as e:
+                    print(f"❌ Malformed frame from server ({e}), ignoring...")
+                    continue
+
+                if envelope.type == MessageType.AUTH_OK:
+                    self.codec.compress = bool(envelope.flags & FLAG_COMPRESS_OK)
+                    await self.flush_outgoing()
+                    self.authenticated.set()
+                    self.uploader.link_up()
+                    self.downloader.link_up()
+                    print("✅ Authenticated.")
+                elif envelope.type == MessageType.AUTH_FAILED:
+                    print("🔴 Authentication failed.")
+                    self.auth_failed = True
+                    break
+                elif envelope.type == MessageType.HISTORY:
+                    await self.receive_history(envelope)
+                elif envelope.type == MessageType.HISTORY_END:
+                    self.history_synced = True
+                elif envelope.type == MessageType.RECONNECT:
+                    self.reconnect_after = envelope.id / 1000
+                    self.report_status("Server restarting, reconnecting shortly...")
+                elif self.downloader.handle_control(envelope) or self.uploader.handle_control(envelope):
+                    continue  # Transfer progress, handled by the downloader or uploader
+                elif envelope.type == MessageType.CHAT:
+                    if envelope.id:
+                        # Queued server message: ack it, skip it if it is a replay
+                        await self.send_envelope(Envelope(MessageType.ACK, ack=envelope.id))
+                        if envelope.id <= self.last_seq:
+                            continue
+                        self.last_seq = envelope.id
+                    if envelope.ack and envelope.ack <= (self.synced_id or 0):
+                        continue  # Already delivered in a history batch
+                    self.message_callback(envelope)  # Send message to UI
+        except websockets.ConnectionClosed:
+            pass
+        print("⚠️ Connection closed.")
+
+    async def receive_history(self, envelope):
+        """Save one batch of synced messages to the cache, then hand it to the UI."""
+        try:
+            batch = unpack_batch(envelope.body)
+        except ProtocolError as e:
+            print(f"❌ Malformed history batch ({e}), ignoring...")
+            return
+        rows = [(message.id, message.sender, message.receiver, message.text, message.timestamp)
+                for message in batch]
+        await self.history_cache.store(rows)
+        self.synced_id = max(self.synced_id or 0, envelope.id)
+        if self.history_callback is not None:
+            self.history_callback(rows)
 
 class ChatApp:
     def __init__(self, page: ft.Page):
@@ -60,11 +250,21 @@ class ChatApp:
             self.page.go("/login")  # Redirect if no valid credentials
             return
         
-        self.ws_client = WebSocketClient("ws://localhost:8765", self.display_message)
+        # 📜 Local copy of the conversation; reconnects only fetch what is newer
+        self.history_cache = HistoryCache(f"chat_cache_{self.username}.db")
+        self.shown_ids = set()  # Stored message ids already rendered from a live delivery
+        self.ws_client = WebSocketClient("ws://localhost:8765", self.on_server_message,
+                                         status_callback=self.display_message,
+                                         history_cache=self.history_cache, history_callback=self.on_history)
         self.ws_client.username = self.username
         self.ws_client.session_token = self.session_token
 
         self.selected_files = []
+        # 🖼 Bubbles show thumbnails/posters/waveforms built off the loop; full media opens on click
+        self.previewer = MediaPreviewer()
+        self.render_stats = ft.Text("", size=10, color="grey")
+        # 🎛 Incoming bursts are painted with at most one page.update() per frame
+        self.renderer = RenderScheduler(self.page, fps=30, stats_control=self.render_stats)
         self.message_input = ft.TextField(label="Type a message...",  multiline=True, dense=True, border_radius=10)
         self.send_button = ft.ElevatedButton("Send", on_click=self.send_message, elevation=20)
         self.multimedia_button = ft.IconButton(
@@ -73,20 +273,29 @@ class ChatApp:
             on_click=self.pick_files
         )
         self.chat_box = ft.Container(
-            content= ft.Column(scroll=True),
+            content= ft.Column(scroll=True, on_scroll=self.on_chat_scroll, on_scroll_interval=100),
             border_radius=10,
             width=self.page.width * 0.5,
             height=self.page.height * 0.5,
             bgcolor="white",
             shadow=ft.BoxShadow(blur_radius=3, spread_radius=5, color="grey")
         )
+        # 📜 Every message is kept as a small tuple; only a window of them exists as controls
+        self.transcript = Transcript(self.chat_box.content.controls, self.build_row)
+        self.previewed = {}  # id(bubble) -> media bubble currently showing its preview
 
         self.file_picker = ft.FilePicker(on_result=self.on_file_picker_result)
         self.page.overlay.append(self.file_picker)
 
         self.chat_ui()
-        self.page.run_task(self.ws_client.connect)  # Connect to server
-    
+        self.renderer.start_stats()
+        self.page.run_task(self.start_chat)  # Show cached history, then connect to server
+
+    async def start_chat(self):
+        """Show the cached conversation straight away, then connect and sync what is newer."""
+        self.on_history(await self.history_cache.load_recent(MAX_TRANSCRIPT_ROWS))
+        await self.ws_client.connect()
+
     def chat_ui(self):
         self.page.overlay.clear()
 
@@ -112,7 +321,7 @@ class ChatApp:
             content=ft.Container(
                 content=  ft.Column(
                     controls=[
-                        self.chat_header, self.chat_box, self.wrap_control
+                        self.chat_header, self.chat_box, self.wrap_control, self.render_stats
                     ],
                     horizontal_alignment=ft.CrossAxisAlignment.CENTER
                 ),
@@ -142,94 +351,201 @@ class ChatApp:
                 attached_names.append(file.name)
             current_text = self.message_input.value or ""
             self.message_input.value = current_text + " [Attached: " + ", ".join(attached_names) + "]"
-        self.page.update()
+        self.renderer.request()
 
     async def send_message(self, e):
         """Send the text and all attached media in one go."""
         text_msg = self.message_input.value.strip()
 
         if text_msg:
-            formatted_message = f"{self.username}|server|{text_msg}"  # Use your required format
-            await self.ws_client.send_message(formatted_message)
-            self.display_message(f"{self.username}: {text_msg}")
+            if not await self.ws_client.send_message(text_msg):
+                self.renderer.request()
+                return  # Offline buffer full: the text stays in the box to send later
+            self.display_message(text_msg, sender=self.username)
 
         for file_path in self.selected_files:
-            if file_path.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp")):
-                prefix = "IMAGE:"
-            elif file_path.lower().endswith((".mp3", ".wav", ".ogg")):
-                prefix = "AUDIO:"
-            elif file_path.lower().endswith((".mp4", ".mov", ".avi", ".mkv")):
-                prefix = "VIDEO:"
-            else:
-                prefix = "FILE:"  # Fallback for other media types.
-            multimedia_message = f"{prefix} {file_path}"
-            await self.ws_client.send_message(multimedia_message)
-            self.display_message(multimedia_message)
+            # Show the local file right away; the bytes stream to the server in the background
+            self.display_message(file_path, sender=self.username, kind=attachment_kind(file_path))
+            self.page.run_task(self.upload_attachment, file_path)
 
         self.message_input.value = ""
         self.selected_files.clear()
-        self.page.update()
+        self.renderer.request()
     
-    def display_message(self, message):
-        """Show received messages with correct sender attribution, formatting, and alignment."""
+    async def upload_attachment(self, file_path):
+        """Stream one attachment in chunks without holding up text chat."""
+        try:
+            stored_path = await self.ws_client.uploader.upload(file_path)
+            print(f"📎 Uploaded {file_path} -> {stored_path}")
+        except (AttachmentError, OSError, websockets.ConnectionClosed) as e:
+            print(f"🔥 Upload failed for {file_path}: {e}")
+
+    def on_history(self, rows):
+        """Add cached or synced rows, skipping what this session already shows; only the
+        ones that land in the rendered window are built."""
+        self.transcript.extend(
+            self.history_item(sender, message)
+            for row_id, sender, receiver, message, timestamp in rows
+            if row_id not in self.shown_ids
+            and not (sender == self.username and self.ws_client.history_synced))  # Shown when typed
+        self.refresh_media()
+        self.renderer.request()
+
+    def history_item(self, sender, message):
+        """Transcript item for a stored row; attachments keep their kind and content hash."""
+        attachment = parse_attachment_message(message)
+        if attachment is None:
+            return "Server" if sender == "server" else sender, message, "TEXT", None
+        kind, _, sha = attachment  # The stored path is on the server; the bytes are fetched into the local cache
+        return sender, self.ws_client.downloader.path_for(sha), kind, sha
+
+    def on_server_message(self, envelope):
+        """Render a CHAT envelope received from the server."""
+        if envelope.ack:
+            self.shown_ids.add(envelope.ack)
+        sender = "Server" if envelope.sender in ("", "server") else envelope.sender
+        self.display_message(envelope.text, sender=sender, kind=envelope.kind or "TEXT")
+
+    def display_message(self, text, sender=None, kind="TEXT"):
+        """Add a message to the transcript; it is rendered if the newest messages are on screen."""
+        row = self.transcript.append(sender, text, kind)
+        if row is not None and (self.previewed or kind in ("IMAGE", "AUDIO", "VIDEO")):
+            self.refresh_media()  # The new row may push an older preview off screen
+        self.renderer.request()
+
+    def build_row(self, sender, text, kind):
+        """Show a message with correct sender attribution, formatting, and alignment."""
     
         # Check for multimedia messages first
-        if message.startswith("IMAGE:"):
-            image_url = message[len("IMAGE:"):].strip()
-            img_control = ft.Image(src=image_url, width=300)
-            self.chat_box.content.controls.append(
-                ft.Row(
-                    controls=[img_control],
-                    alignment=ft.MainAxisAlignment.END
-                )
+        if kind in ("IMAGE", "AUDIO", "VIDEO"):
+            return ft.Row(
+                controls=[self.media_bubble(text, kind)],
+                alignment=ft.MainAxisAlignment.END,
+                data=kind
             )
-        elif message.startswith("AUDIO:"):
-            audio_url = message[len("AUDIO:"):].strip()
-            audio_control = ft.Audio(src=audio_url)
-            self.chat_box.content.controls.append(
-                ft.Row(
-                    controls=[audio_control],
-                    alignment=ft.MainAxisAlignment.END
-                )
+        elif sender is not None:
+            if sender == self.username:  # Sender is the current client
+                color = "blue"
+                alignment = ft.MainAxisAlignment.END  # Right-align own messages
+            else:
+                color = "green"
+                alignment = ft.MainAxisAlignment.START  # Left-align messages from others
+
+            return ft.Row(
+                controls=[ft.Text(f"{sender}: {text}", color=color)],
+                alignment=alignment
             )
-        elif message.startswith("VIDEO:"):
-            video_url = message[len("VIDEO:"):].strip()
-            video_control = ft.Video(src=video_url, width=400, height=300)
-            self.chat_box.content.controls.append(
-                ft.Row(
-                    controls=[video_control],
-                    alignment=ft.MainAxisAlignment.END
-                )
+        else:
+            # Messages without a sender are shown as server notices
+            return ft.Row(
+                controls=[ft.Text(f"Server: {text}", color="purple")],
+                alignment=ft.MainAxisAlignment.CENTER
             )
+
+    async def on_chat_scroll(self, e):
+        """Rebuild a page of rows at whichever edge was reached and track what is on screen."""
+        self.transcript.scrolled(e.pixels, e.min_scroll_extent, e.max_scroll_extent, e.viewport_dimension)
+        if e.pixels <= e.min_scroll_extent + 5:
+            changed = self.transcript.older()
+        elif e.pixels >= e.max_scroll_extent - 5:
+            changed = self.transcript.newer()
         else:
-            # Handle text messages formatted as "sender: message"
-            if ":" in message:
-                sender, text = message.split(":", 1)
-                sender = sender.strip()  # Clean sender name
-                text = text.strip()      # Clean message content
-
-                if sender == self.username:  # Sender is the current client
-                    color = "blue"
-                    alignment = ft.MainAxisAlignment.END  # Right-align own messages
-                else:
-                    color = "green"
-                    alignment = ft.MainAxisAlignment.START  # Left-align messages from others
-
-                self.chat_box.content.controls.append(
-                    ft.Row(
-                        controls=[ft.Text(f"{sender}: {text}", color=color)],
-                        alignment=alignment
-                    )
-                )
-            else:
-                # If the message doesn't match the expected format, display it as a server message
-                self.chat_box.content.controls.append(
-                    ft.Row(
-                        controls=[ft.Text(f"Server: {message}", color="purple")],
-                        alignment=ft.MainAxisAlignment.CENTER
-                    )
-                )        
-        self.page.update()
+            changed = 0
+        self.refresh_media()
+        if changed:
+            self.renderer.request()
+
+    def media_bubble(self, path, kind):
+        """A light placeholder; its preview is only loaded while the bubble is on screen."""
+        return ft.Container(
+            content=self.media_placeholder(path, kind),
+            padding=8,
+            border_radius=10,
+            bgcolor=ft.Colors.BLUE_50,
+            on_click=lambda e: self.page.run_task(self.open_media, path, kind),
+            data=path
+        )
+
+    def media_placeholder(self, path, kind):
+        icon = {"IMAGE": ft.Icons.IMAGE, "AUDIO": ft.Icons.AUDIOTRACK, "VIDEO": ft.Icons.MOVIE}[kind]
+        return ft.Row([ft.Icon(icon), ft.Text(os.path.basename(path))])
+
+    def refresh_media(self):
+        """Load previews for media rows on (or near) screen and drop them everywhere else,
+        so thumbnails, posters and waveforms only exist for what the customer can see."""
+        first, stop = self.transcript.on_screen()
+        shown = {}
+        for position, row in self.transcript.rendered():
+            if row.data is None:
+                continue  # Text row
+            bubble = row.controls[0]
+            if first <= position < stop:
+                shown[id(bubble)] = bubble
+                if id(bubble) not in self.previewed:
+                    bubble.content = ft.Row([bubble.content, ft.ProgressRing(width=14, height=14)])
+                    self.page.run_task(self.load_preview, bubble, bubble.data, row.data, position)
+            elif id(bubble) in self.previewed:
+                bubble.content = self.media_placeholder(bubble.data, row.data)
+                self.renderer.request()
+        self.previewed = shown  # Bubbles scrolled out of the window are released with their rows
+
+    async def local_media(self, path):
+        """A media file on this machine: attachments from history are downloaded on first use."""
+        downloader = self.ws_client.downloader
+        sha = os.path.basename(path)
+        if path == downloader.path_for(sha):
+            return await downloader.fetch(sha)
+        return path
+
+    async def load_preview(self, bubble, path, kind, position):
+        try:
+            path = await self.local_media(path)
+            sha = self.transcript.sha_at(position)
+            if sha is None:
+                sha = await asyncio.to_thread(file_sha256, path)
+                self.transcript.remember_sha(position, sha)
+            meta = await self.previewer.preview(path, kind, sha)
+        except Exception as e:
+            print(f"🔥 Preview failed for {path}: {e}")
+            meta = {}
+        if self.previewed.get(id(bubble)) is not bubble:
+            return  # Scrolled away while the preview was loading
+        icon = {"IMAGE": ft.Icons.IMAGE, "AUDIO": ft.Icons.PLAY_ARROW, "VIDEO": ft.Icons.PLAY_CIRCLE}[kind]
+        duration = meta.get("duration")
+        label = ft.Text(f"{int(duration) // 60}:{int(duration) % 60:02d}" if duration else os.path.basename(path),
+                        size=12)
+
+        if meta.get("thumbnail"):
+            bubble.content = ft.Image(src=meta["thumbnail"], width=meta["thumb_width"], height=meta["thumb_height"])
+        elif meta.get("poster"):
+            bubble.content = ft.Stack([ft.Image(src=meta["poster"], width=320),
+                                       ft.Row([ft.Icon(icon, color="white"), label])])
+        elif meta.get("waveform"):
+            bars = [ft.Container(width=3, height=max(2, 30 * peak), bgcolor=ft.Colors.BLUE_400, border_radius=1)
+                    for peak in meta["waveform"]]
+            bubble.content = ft.Row([ft.Icon(icon), ft.Row(bars, spacing=1), label])
+        else:
+            bubble.content = ft.Row([ft.Icon(icon), label])
+        self.renderer.request()
+
+    async def open_media(self, path, kind):
+        """Load the full asset only when the customer opens it."""
+        try:
+            path = os.path.abspath(await self.local_media(path))  # Relative sources would resolve against assets
+        except (AttachmentError, OSError) as e:
+            print(f"🔥 Could not fetch {os.path.basename(path)}: {e}")
+            return
+        on_dismiss = None
+        if kind == "IMAGE":
+            content = ft.Image(src=path, fit=ft.ImageFit.CONTAIN)
+        elif kind == "VIDEO":
+            content = ft.Video(playlist=[ft.VideoMedia(path)], width=640, height=360, autoplay=True)
+        else:
+            audio = ft.Audio(src=path, autoplay=True)
+            self.page.overlay.append(audio)
+            content = ft.Text(f"▶ {os.path.basename(path)}")
+            on_dismiss = lambda e: self.page.overlay.remove(audio)  # Stop playback with the dialog
+        self.page.open(ft.AlertDialog(content=content, title=ft.Text(os.path.basename(path)), on_dismiss=on_dismiss))
 
 if __name__ == "__main__":
     ft.app(target=ChatApp)
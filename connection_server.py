@@ -0,0 +1,590 @@
+import argparse
+import asyncio
+import calendar
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import time
+
+import websockets
+
+from attachments import ATTACHMENT_KINDS, CHUNK_SIZE, AttachmentError, AttachmentStore, attachment_message
+from chat_bus import create_bus
+from flow_control import OutboundQueue, TokenBucket
+from lifecycle import DrainController
+from metrics import (Histogram, LoopMonitor, MetricsRegistry, auth_metrics, connection_metrics, loop_metrics, queue_metrics,
+                     writer_metrics)
+from protocol import FLAG_COMPRESS_OK, FLAG_SYNC, Codec, Envelope, MessageType, ProtocolError, chat, pack_batch
+from message_store import ChatHistory, MessageWriter, chatDatabase
+from session_auth import SessionAuthenticator
+from sessions import SessionRegistry
+
+
+SERVICE_RESTART = 1012  # WebSocket close code sent while draining
+
+
+class ConnectionServer:
+    """Headless WebSocket tier: authenticates customers, persists their messages and routes
+    them over the bus so any agent dashboard (in this process or another) can reach them."""
+
+    def __init__(self, bus, message_writer=None, authenticator=None, attachments=None, node_id=None,
+                 heartbeat_interval=10.0, compression=True, ping_interval=20.0, ping_timeout=20.0,
+                 history_batch_size=500, outbound_queue_size=256, send_timeout=10.0, message_rate=10.0,
+                 message_burst=30, byte_rate=1024 * 1024, byte_burst=4 * 1024 * 1024, idle_timeout=None):
+        self.bus = bus
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.message_writer = message_writer or MessageWriter()
+        self.authenticator = authenticator or SessionAuthenticator()
+        self.attachments = attachments or AttachmentStore()
+        self.history = ChatHistory(self.message_writer.db_path, page_size=history_batch_size)
+        self.heartbeat_interval = heartbeat_interval
+        self.compression = compression  # Offer zlib bodies to clients that ask for them
+        self.ping_interval = ping_interval  # Dead client links are dropped after interval + timeout
+        self.ping_timeout = ping_timeout
+        self.outbound_queue_size = outbound_queue_size
+        self.send_timeout = send_timeout  # Longer than this to queue or write a frame = slow consumer
+        # 🚦 Per-connection inbound limits: chat messages/s (None disables) and bytes/s
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.idle_timeout = idle_timeout  # Close sessions that sent nothing for this long (None: never)
+        self.sessions = SessionRegistry()  # Authenticated sockets owned by this worker only
+        self.servers = []  # One websockets server per listening socket
+        self.draining = False
+        self.heartbeat_task = None
+        self.stats = {"connections": 0, "protocol_errors": 0, "inbound": 0, "outbound": 0, "history_rows": 0,
+                      "throttled": 0, "throttled_seconds": 0.0, "outbound_dropped": 0,
+                      "slow_disconnects": 0, "idle_disconnects": 0, "broadcasts": 0, "broadcast_frames": 0,
+                      "broadcast_deferred": 0}
+        self.fanout_ms = Histogram()  # Per broadcast: event received to frame queued on every local socket
+
+    async def start(self, host="localhost", port=8765, reuse_port=False, sockets=None):
+        """Start serving; reuse_port lets several worker processes share one listening port.
+
+        sockets, if given, are already-listening sockets taken over from a process being
+        replaced (see lifecycle.DrainController); they are served instead of binding.
+        """
+        self.message_writer.start()
+        await self.authenticator.load()
+        await self.bus.start()
+        self.bus.subscribe(f"deliver:{self.node_id}", self.deliver)
+        self.bus.subscribe("broadcast", self.deliver_broadcast)
+        options = {"ping_interval": self.ping_interval, "ping_timeout": self.ping_timeout}
+        if sockets:
+            self.servers = [await websockets.serve(self.handle_connection, sock=sock, **options) for sock in sockets]
+        else:
+            self.servers = [await websockets.serve(self.handle_connection, host, port, reuse_port=reuse_port,
+                                                   **options)]
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
+        addresses = ", ".join(f"{sock.getsockname()[0]}:{sock.getsockname()[1]}" for sock in self.listening_sockets)
+        print(f"🟢 Worker {self.node_id} listening on {addresses}")
+        return self.servers
+
+    @property
+    def listening_sockets(self):
+        return [sock for server in self.servers for sock in server.sockets]
+
+    async def wait_closed(self):
+        """Wait until listening has stopped and every connection handler has returned."""
+        for server in self.servers:
+            await server.wait_closed()
+
+    async def serve_forever(self, host="localhost", port=8765, reuse_port=False, sockets=None):
+        await self.start(host, port, reuse_port, sockets)
+        try:
+            await self.wait_closed()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Stop listening, clear presence and flush pending writes and bus events."""
+        for server in self.servers:
+            server.close()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        for username in list(self.sessions.users()):
+            await self.bus.clear_presence(username, self.node_id)
+        await self.message_writer.close()
+        await self.bus.close()
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.bus.touch_presence(self.node_id)
+            except Exception as e:
+                print("🔥 Presence heartbeat failed:", e)
+            if self.idle_timeout:
+                for session in self.sessions.idle(self.idle_timeout):
+                    self.stats["idle_disconnects"] += 1
+                    print(f"💤 Closing idle connection {session.conn_id} of {session.username}")
+                    self.sessions.touch(session)  # Not picked again while the close handshake runs
+                    asyncio.ensure_future(session.websocket.close(1001, "idle"))
+
+    async def handle_connection(self, websocket):
+        """Handles incoming WebSocket connections and authenticates clients before allowing access."""
+        username = None
+        session = None
+        codec = Codec()
+        outbound = OutboundQueue(websocket, self.outbound_queue_size, self.send_timeout,
+                                 on_slow=lambda reason: self.on_slow_consumer(username, outbound, reason))
+        messages = TokenBucket(self.message_rate, self.message_burst) if self.message_rate else None
+        volume = TokenBucket(self.byte_rate, self.byte_burst) if self.byte_rate else None
+        self.stats["connections"] += 1
+        try:
+            if self.draining:
+                await websocket.close(SERVICE_RESTART, "server restarting")
+                return
+            hello = codec.decode(await websocket.recv())
+            if hello.type != MessageType.HELLO:
+                raise ProtocolError(f"expected HELLO, got {hello.type.name}")
+
+            # ✅ Extract username and session token
+            username, session_token = hello.sender, hello.text
+
+            # 🔹 Validate session token
+            if not await self.authenticator.authenticate(username, session_token):
+                await outbound.put(codec.encode(Envelope(MessageType.AUTH_FAILED)))
+                await outbound.flush()
+                await websocket.close()
+                return  # Stop processing
+            if self.draining:
+                await websocket.close(SERVICE_RESTART, "server restarting")
+                return
+
+            # ✅ Authentication successful: register this socket next to any others the user has
+            # open, and announce the user on the bus when it is their first one on this worker
+            first = not self.sessions.is_online(username)
+            session = self.sessions.open(username, node=self.node_id, websocket=websocket, codec=codec,
+                                         outbound=outbound)
+            if first:
+                await self.bus.set_presence(username, self.node_id)
+            print(f"🟢 Authenticated and connected: {username} (connection {session.conn_id})")
+
+            # 🔹 Notify client that authentication succeeded, agreeing to compression if offered
+            codec.compress = self.compression and bool(hello.flags & FLAG_COMPRESS_OK)
+            await self.send(session, Envelope(MessageType.AUTH_OK, flags=FLAG_COMPRESS_OK if codec.compress else 0))
+            if first:
+                await self.bus.publish("presence", {"username": username, "node": self.node_id, "online": True})
+
+            # 📜 Catch a caching client up on stored history first, so queued replies it
+            # receives next can be recognised as already synced
+            if hello.flags & FLAG_SYNC:
+                await self.send_history(session, hello.id)
+
+            # 📬 Resume after the last reply the client acknowledged (its ACK may have been lost
+            # with the old link), then replay the rest; they stay queued until acked
+            session.sent_seq = hello.ack
+            await self.ack_outbox(session, hello.ack)
+            await self.flush_session(session)
+
+            # 📡 Handle incoming messages
+            async for frame in websocket:
+                self.sessions.touch(session)
+                try:
+                    envelope = codec.decode(frame)
+                except ProtocolError as e:
+                    self.stats["protocol_errors"] += 1
+                    print(f"❌ Malformed message received ({e}), ignoring...")
+                    continue
+                # 🚦 Pausing here stops reading the socket, which pushes back on the client over TCP
+                await self.throttle(envelope, len(frame), messages, volume)
+
+                if envelope.type == MessageType.CHAT:
+                    # Store the message, then hand it to the agents once it is committed.
+                    # The authenticated username is the sender, whatever the frame claims.
+                    self.stats["inbound"] += 1
+                    await self.store_inbound(username, envelope.receiver or "server", envelope.text)
+                elif envelope.type == MessageType.ACK:
+                    await self.ack_outbox(session, envelope.ack)
+                # 📎 Attachment chunks are interleaved with ordinary chat frames
+                elif envelope.type == MessageType.FILE_CHUNK:
+                    await self.receive_chunk(session, envelope)
+                elif envelope.type == MessageType.FILE_BEGIN:
+                    await self.begin_upload(session, envelope)
+                elif envelope.type == MessageType.FILE_GET:
+                    asyncio.ensure_future(self.send_attachment(session, envelope))  # Chat keeps flowing meanwhile
+                else:
+                    print(f"❌ Unexpected {envelope.type.name} from {username}, ignoring...")
+
+        except websockets.ConnectionClosed:
+            print("⚠️ Connection closed for", username)
+
+        except Exception as e:
+            print(f"🔥 Unexpected server error: {e}")
+
+        finally:
+            outbound.stop()
+            # Only this socket's session goes; the user's other tabs keep theirs
+            if session is not None and self.sessions.close(session.conn_id):
+                self.attachments.discard(username, session.conn_id)  # Resumable from the user's next connection
+                if not self.sessions.is_online(username):
+                    await self.bus.clear_presence(username, self.node_id)
+                    await self.bus.publish("presence", {"username": username, "node": self.node_id, "online": False})
+
+    async def send(self, session, envelope, compress=None):
+        """Encode with the session's negotiated codec and queue for its writer task.
+
+        Returns False if the connection is gone or was dropped as a slow consumer.
+        """
+        return await session.outbound.put(session.codec.encode(envelope, compress))
+
+    async def throttle(self, envelope, size, messages, volume):
+        """Wait until the inbound token buckets admit one frame.
+
+        Every frame is charged its size in bytes; chat messages and upload starts (each a
+        database write) also take a message token. While this waits the socket is not read,
+        so a client over its limit is slowed down by TCP rather than buffered here.
+        """
+        delay = volume.reserve(size) if volume is not None else 0.0
+        if messages is not None and envelope.type in (MessageType.CHAT, MessageType.FILE_BEGIN):
+            delay = max(delay, messages.reserve(1))
+        if delay:
+            self.stats["throttled"] += 1
+            self.stats["throttled_seconds"] += delay
+            await asyncio.sleep(delay)
+
+    async def drain(self, reconnect_window=10.0, timeout=30.0):
+        """Stop accepting and hand every client over to whichever process serves the port next.
+
+        Each client gets a RECONNECT with its own delay spread evenly over reconnect_window,
+        so they do not all come back at once; a client whose send queue is full is waited on
+        for up to timeout rather than skipped. Send queues are given up to timeout to empty,
+        sockets are closed with 1012 and pending message inserts are committed. Replies the
+        client has not acked stay in the durable outbox and are replayed after it reconnects.
+        Returns the time each phase took.
+        """
+        started = time.perf_counter()
+        self.draining = True
+        report = {"clients": len(self.sessions), "queued_frames": self.outbound_depth,
+                  "pending_writes": self.message_writer.queue_depth}
+        for server in self.servers:
+            server.close(close_connections=False)
+
+        sessions = list(self.sessions.by_conn.values())
+        random.shuffle(sessions)
+        notices = []
+        for index, session in enumerate(sessions):
+            delay = reconnect_window * (index + random.random()) / len(sessions)
+            notices.append(session.outbound.put(session.codec.encode(Envelope(MessageType.RECONNECT, id=int(delay * 1000)))))
+        # 🔹 Wait for room behind a full queue too, so a busy client still learns when to come back
+        try:
+            queued = await asyncio.wait_for(asyncio.gather(*notices), timeout)
+        except asyncio.TimeoutError:
+            queued = []
+        report["unnotified"] = len(sessions) - sum(1 for ok in queued if ok)
+        phase = time.perf_counter()
+        report["notify_s"] = phase - started
+
+        await asyncio.gather(*(session.outbound.flush(timeout) for session in sessions))
+        report["flush_s"] = time.perf_counter() - phase
+        phase = time.perf_counter()
+
+        sockets = [websocket for server in self.servers for websocket in server.connections]  # Also any mid-HELLO
+        try:
+            await asyncio.wait_for(asyncio.gather(
+                *(websocket.close(SERVICE_RESTART, "server restarting") for websocket in sockets),
+                return_exceptions=True), timeout)
+        except asyncio.TimeoutError:
+            for websocket in sockets:
+                websocket.transport.abort()
+        await self.wait_closed()
+        report["close_s"] = time.perf_counter() - phase
+        phase = time.perf_counter()
+
+        await self.message_writer.close()
+        report["db_flush_s"] = time.perf_counter() - phase
+        report["total_s"] = time.perf_counter() - started
+        print(f"🚰 Drained {report['clients']} clients in {report['total_s']:.2f}s "
+              f"(notify {report['notify_s'] * 1000:.0f} ms, {report['unnotified']} not notified, flush {report['flush_s']:.2f}s, "
+              f"close {report['close_s']:.2f}s, {report['pending_writes']} pending writes "
+              f"committed in {report['db_flush_s'] * 1000:.0f} ms)")
+        return report
+
+    def on_slow_consumer(self, username, outbound, reason):
+        self.stats["slow_disconnects"] += 1
+        self.stats["outbound_dropped"] += outbound.queue.qsize()
+        print(f"🐌 Disconnecting slow consumer {username}: {reason}")
+
+    @property
+    def outbound_depth(self):
+        return sum(session.outbound.queue.qsize() for session in self.sessions.by_conn.values())
+
+    async def store_inbound(self, sender, receiver, message_text):
+        row_id = await self.message_writer.submit(sender, receiver, message_text)
+        event = {"sender": sender, "receiver": receiver, "text": message_text}
+        row_id.add_done_callback(lambda future: self.publish_inbound(event, future))
+
+    async def send_history(self, session, after_id):
+        """Stream the client's stored messages newer than after_id, oldest first, in batches."""
+        while True:
+            last_id, count, body = await asyncio.to_thread(self.history_batch, session.username, after_id)
+            if not count:
+                break
+            if not await self.send(session, Envelope(MessageType.HISTORY, id=last_id, body=body)):
+                return
+            self.stats["history_rows"] += count
+            after_id = last_id
+            if count < self.history.page_size:
+                break
+        await self.send(session, Envelope(MessageType.HISTORY_END, id=after_id))
+
+    def history_batch(self, username, after_id):
+        """One keyset page after after_id, packed for a HISTORY frame (runs in a worker thread)."""
+        rows = self.history.fetch_page(username, after_id=after_id)
+        envelopes = [Envelope(MessageType.CHAT, id=row_id, timestamp=stored_time(timestamp), sender=sender,
+                              receiver=receiver, body=message)
+                     for row_id, sender, receiver, message, timestamp in rows]
+        return (rows[-1][0] if rows else after_id), len(rows), pack_batch(envelopes)
+
+    async def begin_upload(self, session, envelope):
+        """Reply with the byte range to send: the rest of the file, or a proof range when the
+        content is already stored."""
+        username, sha = session.username, envelope.key
+        try:
+            start, stop = await self.attachments.begin(username, sha, envelope.id, envelope.kind, envelope.text,
+                                                       session.conn_id)
+        except AttachmentError as e:
+            await self.send(session, Envelope(MessageType.FILE_ERROR, key=sha, body=str(e)))
+            return
+        await self.send(session, Envelope(MessageType.FILE_OFFSET, id=start, ack=stop, key=sha))
+
+    async def receive_chunk(self, session, envelope):
+        """Write one chunk off the loop, ack it, and store the file once the last byte is in."""
+        username, sha = session.username, envelope.key
+        try:
+            received = await self.attachments.write_chunk(username, sha, envelope.id, envelope.body, session.conn_id)
+            await self.send(session, Envelope(MessageType.FILE_ACK, id=received, key=sha))
+            if self.attachments.is_complete(username, sha):
+                upload = await self.attachments.finish(username, sha)
+                await self.announce_attachment(session, sha, upload["kind"], upload["path"])
+        except AttachmentError as e:
+            self.attachments.cancel(username, sha, session.conn_id)
+            await self.send(session, Envelope(MessageType.FILE_ERROR, key=sha, body=str(e)))
+
+    async def send_attachment(self, session, envelope):
+        """Stream a stored attachment of the user's own conversation from the requested offset."""
+        username, sha, offset = session.username, envelope.key, envelope.id
+        path = self.attachments.path_for(sha)
+        texts = [attachment_message(kind, path) for kind in ATTACHMENT_KINDS]
+        try:
+            if not await asyncio.to_thread(self.history.has_sent, username, texts):
+                raise AttachmentError("unknown attachment")
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if not 0 <= offset < size:
+                    raise AttachmentError(f"unexpected offset {offset}")
+                f.seek(offset)
+                while offset < size:
+                    data = await asyncio.to_thread(f.read, CHUNK_SIZE)
+                    # The connection's bounded send queue paces the reads to the client
+                    if not await self.send(session, Envelope(MessageType.FILE_DATA, id=offset, ack=size, key=sha,
+                                                             body=data), compress=False):  # Media: already compressed
+                        return  # Disconnected: the client resumes from its part file
+                    offset += len(data)
+        except (AttachmentError, OSError) as e:
+            await self.send(session, Envelope(MessageType.FILE_ERROR, key=sha, body=str(e)))
+
+    async def announce_attachment(self, session, sha, kind, path):
+        await self.store_inbound(session.username, "server", attachment_message(kind, path))
+        await self.send(session, Envelope(MessageType.FILE_DONE, key=sha, body=path))
+        print(f"📎 Stored {kind.lower()} from {session.username}: {path}")
+
+    def publish_inbound(self, event, future):
+        event["id"] = future.result()
+        asyncio.ensure_future(self.announce_inbound(event))
+
+    async def announce_inbound(self, event):
+        """Queue the message as unread for the agents (once, however many dashboards are
+        open), then tell them about it."""
+        await self.bus.enqueue(f"unread:{event['sender']}",
+                               {"text": f"{event['sender']}: {event['text']}", "id": event["id"]})
+        await self.bus.publish("inbox", event)
+
+    async def deliver(self, event):
+        """An agent queued a reply for a client held by this worker."""
+        await self.flush_outbox(event["receiver"])
+
+    async def deliver_broadcast(self, event):
+        """Fan a stored broadcast out to every recipient connected to this worker.
+
+        The frame is encoded once per codec setting and the same bytes are queued for each
+        socket, whose writer task sends it independently. Sockets with a full queue are
+        waited on in a background task, so a slow recipient holds up nobody but itself.
+        Broadcasts are not queued in the outbox: a recipient that misses one gets it from
+        the history sync when it reconnects.
+        """
+        started = time.perf_counter()
+        envelope = chat("server", event["receiver"], event["text"], ack=event["id"])
+        recipients = event["recipients"]
+        if len(recipients) > len(self.sessions.users()):
+            names = set(recipients)
+            recipients = [name for name in self.sessions.users() if name in names]
+        sockets = [session for name in recipients for session in self.sessions.for_user(name)]
+
+        frames = {}  # codec.compress -> encoded frame
+        deferred = []
+        for session in sockets:
+            frame = frames.get(session.codec.compress)
+            if frame is None:
+                frame = frames[session.codec.compress] = session.codec.encode(envelope)
+            if not session.outbound.offer(frame):
+                deferred.append(session.outbound.put(frame))
+        if deferred:
+            asyncio.ensure_future(asyncio.gather(*deferred))
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.fanout_ms.observe(elapsed_ms)
+        self.stats["broadcasts"] += 1
+        self.stats["broadcast_frames"] += len(sockets)
+        self.stats["broadcast_deferred"] += len(deferred)
+        if sockets:
+            print(f"📢 Broadcast {event['id']} queued for {len(sockets)} sockets in {elapsed_ms:.1f} ms"
+                  f"{f' ({len(deferred)} waiting on full queues)' if deferred else ''}")
+
+    async def flush_outbox(self, username):
+        """Bring every socket the user has on this worker up to date with their outbox."""
+        await asyncio.gather(*(self.flush_session(session) for session in self.sessions.for_user(username)))
+
+    async def flush_session(self, session):
+        """Send every queued reply the socket has not seen yet, in order, tagged with its seq."""
+        if session.lock is None:
+            session.lock = asyncio.Lock()
+        async with session.lock:
+            while self.sessions.get(session.conn_id) is session:  # Stays queued once the socket is gone
+                pending = await self.bus.pending(f"outbox:{session.username}", after_seq=session.sent_seq)
+                if not pending:
+                    break
+                for seq, item in pending:
+                    if not await self.send(session, chat("server", session.username, item["text"], id=seq,
+                                                         ack=item.get("id", 0))):
+                        return  # Dropped as a slow consumer; replayed from the outbox on reconnect
+                    session.sent_seq = seq
+                    self.stats["outbound"] += 1
+
+    async def ack_outbox(self, session, seq):
+        """Record a socket's ack; replies leave the outbox once every socket of the user on
+        this worker has acked them."""
+        session.acked_seq = max(session.acked_seq, seq)
+        upto = min(other.acked_seq for other in self.sessions.for_user(session.username))
+        if upto:
+            await self.bus.ack(f"outbox:{session.username}", upto)
+
+
+def stored_time(timestamp):
+    """Messages.timestamp ('YYYY-MM-DD HH:MM:SS', UTC) as epoch seconds."""
+    try:
+        return float(calendar.timegm(time.strptime(timestamp, "%Y-%m-%d %H:%M:%S")))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def server_metrics(server, monitor):
+    """Registry covering everything a connection worker runs."""
+    registry = MetricsRegistry()
+    for source in (connection_metrics(server), auth_metrics(server.authenticator),
+                   writer_metrics(server.message_writer), queue_metrics(server.bus), loop_metrics(monitor)):
+        registry.register(source)
+    return registry
+
+
+async def serve_worker(server, host, port, reuse_port, metrics_port, metrics_log_interval, lifecycle=None):
+    monitor = LoopMonitor()
+    registry = server_metrics(server, monitor)
+    controller = DrainController(server, **(lifecycle or {}))
+    controller.install_signal_handlers()
+    monitor.start()
+    await registry.start(port=metrics_port, log_interval=metrics_log_interval)
+    try:
+        sockets = await controller.take_over()
+        await server.start(host, port, reuse_port, sockets)
+        await controller.started()
+        await server.wait_closed()
+        if controller.drain_task is not None:
+            await controller.drain_task
+    finally:
+        monitor.stop()
+        await registry.close()
+        await server.close()
+
+
+def run_worker(host, port, bus_kind, reuse_port, metrics_port=0, metrics_log_interval=0.0, limits=None,
+               lifecycle=None):
+    server = ConnectionServer(create_bus(bus_kind), **(limits or {}))
+    try:
+        asyncio.run(serve_worker(server, host, port, reuse_port, metrics_port, metrics_log_interval, lifecycle))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the WebSocket connection tier without the admin UI.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--bus", default="sqlite", choices=["memory", "sqlite"],
+                        help="memory only works with a single worker and no external dashboard")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics from this port (worker i uses port + i); 0 disables")
+    parser.add_argument("--metrics-log-interval", type=float, default=0.0,
+                        help="seconds between JSON metrics log lines; 0 disables")
+    parser.add_argument("--message-rate", type=float, default=10.0,
+                        help="chat messages per second accepted from one connection; 0 disables")
+    parser.add_argument("--message-burst", type=int, default=30, help="messages a client may send back to back")
+    parser.add_argument("--send-timeout", type=float, default=10.0,
+                        help="seconds a client may fall behind on reading before it is disconnected")
+    parser.add_argument("--idle-timeout", type=float, default=0.0,
+                        help="close connections whose client sends no frames (chat, acks, uploads) for this "
+                             "many seconds; 0 keeps them")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="bind with SO_REUSEPORT even with one worker, so a replacement can bind alongside")
+    parser.add_argument("--handoff",
+                        help="control socket path: take over the listening sockets of the process serving it, "
+                             "then serve it for the next one (worker i uses PATH.i)")
+    parser.add_argument("--reconnect-window", type=float, default=10.0,
+                        help="on SIGTERM, clients are told to reconnect spread over this many seconds")
+    parser.add_argument("--drain-timeout", type=float, default=30.0,
+                        help="seconds a drain waits for send queues to empty and sockets to close")
+    args = parser.parse_args()
+    limits = {"message_rate": args.message_rate or None, "message_burst": args.message_burst,
+              "send_timeout": args.send_timeout, "idle_timeout": args.idle_timeout or None}
+
+    def lifecycle(index):
+        handoff = args.handoff and (f"{args.handoff}.{index}" if args.workers > 1 else args.handoff)
+        return {"reconnect_window": args.reconnect_window, "drain_timeout": args.drain_timeout,
+                "handoff_path": handoff}
+
+    chatDatabase()
+    if args.workers == 1:
+        run_worker(args.host, args.port, args.bus, args.reuse_port, args.metrics_port, args.metrics_log_interval,
+                   limits, lifecycle(0))
+        return
+
+    # 🔹 Every worker binds the same port with SO_REUSEPORT; the kernel spreads new sockets
+    workers = [
+        multiprocessing.Process(target=run_worker, daemon=True,
+                                args=(args.host, args.port, args.bus, True,
+                                      args.metrics_port + index if args.metrics_port else 0, args.metrics_log_interval,
+                                      limits, lifecycle(index)))
+        for index in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # 🔹 Each worker drains on its own signal; the parent passes its signals on and waits
+    def forward(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, forward)
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()
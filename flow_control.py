@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+import websockets
+
+SLOW_CONSUMER = 1013  # WebSocket close code "try again later"; the client reconnects and resumes
+
+
+class TokenBucket:
+    """Refills rate tokens per second up to burst; each admitted event takes cost tokens."""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def reserve(self, cost=1.0):
+        """Take cost tokens and return how many seconds to wait before acting on them.
+
+        The balance may go negative, so events that follow queue up behind one that waits.
+        """
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= cost
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class OutboundQueue:
+    """Bounded send queue for one connection, drained by its own writer task.
+
+    Producers (reply delivery, acks, history batches) only wait for room in the queue,
+    never for the socket. A frame that cannot be queued within send_timeout, or a single
+    send that takes longer than that, marks the client as a slow consumer: it is
+    disconnected and on_slow(reason) is called. Replies stay in the offline queue until
+    acked, so the client gets them again when it reconnects.
+    """
+
+    def __init__(self, websocket, maxsize=256, send_timeout=10.0, on_slow=None):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize)
+        self.send_timeout = send_timeout
+        self.on_slow = on_slow
+        self.closed = False
+        self.task = asyncio.create_task(self._drain())
+
+    async def put(self, frame):
+        """Queue one encoded frame; returns False if it was dropped."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(frame), self.send_timeout)
+            except asyncio.TimeoutError:
+                self.disconnect(f"send queue full for {self.send_timeout:.0f}s")
+                return False
+        return True
+
+    def offer(self, frame):
+        """Queue a frame only if there is room right now; returns whether it was queued."""
+        if self.closed or self.queue.full():
+            return False
+        self.queue.put_nowait(frame)
+        return True
+
+    async def flush(self, timeout=None):
+        """Wait until everything queued so far has been written to the socket."""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout or self.send_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        self.closed = True
+        self.task.cancel()
+
+    def disconnect(self, reason):
+        if self.closed:
+            return
+        self.closed = True
+        if self.on_slow is not None:
+            self.on_slow(reason)
+        asyncio.ensure_future(self._close())
+
+    async def _close(self):
+        # The close frame has to get past the same full buffer, so do not wait on it for long
+        try:
+            await asyncio.wait_for(self.websocket.close(SLOW_CONSUMER, "slow consumer"), self.send_timeout)
+        except asyncio.TimeoutError:
+            self.websocket.transport.abort()
+
+    async def _drain(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                try:
+                    await asyncio.wait_for(self.websocket.send(frame), self.send_timeout)
+                finally:
+                    self.queue.task_done()
+        except asyncio.TimeoutError:
+            self.disconnect(f"send blocked for {self.send_timeout:.0f}s")
+        except websockets.ConnectionClosed:
+            self.closed = True
@@ -0,0 +1,60 @@
+import asyncio
+import sqlite3
+
+
+class HistoryCache:
+    """The customer's own copy of their conversation, so the app opens with history shown
+    and a reconnect only asks the server for messages newer than the last cached id."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS CachedMessages (
+                    id INTEGER PRIMARY KEY,
+                    sender TEXT NOT NULL,
+                    receiver TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    timestamp REAL NOT NULL
+                )
+            ''')
+        conn.close()
+
+    def fetch_last_id(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('SELECT COALESCE(MAX(id), 0) FROM CachedMessages').fetchone()[0]
+        finally:
+            conn.close()
+
+    def fetch_recent(self, limit):
+        """The newest limit rows as (id, sender, receiver, message, timestamp), oldest first."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            rows = conn.execute('''
+                SELECT id, sender, receiver, message, timestamp FROM CachedMessages ORDER BY id DESC LIMIT ?
+            ''', (limit,)).fetchall()
+        finally:
+            conn.close()
+        rows.reverse()
+        return rows
+
+    def save(self, rows):
+        """Store one synced batch in a single transaction; rows already cached are kept as they are."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO CachedMessages VALUES (?, ?, ?, ?, ?)', rows)
+        finally:
+            conn.close()
+
+    # 🔹 The same calls in a worker thread, so the UI loop never waits on SQLite
+    async def load_last_id(self):
+        return await asyncio.to_thread(self.fetch_last_id)
+
+    async def load_recent(self, limit):
+        return await asyncio.to_thread(self.fetch_recent, limit)
+
+    async def store(self, rows):
+        await asyncio.to_thread(self.save, rows)
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import signal
+import socket
+
+DRAIN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+HANDOFF_TIMEOUT = 30.0  # Seconds either side waits on the other during a takeover
+
+
+class DrainController:
+    """Drains a ConnectionServer on SIGTERM/SIGINT and hands its listening sockets over
+    to a replacement process.
+
+    Zero-downtime restart with a handoff path: start the new process with the same path.
+    It connects to the old process's control socket there, receives the listening sockets
+    (SCM_RIGHTS), starts accepting on them and answers "ready"; the old process then
+    releases the path and drains. The listening socket stays open throughout, so no
+    connection attempt is refused or lost from the accept queue. Without a handoff path,
+    start the new process with SO_REUSEPORT on the same port and send the old one SIGTERM.
+    """
+
+    def __init__(self, server, reconnect_window=10.0, drain_timeout=30.0, handoff_path=None):
+        self.server = server
+        self.reconnect_window = reconnect_window  # Clients come back spread over this many seconds
+        self.drain_timeout = drain_timeout
+        self.handoff_path = handoff_path
+        self.drain_task = None
+        self.report = None
+        self.predecessor = None  # Control connection to the process we took over from
+        self.handoff_task = None
+
+    def install_signal_handlers(self):
+        """Drain on SIGTERM/SIGINT; returns False where the loop cannot take signals."""
+        loop = asyncio.get_running_loop()
+        try:
+            for sig in DRAIN_SIGNALS:
+                loop.add_signal_handler(sig, self.request_drain, sig.name)
+        except (NotImplementedError, RuntimeError):
+            return False  # Windows, or not the main thread
+        return True
+
+    def restore_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in DRAIN_SIGNALS:
+            loop.remove_signal_handler(sig)
+
+    def request_drain(self, reason):
+        if self.drain_task is not None:
+            print(f"⏳ Already draining, ignoring {reason}")
+            return
+        print(f"🚰 Draining {self.server.node_id} ({reason})")
+        if self.handoff_task is not None:
+            self.handoff_task.cancel()
+        self.drain_task = asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        self.report = await self.server.drain(self.reconnect_window, self.drain_timeout)
+
+    # 🔹 Takeover, new process side
+
+    async def take_over(self):
+        """Adopt the listening sockets of the process serving handoff_path; [] if there is none."""
+        if self.handoff_path is None:
+            return []
+        control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        control.settimeout(HANDOFF_TIMEOUT)
+        try:
+            await asyncio.to_thread(control.connect, self.handoff_path)
+            _, fds, _, _ = await asyncio.to_thread(socket.recv_fds, control, 64, 16)
+        except (FileNotFoundError, ConnectionRefusedError):
+            control.close()
+            return []  # First start, or a stale path left by a crash
+        except OSError:
+            control.close()
+            raise
+        self.predecessor = control
+        print(f"🤝 Took over {len(fds)} listening socket(s) from {self.handoff_path}")
+        return [socket.socket(fileno=fd) for fd in fds]
+
+    async def started(self):
+        """Call once serving: lets the predecessor drain, then waits for our own successor."""
+        if self.predecessor is not None:
+            control, self.predecessor = self.predecessor, None
+            try:
+                await asyncio.to_thread(control.sendall, b"ready")
+                await asyncio.to_thread(control.recv, 16)  # "released": the old process left the path
+            except OSError as e:
+                print(f"⚠️ Predecessor went away during takeover: {e}")
+            finally:
+                control.close()
+        if self.handoff_path is not None:
+            self.handoff_task = asyncio.create_task(self.serve_handoff())
+
+    # 🔹 Takeover, old process side
+
+    async def serve_handoff(self):
+        """Wait for a successor on handoff_path, give it our listening sockets, then drain."""
+        if os.path.exists(self.handoff_path):
+            os.unlink(self.handoff_path)  # Left by a process that crashed without releasing it
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.handoff_path)
+        listener.listen(1)
+        listener.setblocking(False)
+        loop = asyncio.get_running_loop()
+        released = False
+        try:
+            while True:
+                control, _ = await loop.sock_accept(listener)
+                with control:
+                    control.setblocking(True)
+                    control.settimeout(HANDOFF_TIMEOUT)
+                    try:
+                        fds = [sock.fileno() for sock in self.server.listening_sockets]
+                        await asyncio.to_thread(socket.send_fds, control, [b"listeners"], fds)
+                        ready = await asyncio.to_thread(control.recv, 16)
+                    except OSError as e:
+                        print(f"⚠️ Takeover attempt failed: {e}")
+                        continue
+                    if ready != b"ready":
+                        continue  # The successor died before serving; keep ours
+                    listener.close()
+                    os.unlink(self.handoff_path)
+                    released = True
+                    control.sendall(b"released")
+                    self.handoff_task = None
+                    self.request_drain("handed off to successor")
+                    return
+        finally:
+            listener.close()
+            if not released and os.path.exists(self.handoff_path):
+                os.unlink(self.handoff_path)  # Draining for another reason: nothing left to take over
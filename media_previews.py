@@ -0,0 +1,191 @@
+import array
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+from attachments import file_sha256
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Thumbnails need Pillow; without it image bubbles show an icon instead
+    Image = None
+
+PREVIEW_ROOT = 'previews'
+PREVIEW_KINDS = ("IMAGE", "AUDIO", "VIDEO")
+PREVIEW_VERSION = 2  # Bump to rebuild cached previews after changing how they are made
+THUMBNAIL_SIZE = (320, 320)
+WAVEFORM_BARS = 48
+SAMPLES_PER_BAR = 2000  # Peaks are taken from at most this many samples per bar
+MAX_CACHED = 1000  # Metadata entries kept in memory; the rest are re-read from disk
+FFMPEG_TIMEOUT = 30
+
+
+# 🔹 Builders (run in worker processes, so they must stay importable top-level functions)
+
+def build_preview(path, sha, kind, root=PREVIEW_ROOT):
+    """Derive the preview for one file and cache its metadata as <root>/<sha[:2]>/<sha>.json.
+
+    Images get a JPEG thumbnail, videos a poster frame and duration, audio a duration and
+    WAVEFORM_BARS peak heights in 0..1. Anything that cannot be derived (missing Pillow or
+    ffmpeg, a missing or corrupt file) is left out, with the reason under "error", and the bubble falls
+    back to an icon; such partial results are not cached on disk.
+    """
+    base = os.path.join(root, sha[:2], sha)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    meta = {"version": PREVIEW_VERSION, "kind": kind, "name": os.path.basename(path)}
+    try:
+        meta["size"] = os.path.getsize(path)  # Missing file: falls back to the icon like any other failure
+        if kind == "IMAGE":
+            meta.update(_image_thumbnail(path, base + "-thumb.jpg"))
+        elif kind == "VIDEO":
+            meta.update(_video_poster(path, base + "-poster.jpg"))
+        elif kind == "AUDIO":
+            meta.update(_audio_waveform(path))
+    except Exception as e:
+        meta["error"] = f"{type(e).__name__}: {e}"
+
+    if "error" not in meta:  # Retried next time, e.g. after Pillow or ffmpeg gets installed
+        with open(base + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(base + ".json.tmp", base + ".json")
+    return meta
+
+
+def _image_thumbnail(path, out):
+    if Image is None:
+        return {"error": "Pillow not installed"}
+    with Image.open(path) as image:
+        width, height = image.size
+        image.draft("RGB", THUMBNAIL_SIZE)  # JPEG: decode at 1/2..1/8 scale instead of full size
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(THUMBNAIL_SIZE)
+        image.convert("RGB").save(out, "JPEG", quality=80, optimize=True)
+        return {"thumbnail": out, "width": width, "height": height,
+                "thumb_width": image.width, "thumb_height": image.height}
+
+
+def _video_poster(path, out):
+    ffmpeg, ffprobe = shutil.which("ffmpeg"), shutil.which("ffprobe")
+    if ffmpeg is None or ffprobe is None:
+        return {"error": "ffmpeg not installed"}
+    duration = _probe_duration(ffprobe, path)
+    subprocess.run([ffmpeg, "-v", "error", "-ss", f"{min(1.0, duration / 2):.2f}", "-i", path, "-frames:v", "1",
+                    "-vf", f"scale='min({THUMBNAIL_SIZE[0]},iw)':-2", "-y", out],
+                   check=True, capture_output=True, timeout=FFMPEG_TIMEOUT)
+    return {"poster": out, "duration": duration}
+
+
+def _audio_waveform(path):
+    if path.lower().endswith(".wav"):
+        with wave.open(path, "rb") as wav:
+            if wav.getsampwidth() == 2:
+                frames, rate, channels = wav.getnframes(), wav.getframerate(), wav.getnchannels()
+                step = max(1, -(-frames // WAVEFORM_BARS))  # Frames per bar, rounded up
+                peaks = []
+                for _ in range(WAVEFORM_BARS):
+                    samples = array.array("h", wav.readframes(step))
+                    if not samples:
+                        break
+                    peaks.append(_peak(samples[::channels]))
+                return {"duration": frames / rate, "waveform": _normalise(peaks)}
+
+    # Anything else (and non-16-bit WAV) is decoded by ffmpeg to 8 kHz mono 16-bit PCM
+    ffmpeg, ffprobe = shutil.which("ffmpeg"), shutil.which("ffprobe")
+    if ffmpeg is None or ffprobe is None:
+        return {"error": "ffmpeg not installed"}
+    duration = _probe_duration(ffprobe, path)
+    pcm = subprocess.run([ffmpeg, "-v", "error", "-i", path, "-ac", "1", "-ar", "8000", "-f", "s16le", "-"],
+                         check=True, capture_output=True, timeout=FFMPEG_TIMEOUT).stdout
+    samples = array.array("h", pcm[:len(pcm) // 2 * 2])
+    step = max(1, -(-len(samples) // WAVEFORM_BARS))
+    peaks = [_peak(samples[start:start + step]) for start in range(0, len(samples), step)]
+    return {"duration": duration, "waveform": _normalise(peaks)}
+
+
+def _probe_duration(ffprobe, path):
+    result = subprocess.run([ffprobe, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+                            check=True, capture_output=True, text=True, timeout=FFMPEG_TIMEOUT)
+    return float(result.stdout.strip() or 0.0)
+
+
+def _peak(samples):
+    stride = max(1, len(samples) // SAMPLES_PER_BAR)
+    return max((abs(sample) for sample in samples[::stride]), default=0)
+
+
+def _normalise(peaks):
+    loudest = max(peaks, default=0) or 1
+    return [round(peak / loudest, 3) for peak in peaks]
+
+
+# 🔹 Async front end
+
+class MediaPreviewer:
+    """Builds attachment previews in a process pool and caches them by content hash.
+
+    Decoding a photo or seeking through a video is CPU-bound, so it runs in worker
+    processes instead of on the event loop. Artifacts live under <root>/<sha[:2]>/, so the
+    same content sent twice, or by several customers, is processed once; concurrent
+    requests for one hash share a single build. The pool starts on first use.
+    """
+
+    def __init__(self, root=PREVIEW_ROOT, workers=2):
+        self.root = os.path.abspath(root)  # Thumbnail paths end up as ft.Image sources, which need absolute paths
+        self.workers = workers
+        self.pool = None
+        self.cache = {}  # sha -> metadata, insertion-ordered for eviction
+        self.building = {}  # sha -> Future of the build in flight
+        self.stats = {"built": 0, "disk_hits": 0, "memory_hits": 0, "errors": 0}
+
+    async def preview(self, path, kind, sha=None):
+        """Metadata for path's preview (see build_preview), or None for kinds without one."""
+        if kind not in PREVIEW_KINDS:
+            return None
+        sha = sha or await asyncio.to_thread(file_sha256, path)
+        meta = self.cache.get(sha)
+        if meta is not None:
+            self.stats["memory_hits"] += 1
+            return meta
+        future = self.building.get(sha)
+        if future is None:
+            future = self.building[sha] = asyncio.ensure_future(self._load_or_build(path, sha, kind))
+            future.add_done_callback(lambda _: self.building.pop(sha, None))
+        return await asyncio.shield(future)
+
+    async def _load_or_build(self, path, sha, kind):
+        meta = await asyncio.to_thread(self._read_cached, sha)
+        if meta is not None:
+            self.stats["disk_hits"] += 1
+        else:
+            if self.pool is None:
+                # spawn: forking a process that runs UI and writer threads is not safe
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            meta = await asyncio.get_running_loop().run_in_executor(
+                self.pool, build_preview, path, sha, kind, self.root)
+            self.stats["built"] += 1
+            if "error" in meta:
+                self.stats["errors"] += 1
+                print(f"⚠️ Preview for {meta['name']} incomplete: {meta['error']}")
+                return meta  # Not cached, so the next view retries it
+        self.cache[sha] = meta
+        if len(self.cache) > MAX_CACHED:
+            self.cache.pop(next(iter(self.cache)))
+        return meta
+
+    def _read_cached(self, sha):
+        try:
+            with open(os.path.join(self.root, sha[:2], sha + ".json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get("version") == PREVIEW_VERSION else None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
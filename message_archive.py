@@ -0,0 +1,306 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+from broadcast import create_broadcast_tables
+from message_search import first_id_at
+
+DB_PATH = 'chat_messages.db'
+ARCHIVE_DIR = 'archive'
+
+
+def create_archive_index(conn):
+    """Tables in chat_messages.db that say which archive partition holds which history.
+
+    ArchivedClients has one row per (client, month), so reading a client's archived history
+    opens only the partitions that contain it.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ArchivePartitions (
+            partition TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            rows INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ArchivedClients (
+            client TEXT NOT NULL,
+            partition TEXT NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            PRIMARY KEY (client, partition)
+        ) WITHOUT ROWID
+    ''')
+    conn.commit()
+
+
+def open_partition(path):
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS Messages (
+            id INTEGER PRIMARY KEY,
+            sender TEXT NOT NULL,
+            receiver TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON Messages (sender, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_receiver_id ON Messages (receiver, id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS MessageRecipients (
+            receiver TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (receiver, message_id)
+        ) WITHOUT ROWID
+    ''')
+    return conn
+
+
+def file_size(path):
+    """Bytes used by a database, its WAL included."""
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+class MessageArchiver:
+    """Applies the retention policy to chat_messages.db.
+
+    Messages older than archive_after_days move to one SQLite file per month under
+    archive_dir. The move goes chunk_size rows at a time: the chunk is committed to its
+    partition first, then the index is updated and the rows are deleted in one short
+    transaction on the live database. A pause between chunks lets MessageWriter commit, so
+    live inserts wait one chunk at most. A crash in between leaves rows in both places, and
+    the next run skips the copies already archived. Partitions whose whole month is older
+    than delete_after_days are removed. Compaction gives freed pages back incrementally and
+    refreshes planner statistics.
+    """
+
+    def __init__(self, db_path=DB_PATH, archive_dir=ARCHIVE_DIR, archive_after_days=90, delete_after_days=None,
+                 chunk_size=5000, pause=0.05, vacuum_pages=2000):
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+        self.archive_after_days = archive_after_days
+        self.delete_after_days = delete_after_days
+        self.chunk_size = chunk_size
+        self.pause = pause  # Seconds between chunks so the writer thread gets the lock
+        self.vacuum_pages = vacuum_pages  # Pages returned to the OS per incremental_vacuum step
+
+    def run(self, progress=print):
+        """Archive, expire and compact once; returns a report dict."""
+        started = time.perf_counter()
+        report = {"size_before": file_size(self.db_path), "archived": {}, "expired": []}
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        try:
+            create_archive_index(conn)
+            create_broadcast_tables(conn)
+            phase = time.perf_counter()
+            self.archive(conn, report, progress)
+            report["archive_s"] = time.perf_counter() - phase
+            phase = time.perf_counter()
+            if self.delete_after_days is not None:
+                self.expire(conn, report, progress)
+            self.compact(conn, report)
+            report["compact_s"] = time.perf_counter() - phase
+        finally:
+            conn.close()
+        report["size_after"] = file_size(self.db_path)
+        report["archive_bytes"] = sum(file_size(os.path.join(self.archive_dir, name))
+                                      for name in os.listdir(self.archive_dir)) if os.path.isdir(self.archive_dir) else 0
+        report["total_s"] = time.perf_counter() - started
+        return report
+
+    def archive(self, conn, report, progress):
+        cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - self.archive_after_days * 86400))
+        end_id = first_id_at(conn, cutoff)  # First id that is kept
+        os.makedirs(self.archive_dir, exist_ok=True)
+        partitions = {}  # month -> open connection
+        last_id = 0
+        try:
+            while True:
+                rows = conn.execute('''
+                    SELECT id, sender, receiver, message, timestamp FROM Messages
+                    WHERE id > ? AND id < ? ORDER BY id LIMIT ?
+                ''', (last_id, end_id, self.chunk_size)).fetchall()
+                if not rows:
+                    break
+                by_month = {}
+                for row in rows:
+                    by_month.setdefault(str(row[4])[:7], []).append(row)
+                # Broadcast recipient sets move with their message
+                months = {row[0]: month for month, month_rows in by_month.items() for row in month_rows}
+                recipients = {}
+                for receiver, message_id in conn.execute('''
+                    SELECT receiver, message_id FROM MessageRecipients WHERE message_id > ? AND message_id <= ?
+                ''', (last_id, rows[-1][0])):
+                    recipients.setdefault(months[message_id], []).append((receiver, message_id))
+
+                # 🔹 Copy first: the rows are durable in their partition before they leave Messages
+                for month, month_rows in by_month.items():
+                    if month not in partitions:
+                        partitions[month] = open_partition(self.partition_path(month))
+                    with partitions[month]:
+                        partitions[month].executemany('INSERT OR IGNORE INTO Messages VALUES (?, ?, ?, ?, ?)',
+                                                      month_rows)
+                        partitions[month].executemany('INSERT OR IGNORE INTO MessageRecipients VALUES (?, ?)',
+                                                      recipients.get(month, ()))
+
+                with conn:
+                    for month, month_rows in by_month.items():
+                        self.index_rows(conn, month, month_rows, recipients.get(month, ()))
+                    conn.execute('DELETE FROM MessageRecipients WHERE message_id > ? AND message_id <= ?',
+                                 (last_id, rows[-1][0]))
+                    conn.execute('DELETE FROM Messages WHERE id > ? AND id <= ?', (last_id, rows[-1][0]))
+                for month, month_rows in by_month.items():
+                    report["archived"][month] = report["archived"].get(month, 0) + len(month_rows)
+                last_id = rows[-1][0]
+                progress(f"📦 Archived up to id {last_id} ({sum(report['archived'].values())} rows)")
+                time.sleep(self.pause)
+        finally:
+            for partition in partitions.values():
+                partition.close()
+
+    def partition_path(self, month):
+        return os.path.join(self.archive_dir, f"messages-{month}.db")
+
+    def index_rows(self, conn, month, rows, recipients=()):
+        conn.execute('''
+            INSERT INTO ArchivePartitions (partition, path, min_id, max_id, rows) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (partition) DO UPDATE SET min_id = MIN(min_id, excluded.min_id),
+                max_id = MAX(max_id, excluded.max_id), rows = rows + excluded.rows
+        ''', (month, self.partition_path(month), rows[0][0], rows[-1][0], len(rows)))
+        clients = {}
+        pairs = [(client, row_id) for row_id, sender, receiver, _, _ in rows for client in {sender, receiver}]
+        for client, row_id in pairs + list(recipients):
+            low, high, count = clients.get(client, (row_id, row_id, 0))
+            clients[client] = (min(low, row_id), max(high, row_id), count + 1)
+        conn.executemany('''
+            INSERT INTO ArchivedClients (client, partition, min_id, max_id, rows) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (client, partition) DO UPDATE SET min_id = MIN(min_id, excluded.min_id),
+                max_id = MAX(max_id, excluded.max_id), rows = rows + excluded.rows
+        ''', [(client, month, low, high, count) for client, (low, high, count) in clients.items()])
+
+    def expire(self, conn, report, progress):
+        """Drop partitions whose whole month is older than delete_after_days."""
+        cutoff = time.strftime('%Y-%m', time.gmtime(time.time() - self.delete_after_days * 86400))
+        for month, path in conn.execute('SELECT partition, path FROM ArchivePartitions WHERE partition < ?',
+                                        (cutoff,)).fetchall():
+            with conn:
+                conn.execute('DELETE FROM ArchivedClients WHERE partition = ?', (month,))
+                conn.execute('DELETE FROM ArchivePartitions WHERE partition = ?', (month,))
+            if os.path.exists(path):
+                os.remove(path)
+            report["expired"].append(month)
+            progress(f"🗑 Deleted archive partition {month}")
+
+    def compact(self, conn, report):
+        """Return free pages to the OS a step at a time, then refresh statistics and checkpoint."""
+        report["free_pages_before"] = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:  # INCREMENTAL
+            while conn.execute('PRAGMA freelist_count').fetchone()[0]:
+                # executescript steps the pragma to completion; execute() frees one page per call
+                conn.executescript(f'PRAGMA incremental_vacuum({self.vacuum_pages});')
+                time.sleep(self.pause)
+        else:
+            report["note"] = ("auto_vacuum is off, so freed pages are reused but the file does not shrink; "
+                              "run `python message_archive.py vacuum` once in a quiet period")
+        report["free_pages_after"] = conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+        # Merge some FTS segments left fragmented by the deletes, without a full rebuild
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'MessagesFTS'").fetchone():
+            with conn:
+                conn.execute("INSERT INTO MessagesFTS (MessagesFTS, rank) VALUES ('merge', 500)")
+        conn.execute('PRAGMA analysis_limit=1000')  # Sampled ANALYZE: milliseconds, not a table scan
+        conn.execute('ANALYZE')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def vacuum(self):
+        """One-off full VACUUM that also switches the database to incremental auto_vacuum.
+
+        It rewrites the whole file and blocks writers meanwhile, so run it in a quiet period.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            before = file_size(self.db_path)
+            started = time.perf_counter()
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            return before, file_size(self.db_path), time.perf_counter() - started
+        finally:
+            conn.close()
+
+    def status(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            create_archive_index(conn)
+            return conn.execute('SELECT partition, rows, min_id, max_id FROM ArchivePartitions ORDER BY partition').fetchall()
+        finally:
+            conn.close()
+
+
+def print_report(report):
+    archived = sum(report["archived"].values())
+    print(f"📦 Archived {archived} messages into {len(report['archived'])} partitions in {report['archive_s']:.1f}s")
+    for month, count in sorted(report["archived"].items()):
+        print(f"   {month}: {count}")
+    if report["expired"]:
+        print(f"🗑 Deleted partitions: {', '.join(report['expired'])}")
+    print(f"🧹 Free pages {report['free_pages_before']} -> {report['free_pages_after']} "
+          f"(compaction {report['compact_s']:.1f}s)")
+    reclaimed = report["size_before"] - report["size_after"]
+    print(f"💾 chat_messages.db {report['size_before'] / 1048576:.1f} MiB -> {report['size_after'] / 1048576:.1f} MiB "
+          f"({reclaimed / 1048576:.1f} MiB reclaimed), archive {report['archive_bytes'] / 1048576:.1f} MiB, "
+          f"{report['total_s']:.1f}s total")
+    if "note" in report:
+        print(f"⚠️ {report['note']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retention, archival and compaction for chat_messages.db.")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="archive old messages, expire old partitions and compact")
+    run.add_argument("--archive-after", type=float, default=90, help="days a message stays in chat_messages.db")
+    run.add_argument("--delete-after", type=float, help="days after which archived months are deleted (default: never)")
+    run.add_argument("--chunk-size", type=int, default=5000)
+    run.add_argument("--every", type=float, help="repeat every N hours instead of running once")
+    run.add_argument("--json", help="also append each report to this file as a JSON line")
+    commands.add_parser("vacuum", help="one-off full VACUUM that enables incremental vacuum")
+    commands.add_parser("status", help="list archive partitions")
+    args = parser.parse_args()
+
+    archiver = MessageArchiver(args.db, args.archive_dir)
+    if args.command == "vacuum":
+        before, after, seconds = archiver.vacuum()
+        print(f"🧹 VACUUM {before / 1048576:.1f} MiB -> {after / 1048576:.1f} MiB in {seconds:.1f}s")
+        return
+    if args.command == "status":
+        for month, rows, min_id, max_id in archiver.status():
+            print(f"{month}: {rows} messages (ids {min_id}-{max_id})")
+        return
+
+    archiver.archive_after_days = args.archive_after
+    archiver.delete_after_days = args.delete_after
+    archiver.chunk_size = args.chunk_size
+    while True:
+        report = archiver.run()
+        print_report(report)
+        if args.json:
+            with open(args.json, "a") as f:
+                f.write(json.dumps({"event": "retention", "ts": round(time.time(), 3), **report}) + "\n")
+        if not args.every:
+            break
+        time.sleep(args.every * 3600)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import re
+import sqlite3
+import time
+
+DB_PATH = 'chat_messages.db'
+
+# Bare words, "quoted phrases", each optionally ending in * for a prefix match
+_TERM = re.compile(r'"([^"]*)"(\*?)|(\S+?)(\*?)(?=\s|$)')
+
+
+def create_search_index(conn):
+    """Create the FTS5 index over Messages and the triggers that keep it in sync.
+
+    The index is external-content: it reads text back through the MessagesSearchSource
+    view instead of storing a second copy, and indexes the sender and receiver names as a
+    `party` column so a client filter is a doclist intersection rather than a scan. Triggers
+    maintain it, so every insert path, MessageWriter batches included, is indexed inside
+    the same transaction. On a database that already holds messages, rows up to the
+    current max id are left for backfill(); the delete/update triggers skip them until then.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'MessagesFTS'").fetchone()
+    if exists:
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('''
+            CREATE VIEW MessagesSearchSource AS
+            SELECT id, message, sender || ' ' || receiver AS party FROM Messages
+        ''')
+        conn.execute('''
+            CREATE VIRTUAL TABLE MessagesFTS USING fts5(
+                message, party, content='MessagesSearchSource', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE SearchIndexState (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                backfilled_upto INTEGER NOT NULL,
+                backfill_end INTEGER NOT NULL
+            )
+        ''')
+        # 🔹 Everything at or below the current max id predates the index and waits for backfill
+        conn.execute('''
+            INSERT INTO SearchIndexState (id, backfilled_upto, backfill_end)
+            SELECT 1, 0, COALESCE(MAX(id), 0) FROM Messages
+        ''')
+        indexed = '''(old.id <= (SELECT backfilled_upto FROM SearchIndexState)
+                      OR old.id > (SELECT backfill_end FROM SearchIndexState))'''
+        remove = '''INSERT INTO MessagesFTS (MessagesFTS, rowid, message, party)
+                    VALUES ('delete', old.id, old.message, old.sender || ' ' || old.receiver);'''
+        add = '''INSERT INTO MessagesFTS (rowid, message, party)
+                 VALUES (new.id, new.message, new.sender || ' ' || new.receiver);'''
+        conn.execute(f'CREATE TRIGGER messages_fts_insert AFTER INSERT ON Messages BEGIN {add} END')
+        conn.execute(f'CREATE TRIGGER messages_fts_delete AFTER DELETE ON Messages WHEN {indexed} BEGIN {remove} END')
+        conn.execute(f'''
+            CREATE TRIGGER messages_fts_update AFTER UPDATE OF sender, receiver, message ON Messages
+            WHEN {indexed} BEGIN {remove} {add} END
+        ''')
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
+def build_match(query):
+    """Turn agent input into a safe FTS5 expression.
+
+    Words and "quoted phrases" are ANDed together; a trailing * makes a term a prefix
+    query (refun* matches refund, refunded). Everything is quoted, so punctuation such as
+    #4821 or - never reaches the FTS5 query parser as syntax.
+    """
+    terms = []
+    for phrase, phrase_star, word, word_star in _TERM.findall(query):
+        text = (phrase if phrase or phrase_star else word).strip()
+        if text:
+            terms.append('"' + text.replace('"', '""') + '"' + (phrase_star or word_star))
+    return " ".join(terms)
+
+
+def first_id_at(conn, timestamp, after=False):
+    """Smallest Messages id whose timestamp is >= (or > with after) the given one.
+
+    Ids grow with time, so this bisects the primary key instead of scanning timestamps.
+    """
+    # Two statements: SQLite only answers a lone MIN() or MAX() from the primary key
+    low = conn.execute('SELECT COALESCE(MIN(id), 0) FROM Messages').fetchone()[0]
+    high = conn.execute('SELECT COALESCE(MAX(id), 0) FROM Messages').fetchone()[0] + 1  # Past the end
+    while low < high:
+        middle = (low + high) // 2
+        row = conn.execute('SELECT id, timestamp FROM Messages WHERE id >= ? ORDER BY id LIMIT 1', (middle,)).fetchone()
+        if row is None:
+            break  # Empty table
+        row_id, row_time = row
+        if row_time > timestamp if after else row_time >= timestamp:
+            high = middle
+        else:
+            low = row_id + 1
+    return low
+
+
+class MessageSearch:
+    """Ranked full-text search over chat messages, optionally narrowed to one client and a time range.
+
+    Scoring every hit of a common word with bm25 grows with the table, so matches are
+    ranked in windows of max_candidates, newest window first: one rowid-ordered probe finds
+    a window's lowest id, and FTS5 applies it as a rowid bound before ranking. Paging past
+    the end of a window moves on to the next older one, so no match is ever dropped.
+    """
+
+    def __init__(self, db_path=DB_PATH, page_size=20, max_candidates=2000):
+        self.db_path = db_path
+        self.page_size = page_size
+        self.max_candidates = max_candidates
+
+    def fetch_results(self, query, client=None, since=None, until=None, cursor=None, limit=None):
+        """Return (rows, next_cursor) for one page of matches, best first within each window.
+
+        Rows are (id, sender, receiver, message, timestamp, snippet); pass next_cursor back
+        for the following page (None means this was the last). since/until are
+        'YYYY-MM-DD[ HH:MM:SS]' UTC strings; since ids grow with time they become an id
+        range found by bisecting the primary key. The cursor pins that id range, so
+        messages arriving between pages do not reshuffle the ranking.
+        """
+        match = build_match(query)
+        if not match:
+            return [], None
+        match = f"message : ({match})"
+        if client:
+            match += f" AND party : ({build_match(client.replace(chr(34), ' '))})"
+        limit = limit or self.page_size
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            if cursor is None:
+                low, high = 0, conn.execute('SELECT COALESCE(MAX(id), 0) FROM Messages').fetchone()[0]
+                if since:
+                    low = first_id_at(conn, since)
+                if until:
+                    high = min(high, first_id_at(conn, until, after=True) - 1)
+                cursor = (0, self._window_floor(conn, match, low, high), high, low)
+            offset, floor, high, low = cursor
+
+            rows = []
+            while True:
+                wanted = limit - len(rows)
+                page = self._ranked(conn, match, client, floor, high, wanted + 1, offset)
+                if len(page) > wanted:
+                    rows += page[:wanted]
+                    next_cursor = (offset + wanted, floor, high, low)
+                    break
+                rows += page
+                if floor <= low:
+                    next_cursor = None  # Every window has been ranked
+                    break
+                high = floor - 1  # 🔹 On to the next older window of candidates
+                floor, offset = self._window_floor(conn, match, low, high), 0
+                if len(rows) == limit:
+                    next_cursor = (offset, floor, high, low)
+                    break
+        finally:
+            conn.close()
+        return rows, next_cursor
+
+    def _window_floor(self, conn, match, low, high):
+        """Lowest id of the newest max_candidates matches in [low, high]."""
+        floor = conn.execute('''
+            SELECT rowid FROM MessagesFTS WHERE MessagesFTS MATCH ? AND rowid BETWEEN ? AND ?
+            ORDER BY rowid DESC LIMIT 1 OFFSET ?
+        ''', (match, low, high, self.max_candidates - 1)).fetchone()
+        return max(low, floor[0]) if floor else low
+
+    def _ranked(self, conn, match, client, low, high, limit, offset):
+        sql = '''
+            SELECT m.id, m.sender, m.receiver, m.message, m.timestamp,
+                   snippet(MessagesFTS, 0, '[', ']', '…', 12)
+            FROM MessagesFTS JOIN Messages m ON m.id = MessagesFTS.rowid
+            WHERE MessagesFTS MATCH ? AND MessagesFTS.rowid BETWEEN ? AND ?
+        '''
+        params = [match, low, high]
+        if client:
+            # Party tokens only narrow the candidates; john.doe must not match john-doe
+            sql += ' AND (m.sender = ? OR m.receiver = ?)'
+            params += [client, client]
+        sql += ' ORDER BY bm25(MessagesFTS, 1.0, 0.0) LIMIT ? OFFSET ?'
+        params += [limit, offset]
+        return conn.execute(sql, params).fetchall()
+
+    async def load_results(self, query, client=None, since=None, until=None, cursor=None, limit=None):
+        """fetch_results() in a worker thread so the UI loop never waits on SQLite."""
+        return await asyncio.to_thread(self.fetch_results, query, client, since, until, cursor, limit)
+
+    def status(self):
+        """Backfill progress: (backfilled_upto, backfill_end)."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('SELECT backfilled_upto, backfill_end FROM SearchIndexState').fetchone()
+        finally:
+            conn.close()
+
+    def backfill(self, chunk_size=50000, progress=print):
+        """Index rows that predate the search index, one short transaction per chunk.
+
+        Safe to stop and rerun: progress is recorded with each chunk, and live inserts are
+        indexed by the trigger meanwhile, so the chat server can keep running.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        try:
+            create_search_index(conn)
+            done, end = conn.execute('SELECT backfilled_upto, backfill_end FROM SearchIndexState').fetchone()
+            started = time.perf_counter()
+            indexed = 0
+            while done < end:
+                upto = min(done + chunk_size, end)
+                with conn:
+                    cursor = conn.execute('''
+                        INSERT INTO MessagesFTS (rowid, message, party)
+                        SELECT id, message, sender || ' ' || receiver FROM Messages WHERE id > ? AND id <= ?
+                    ''', (done, upto))
+                    conn.execute('UPDATE SearchIndexState SET backfilled_upto = ?', (upto,))
+                indexed += cursor.rowcount
+                done = upto
+                rate = indexed / (time.perf_counter() - started or 1e-9)
+                progress(f"🔎 Indexed up to id {done}/{end} ({indexed} rows, {rate:.0f} rows/s)")
+            if indexed:
+                with conn:
+                    conn.execute("INSERT INTO MessagesFTS (MessagesFTS) VALUES ('optimize')")
+            return indexed
+        finally:
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-text search over chat_messages.db.")
+    parser.add_argument("--db", default=DB_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill = commands.add_parser("backfill", help="index messages stored before search was enabled")
+    backfill.add_argument("--chunk-size", type=int, default=50000)
+    search = commands.add_parser("search", help="run a query from the command line")
+    search.add_argument("query")
+    search.add_argument("--client")
+    search.add_argument("--since")
+    search.add_argument("--until")
+    search.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    searcher = MessageSearch(args.db)
+    if args.command == "backfill":
+        print(f"✅ Backfill finished: {searcher.backfill(args.chunk_size)} rows indexed")
+        return
+
+    started = time.perf_counter()
+    rows, _ = searcher.fetch_results(args.query, args.client, args.since, args.until, limit=args.limit)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    for msg_id, sender, receiver, _, timestamp, snippet in rows:
+        print(f"{msg_id:>10} {timestamp} {sender} → {receiver}: {snippet}")
+    print(f"🔎 {len(rows)} results in {elapsed_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
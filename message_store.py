@@ -0,0 +1,318 @@
+import asyncio
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+
+from broadcast import create_broadcast_tables
+from message_archive import create_archive_index
+from message_search import create_search_index
+from metrics import Histogram
+
+DB_PATH = 'chat_messages.db'
+
+_STOP = object()
+
+
+class chatDatabase:
+    def __init__(self):
+
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+
+        # 🔹 Lets retention give space back in small steps (only takes effect on a new file)
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+        # 🔹 Create table to store chat messages
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender TEXT NOT NULL,
+                receiver TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # 🔹 Keyset pagination walks these per-client (sender/receiver, id) ranges
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON Messages (sender, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_receiver_id ON Messages (receiver, id)')
+        conn.commit()
+
+        # 🔎 Full-text index for agent search, kept in sync by triggers
+        create_search_index(conn)
+        # 📦 Where archived months live (see message_archive.py)
+        create_archive_index(conn)
+        # 📢 Broadcast recipient sets and customer groups (see broadcast.py)
+        create_broadcast_tables(conn)
+        conn.close()
+        print("✅ Chat database initialized successfully!")
+
+
+class MessageWriter:
+    """Single long-lived SQLite writer that group-commits queued inserts on its own thread."""
+
+    def __init__(self, db_path=DB_PATH, batch_size=200, flush_interval=0.05, max_queue=10000):
+        self.db_path = db_path
+        self.batch_size = batch_size          # Commit once this many rows are waiting...
+        self.flush_interval = flush_interval  # ...or once the oldest row has waited this long (seconds)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.stats = {
+            "submitted": 0,
+            "written": 0,
+            "commits": 0,
+            "errors": 0,
+            "backpressure_waits": 0,
+            "last_commit_ms": 0.0,
+            "max_commit_ms": 0.0,
+            "total_commit_ms": 0.0,
+        }
+        self.commit_ms = Histogram()  # Per batch transaction
+        self.insert_ms = Histogram()  # Per message, submit() to commit
+
+    def start(self):
+        """Open the writer connection and start the background commit thread."""
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    async def submit(self, sender, receiver, message, recipients=None):
+        """Queue one message for insertion without blocking the event loop.
+
+        Waits (off the loop) while the queue is full, which is the backpressure signal for
+        chatty senders. Returns a future resolving to the new row id, or None on a DB error.
+        A broadcast passes its audience label as receiver and everyone it goes to as
+        recipients: one Messages row plus one MessageRecipients row each, in the same commit.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        item = (sender, receiver, message, recipients, future, loop, time.perf_counter())
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.stats["backpressure_waits"] += 1
+            await loop.run_in_executor(None, self.queue.put, item)
+        self.stats["submitted"] += 1
+        return future
+
+    def stop(self):
+        """Flush everything still queued and close the writer connection."""
+        if not self.thread or not self.thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    async def close(self):
+        """Async-friendly stop() for use from the event loop."""
+        await asyncio.to_thread(self.stop)
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def snapshot(self):
+        """Counters for queue depth and commit latency."""
+        commits = self.stats["commits"]
+        return {
+            **self.stats,
+            "queue_depth": self.queue_depth,
+            "avg_commit_ms": self.stats["total_commit_ms"] / commits if commits else 0.0,
+        }
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(conn, batch)
+
+        conn.close()
+
+    def _commit(self, conn, batch):
+        """Insert a batch in one transaction and hand the row ids back to the waiting loops."""
+        started = time.perf_counter()
+        row_ids = []
+        try:
+            cursor = conn.cursor()
+            for sender, receiver, message, recipients, *_ in batch:
+                cursor.execute('INSERT INTO Messages (sender, receiver, message) VALUES (?, ?, ?)',
+                               (sender, receiver, message))
+                row_ids.append(cursor.lastrowid)
+                if recipients:
+                    cursor.executemany('INSERT OR IGNORE INTO MessageRecipients (receiver, message_id) VALUES (?, ?)',
+                                       [(recipient, row_ids[-1]) for recipient in recipients])
+            conn.commit()
+            self.stats["written"] += len(batch)
+        except sqlite3.Error as db_error:
+            conn.rollback()
+            row_ids = [None] * len(batch)
+            self.stats["errors"] += 1
+            print("🔥 Database error:", db_error)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats["commits"] += 1
+        self.stats["last_commit_ms"] = elapsed_ms
+        self.stats["total_commit_ms"] += elapsed_ms
+        self.stats["max_commit_ms"] = max(self.stats["max_commit_ms"], elapsed_ms)
+        self.commit_ms.observe(elapsed_ms)
+        finished = time.perf_counter()
+        for item in batch:
+            self.insert_ms.observe((finished - item[-1]) * 1000)
+
+        # 🔹 Resolve futures on their own loops, one callback per loop per batch
+        by_loop = {}
+        for (*_, future, loop, _), row_id in zip(batch, row_ids):
+            by_loop.setdefault(loop, []).append((future, row_id))
+        for loop, results in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(_resolve, results)
+            except RuntimeError:
+                pass  # Loop already closed during shutdown
+
+
+def _resolve(results):
+    for future, row_id in results:
+        if not future.done():
+            future.set_result(row_id)
+
+
+def client_page(conn, client, before_id, after_id, limit, recipients=True):
+    """One keyset page of a client's conversation from conn's Messages table (see ChatHistory).
+
+    Broadcasts the client received come from MessageRecipients; pass recipients=False for
+    an archive partition written before that table existed.
+    """
+    if after_id is not None:
+        op, bound, order = '>', after_id, 'ASC'
+    else:
+        op, bound, order = '<', before_id if before_id is not None else 2 ** 63 - 1, 'DESC'
+
+    query = f'''
+        SELECT * FROM (
+            SELECT id, sender, receiver, message, timestamp FROM Messages
+            WHERE sender = ? AND id {op} ? ORDER BY id {order} LIMIT ?
+        )
+        UNION
+        SELECT * FROM (
+            SELECT id, sender, receiver, message, timestamp FROM Messages
+            WHERE receiver = ? AND id {op} ? ORDER BY id {order} LIMIT ?
+        )
+    '''
+    params = [client, bound, limit, client, bound, limit]
+    if recipients:
+        query += f'''
+        UNION
+        SELECT * FROM (
+            SELECT m.id, m.sender, m.receiver, m.message, m.timestamp
+            FROM MessageRecipients r JOIN Messages m ON m.id = r.message_id
+            WHERE r.receiver = ? AND r.message_id {op} ? ORDER BY r.message_id {order} LIMIT ?
+        )
+        '''
+        params += [client, bound, limit]
+    query += f'ORDER BY id {order} LIMIT ?'
+    return conn.execute(query, params + [limit]).fetchall()
+
+
+class ChatHistory:
+    """Keyset-paginated reads of one client's conversation, newest page first."""
+
+    def __init__(self, db_path=DB_PATH, page_size=50):
+        self.db_path = db_path
+        self.page_size = page_size
+
+    def fetch_page(self, client, before_id=None, after_id=None, limit=None):
+        """Return one page of (id, sender, receiver, message, timestamp) rows.
+
+        With before_id (or nothing) rows come newest-first, walking back in time; with
+        after_id they come oldest-first, walking forward. Each branch of the UNION is a range
+        scan on the (sender, id), (receiver, id) or MessageRecipients key, so the cost is one
+        page no matter how long the history is. Archived rows are older than anything left in Messages, so
+        a backward page that runs out continues into the archive, and a forward page starts
+        there.
+        """
+        limit = limit or self.page_size
+        conn = sqlite3.connect(self.db_path)
+        try:
+            if after_id is not None:
+                rows = self._archived_page(conn, client, None, after_id, limit)
+                if len(rows) < limit:
+                    rows += client_page(conn, client, None, rows[-1][0] if rows else after_id, limit - len(rows))
+            else:
+                rows = client_page(conn, client, before_id, None, limit)
+                if len(rows) < limit:
+                    rows += self._archived_page(conn, client, rows[-1][0] if rows else before_id, None,
+                                                limit - len(rows))
+            return rows
+        finally:
+            conn.close()
+
+    def has_sent(self, client, texts):
+        """Whether client sent any of texts (an index range scan of the client's own messages)."""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            row = conn.execute(f'''
+                SELECT 1 FROM Messages WHERE sender = ? AND message IN ({", ".join("?" * len(texts))}) LIMIT 1
+            ''', [client, *texts]).fetchone()
+            return row is not None
+        finally:
+            conn.close()
+
+    def _archived_page(self, conn, client, before_id, after_id, limit):
+        """Continue a page in the monthly archive partitions that hold this client."""
+        if after_id is not None:
+            partitions = conn.execute('''
+                SELECT p.path FROM ArchivedClients a JOIN ArchivePartitions p USING (partition)
+                WHERE a.client = ? AND a.max_id > ? ORDER BY a.min_id
+            ''', (client, after_id)).fetchall()
+        else:
+            partitions = conn.execute('''
+                SELECT p.path FROM ArchivedClients a JOIN ArchivePartitions p USING (partition)
+                WHERE a.client = ? AND a.min_id < ? ORDER BY a.max_id DESC
+            ''', (client, before_id if before_id is not None else 2 ** 63 - 1)).fetchall()
+        rows = []
+        for path, in partitions:
+            try:
+                archive = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            except sqlite3.OperationalError:
+                continue  # Deleted by retention since the index was read
+            try:
+                recipients = archive.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'MessageRecipients'").fetchone() is not None
+                if after_id is not None:
+                    rows += client_page(archive, client, None, rows[-1][0] if rows else after_id, limit - len(rows),
+                                        recipients)
+                else:
+                    rows += client_page(archive, client, rows[-1][0] if rows else before_id, None, limit - len(rows),
+                                        recipients)
+            finally:
+                archive.close()
+            if len(rows) >= limit:
+                break
+        return rows
+
+    async def load_page(self, client, before_id=None, after_id=None, limit=None):
+        """fetch_page() in a worker thread so the UI loop never waits on SQLite."""
+        return await asyncio.to_thread(self.fetch_page, client, before_id, after_id, limit)
@@ -0,0 +1,288 @@
+import asyncio
+import json
+import time
+from bisect import bisect_left
+
+# Upper bounds in milliseconds; the last bucket (+Inf) is implicit
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+MAX_QUEUE_SERIES = 100  # Per-client queue gauges exported, largest first
+
+
+class Histogram:
+    """Fixed-bucket latency histogram; observe() is a bisect and three additions."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (an estimate, for logs)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class LoopMonitor:
+    """Measures event-loop lag: how late a periodic wake-up fires.
+
+    A wake-up later than slow_threshold means some callback held the loop that long; it is
+    counted and logged. With debug_callbacks=True asyncio's debug mode also names the slow
+    callback, at a noticeable cost, so it is meant for investigation rather than always-on.
+    """
+
+    def __init__(self, interval=0.05, slow_threshold=0.1, debug_callbacks=False):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.debug_callbacks = debug_callbacks
+        self.lag_ms = Histogram()
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self.slow_callbacks = 0
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            loop = asyncio.get_running_loop()
+            if self.debug_callbacks:
+                loop.set_debug(True)
+                loop.slow_callback_duration = self.slow_threshold
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - expected)
+            self.last_lag_ms = lag * 1000
+            self.max_lag_ms = max(self.max_lag_ms, self.last_lag_ms)
+            self.lag_ms.observe(self.last_lag_ms)
+            if lag >= self.slow_threshold:
+                self.slow_callbacks += 1
+                print(f"🐢 Event loop blocked for {self.last_lag_ms:.0f} ms")
+
+
+class MetricsRegistry:
+    """Collects metrics from the running components only when scraped or logged.
+
+    Components keep their own counters and histograms; each source registered here is a
+    (possibly async) function returning [(name, type, help, samples)], where samples is a
+    list of (labels, value) pairs or, for histograms, a single Histogram. Nothing is added
+    to the message hot path beyond the counters the components already keep.
+    """
+
+    def __init__(self, prefix="chat"):
+        self.prefix = prefix
+        self.sources = []
+        self.server = None
+        self.log_task = None
+
+    def register(self, source):
+        self.sources.append(source)
+
+    async def collect(self):
+        families = []
+        for source in self.sources:
+            result = source()
+            if asyncio.iscoroutine(result):
+                result = await result
+            families.extend(result)
+        return families
+
+    async def render(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for name, kind, help_text, samples in await self.collect():
+            name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                cumulative = 0
+                for bound, count in zip(samples.buckets + (float("inf"),), samples.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f"{name}_sum {samples.sum:.6f}")
+                lines.append(f"{name}_count {samples.count}")
+                continue
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{_escape(str(val))}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def snapshot(self):
+        """Flat dict for a structured log line; histograms are summarised as count/avg/p50/p99."""
+        snapshot = {"ts": round(time.time(), 3)}
+        for name, kind, _, samples in await self.collect():
+            if kind == "histogram":
+                snapshot[name] = {
+                    "count": samples.count,
+                    "avg": round(samples.sum / samples.count, 3) if samples.count else 0.0,
+                    "p50": samples.quantile(0.5),
+                    "p99": samples.quantile(0.99),
+                }
+            elif len(samples) == 1 and not samples[0][0]:
+                snapshot[name] = samples[0][1]
+            else:
+                snapshot[name] = {",".join(str(v) for v in labels.values()): value for labels, value in samples}
+        return snapshot
+
+    async def start(self, host="127.0.0.1", port=9100, log_interval=0.0):
+        """Serve GET /metrics on host:port (port 0 disables) and log snapshots every log_interval seconds."""
+        if port:
+            try:
+                self.server = await asyncio.start_server(self._handle_http, host, port)
+                print(f"📊 Metrics on http://{host}:{port}/metrics")
+            except OSError as e:
+                print(f"⚠️ Metrics endpoint disabled, cannot listen on {host}:{port}: {e}")
+        if log_interval:
+            self.log_task = asyncio.create_task(self._log_loop(log_interval))
+
+    async def close(self):
+        if self.log_task is not None:
+            self.log_task.cancel()
+        if self.server is not None:
+            self.server.close()
+
+    async def _log_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                print(json.dumps({"event": "metrics", **await self.snapshot()}, default=str))
+            except Exception as e:
+                print("🔥 Metrics snapshot failed:", e)
+
+    async def _handle_http(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", (await self.render()).encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# 🔹 Sources for the components the servers run
+
+def connection_metrics(server):
+    def collect():
+        stats = server.stats
+        return [
+            ("active_connections", "gauge", "Authenticated sockets held by this process",
+             [({}, len(server.sessions))]),
+            ("session_registry_bytes", "gauge", "Session objects and their indexes, per authenticated socket",
+             [({}, round(server.sessions.memory()["bytes_per_session"], 1))]),
+            ("idle_disconnects_total", "counter", "Connections closed for sending nothing within the idle timeout",
+             [({}, stats["idle_disconnects"])]),
+            ("connections_total", "counter", "WebSocket connections accepted", [({}, stats["connections"])]),
+            ("protocol_errors_total", "counter", "Frames that failed to decode", [({}, stats["protocol_errors"])]),
+            ("messages_total", "counter", "Chat messages by direction",
+             [({"direction": "inbound"}, stats["inbound"]), ({"direction": "outbound"}, stats["outbound"])]),
+            ("history_rows_synced_total", "counter", "Stored messages streamed to caching clients",
+             [({}, stats["history_rows"])]),
+            ("throttled_frames_total", "counter", "Inbound frames delayed by the rate limiter",
+             [({}, stats["throttled"])]),
+            ("throttled_seconds_total", "counter", "Time inbound reading was paused by the rate limiter",
+             [({}, round(stats["throttled_seconds"], 3))]),
+            ("outbound_dropped_frames_total", "counter", "Queued frames discarded when a slow consumer was cut off",
+             [({}, stats["outbound_dropped"])]),
+            ("slow_consumer_disconnects_total", "counter", "Clients disconnected for not reading",
+             [({}, stats["slow_disconnects"])]),
+            ("outbound_queue_depth", "gauge", "Frames waiting in per-connection send queues",
+             [({}, server.outbound_depth)]),
+            ("broadcasts_total", "counter", "Broadcasts fanned out by this process", [({}, stats["broadcasts"])]),
+            ("broadcast_frames_total", "counter", "Broadcast frames queued, by whether the socket had room",
+             [({"queued": "immediately"}, stats["broadcast_frames"] - stats["broadcast_deferred"]),
+              ({"queued": "deferred"}, stats["broadcast_deferred"])]),
+            ("broadcast_fanout_ms", "histogram", "Time to queue one broadcast on every local recipient socket",
+             server.fanout_ms),
+        ]
+    return collect
+
+
+def auth_metrics(authenticator):
+    def collect():
+        stats = authenticator.stats
+        return [
+            ("auth_total", "counter", "Authentication attempts by result",
+             [({"result": "success"}, stats["successes"]), ({"result": "failure"}, stats["failures"])]),
+            ("auth_cache_hits_total", "counter", "Attempts answered from memory",
+             [({}, stats["cache_hits"] + stats["negative_hits"])]),
+            ("auth_latency_ms", "histogram", "Authentication latency", authenticator.latency_ms),
+        ]
+    return collect
+
+
+def writer_metrics(writer):
+    def collect():
+        stats = writer.stats
+        return [
+            ("db_rows_written_total", "counter", "Messages committed to chat_messages.db", [({}, stats["written"])]),
+            ("db_write_errors_total", "counter", "Failed insert batches", [({}, stats["errors"])]),
+            ("db_writer_queue_depth", "gauge", "Inserts waiting for the writer thread", [({}, writer.queue_depth)]),
+            ("db_commit_latency_ms", "histogram", "Duration of one batched insert transaction", writer.commit_ms),
+            ("db_insert_latency_ms", "histogram", "Time from submit() to commit per message", writer.insert_ms),
+        ]
+    return collect
+
+
+def queue_metrics(bus, max_series=MAX_QUEUE_SERIES):
+    async def collect():
+        sizes = await bus.queue_sizes()
+        largest = sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:max_series]
+        return [
+            ("queue_depth", "gauge", f"Items waiting per offline queue (largest {max_series})",
+             [({"queue": name}, size) for name, size in largest]),
+            ("queued_items", "gauge", "Items waiting across all offline queues", [({}, sum(sizes.values()))]),
+        ]
+    return collect
+
+
+def render_metrics(renderer):
+    def collect():
+        return [
+            ("page_updates_total", "counter", "page.update() calls", [({}, renderer.stats["updates"])]),
+            ("page_update_requests_total", "counter", "Render requests before coalescing",
+             [({}, renderer.stats["requests"])]),
+            ("page_update_cost_ms", "histogram", "Duration of one page.update()", renderer.cost_ms),
+        ]
+    return collect
+
+
+def loop_metrics(monitor):
+    def collect():
+        return [
+            ("event_loop_lag_ms", "histogram", "How late periodic loop wake-ups fire", monitor.lag_ms),
+            ("event_loop_max_lag_ms", "gauge", "Worst loop lag seen", [({}, round(monitor.max_lag_ms, 3))]),
+            ("event_loop_slow_callbacks_total", "counter", "Wake-ups delayed past the slow threshold",
+             [({}, monitor.slow_callbacks)]),
+        ]
+    return collect
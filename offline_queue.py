@@ -0,0 +1,229 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+
+QUEUE_DB_PATH = 'offline_queues.db'
+
+
+class OfflineQueueStore:
+    """Bounded, durable per-client message queues.
+
+    Every item is written through to SQLite so queues survive restarts. Recent items are
+    also kept in memory until memory_budget bytes are in use; past that a queue "spills"
+    and is read back from disk until it has been fully acknowledged. Each queue holds at
+    most max_items: with overflow="drop_oldest" the oldest items make room, with
+    "drop_newest" the new item is refused. Sequence numbers increase monotonically, so
+    ack(queue, seq) acknowledges everything up to and including seq.
+
+    Pushes and acks are group-committed: while one transaction is being written, the
+    operations that arrive meanwhile wait and are applied together in the next one, so
+    under load a commit covers many of them. Each call still returns only once its
+    change is committed.
+
+    The memory cache assumes one process owns the store; when several processes share the
+    file (the SQLite bus), use memory_budget=0 so every read goes to disk.
+    """
+
+    def __init__(self, db_path=QUEUE_DB_PATH, max_items=1000, memory_budget=4 * 1024 * 1024,
+                 overflow="drop_oldest"):
+        if overflow not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.db_path = db_path
+        self.max_items = max_items
+        self.memory_budget = memory_budget
+        self.overflow = overflow
+
+        self.cache = {}        # queue name -> deque of (seq, payload) for queues not spilled
+        self.spilled = set()   # queues whose items must be read from disk
+        self.memory_bytes = 0
+        self.stats = {"pushed": 0, "dropped": 0, "acked": 0, "spilled_pushes": 0, "commits": 0}
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes = []  # (operation, queue_name, argument, future) waiting for the next commit
+        self._writer = None  # Task committing batches of _writes
+
+    async def open(self):
+        """Create the table and mark every queue left over from a previous run as spilled."""
+        if self._conn is not None:
+            return
+        names = await self._run(self._setup)
+        self.spilled.update(names)
+
+    async def close(self):
+        if self._writer is not None:
+            await asyncio.gather(self._writer, return_exceptions=True)
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+    async def push(self, queue_name, item):
+        """Append item; returns its sequence number, or None when the overflow policy refused it."""
+        payload = json.dumps(item)
+        seq, dropped, dropped_upto = await self._write("push", queue_name, payload)
+        self.stats["dropped"] += dropped
+        if seq is None:
+            return None
+
+        self.stats["pushed"] += 1
+        if dropped_upto is not None:
+            self._evict(queue_name, dropped_upto)
+
+        if queue_name in self.spilled or self.memory_bytes + len(payload) > self.memory_budget:
+            # 🔹 Over budget: this queue is served from disk until it drains
+            if queue_name not in self.spilled:
+                self._evict(queue_name, seq)
+                self.spilled.add(queue_name)
+            self.stats["spilled_pushes"] += 1
+        else:
+            self.cache.setdefault(queue_name, deque()).append((seq, payload))
+            self.memory_bytes += len(payload)
+        return seq
+
+    async def pending(self, queue_name, after_seq=0, limit=500):
+        """Return up to limit unacknowledged (seq, item) pairs after after_seq, oldest first."""
+        if queue_name in self.spilled or not self.memory_budget:
+            rows = await self._run(self._pending, queue_name, after_seq, limit)
+        else:
+            rows = [(seq, payload) for seq, payload in self.cache.get(queue_name, ()) if seq > after_seq][:limit]
+        return [(seq, json.loads(payload)) for seq, payload in rows]
+
+    async def ack(self, queue_name, upto_seq):
+        """Acknowledge (delete) every item up to and including upto_seq."""
+        removed, remaining = await self._write("ack", queue_name, upto_seq)
+        self.stats["acked"] += removed
+        self._evict(queue_name, upto_seq)
+        if remaining == 0:
+            self.spilled.discard(queue_name)
+
+    async def drain(self, queue_name):
+        """Pop every queued item, oldest first."""
+        rows = await self.pending(queue_name, limit=self.max_items)
+        if rows:
+            await self.ack(queue_name, rows[-1][0])
+        return [item for _, item in rows]
+
+    async def sizes(self):
+        """Queue length per queue name (read from disk, so it is shared across processes)."""
+        return dict(await self._run(lambda: self._conn.execute(
+            'SELECT queue_name, COUNT(*) FROM OfflineQueues GROUP BY queue_name').fetchall()))
+
+    async def snapshot(self):
+        sizes = await self.sizes()
+        return {
+            **self.stats,
+            "queues": len(sizes),
+            "queued": sum(sizes.values()),
+            "max_queue": max(sizes.values(), default=0),
+            "memory_bytes": self.memory_bytes,
+            "spilled_queues": len(self.spilled),
+            "sizes": sizes,
+        }
+
+    def _evict(self, queue_name, upto_seq):
+        """Drop cached items up to upto_seq; returns how many were removed."""
+        cached = self.cache.get(queue_name)
+        removed = 0
+        while cached and cached[0][0] <= upto_seq:
+            self.memory_bytes -= len(cached.popleft()[1])
+            removed += 1
+        if cached is not None and not cached:
+            del self.cache[queue_name]
+        return removed
+
+    async def _write(self, operation, queue_name, argument):
+        """Queue one push or ack for the next group commit and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        self._writes.append((operation, queue_name, argument, future))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._commit_writes())
+        return await future
+
+    async def _commit_writes(self):
+        while self._writes:
+            writes, self._writes = self._writes, []
+            try:
+                results = await self._run(self._apply, writes)
+            except Exception as e:
+                for *_, future in writes:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats["commits"] += 1
+            for (*_, future), result in zip(writes, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _run(self, func, *args):
+        def locked():
+            with self._lock:
+                return func(*args)
+        return await asyncio.to_thread(locked)
+
+    def _setup(self):
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS OfflineQueues (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue_name TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_offlinequeues_name_seq ON OfflineQueues (queue_name, seq)')
+        self._conn.commit()
+        return [row[0] for row in self._conn.execute('SELECT DISTINCT queue_name FROM OfflineQueues')]
+
+    def _apply(self, writes):
+        """Apply a batch of pushes and acks in one transaction; returns their results in order."""
+        cursor = self._conn.cursor()
+        counts = {}  # queue name -> length, counted once per batch and then kept up to date
+        try:
+            results = [self._push(cursor, counts, queue_name, argument) if operation == "push"
+                       else self._ack(cursor, counts, queue_name, argument)
+                       for operation, queue_name, argument, _ in writes]
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        return results
+
+    def _count(self, cursor, counts, queue_name):
+        if queue_name not in counts:
+            counts[queue_name] = cursor.execute('SELECT COUNT(*) FROM OfflineQueues WHERE queue_name = ?',
+                                                (queue_name,)).fetchone()[0]
+        return counts[queue_name]
+
+    def _push(self, cursor, counts, queue_name, payload):
+        count = self._count(cursor, counts, queue_name)
+        dropped, dropped_upto = 0, None
+        if count >= self.max_items:
+            if self.overflow == "drop_newest":
+                return None, 1, None
+            dropped = count - self.max_items + 1
+            dropped_upto = cursor.execute('''
+                SELECT MAX(seq) FROM (
+                    SELECT seq FROM OfflineQueues WHERE queue_name = ? ORDER BY seq LIMIT ?
+                )
+            ''', (queue_name, dropped)).fetchone()[0]
+            cursor.execute('DELETE FROM OfflineQueues WHERE queue_name = ? AND seq <= ?', (queue_name, dropped_upto))
+        cursor.execute('INSERT INTO OfflineQueues (queue_name, payload, created) VALUES (?, ?, ?)',
+                       (queue_name, payload, time.time()))
+        counts[queue_name] = count - dropped + 1
+        return cursor.lastrowid, dropped, dropped_upto
+
+    def _pending(self, queue_name, after_seq, limit):
+        return self._conn.execute(
+            'SELECT seq, payload FROM OfflineQueues WHERE queue_name = ? AND seq > ? ORDER BY seq LIMIT ?',
+            (queue_name, after_seq, limit)).fetchall()
+
+    def _ack(self, cursor, counts, queue_name, upto_seq):
+        count = self._count(cursor, counts, queue_name)
+        cursor.execute('DELETE FROM OfflineQueues WHERE queue_name = ? AND seq <= ?', (queue_name, upto_seq))
+        counts[queue_name] = count - cursor.rowcount
+        return cursor.rowcount, counts[queue_name]
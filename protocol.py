@@ -0,0 +1,234 @@
+import struct
+import time
+import zlib
+from enum import IntEnum
+
+PROTOCOL_VERSION = 1
+
+# Frame flags
+FLAG_COMPRESSED = 0x01  # Body is zlib-compressed
+FLAG_COMPRESS_OK = 0x02  # HELLO / AUTH_OK: sender accepts compressed bodies
+FLAG_SYNC = 0x04  # HELLO: send the stored conversation after id (the client's last cached message)
+
+# Presence bits for the optional fields, in wire order
+_HAS_ID = 0x01
+_HAS_ACK = 0x02
+_HAS_TIMESTAMP = 0x04
+_HAS_SENDER = 0x08
+_HAS_RECEIVER = 0x10
+_HAS_KIND = 0x20
+_HAS_KEY = 0x40
+_HAS_BODY = 0x80
+
+_HEADER = struct.Struct("!BBBB")  # version, type, flags, presence bits
+_U64 = struct.Struct("!Q")
+_F64 = struct.Struct("!d")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+
+COMPRESS_THRESHOLD = 256  # Bodies shorter than this are never worth compressing
+MAX_BODY_BYTES = 16 * 1024 * 1024  # Upper bound for a decompressed body
+
+
+class MessageType(IntEnum):
+    HELLO = 1         # client -> server: sender=username, body=session token, ack=last reply seen,
+                      #   id=last cached message id (with FLAG_SYNC)
+    AUTH_OK = 2
+    AUTH_FAILED = 3
+    CHAT = 4          # id=message id, sender, receiver, kind=TEXT/IMAGE/AUDIO/VIDEO/FILE, body;
+                      #   queued replies and broadcasts carry their stored message id in ack
+    ACK = 5           # ack=highest message id received
+    FILE_BEGIN = 6    # key=sha256, id=size, kind, body=file name
+    FILE_OFFSET = 7   # key=sha256, id=offset to send from, ack=offset to stop at (0: end of file)
+    FILE_CHUNK = 8    # key=sha256, id=offset, body=data
+    FILE_ACK = 9      # key=sha256, id=bytes written so far
+    FILE_DONE = 10    # key=sha256, body=stored path
+    FILE_ERROR = 11   # key=sha256, body=reason
+    HISTORY = 12      # id=highest message id in the batch, body=pack_batch() of stored CHAT envelopes
+    HISTORY_END = 13  # id=highest message id the sync covered
+    RECONNECT = 14    # server -> client: the server is restarting, reconnect after id milliseconds
+    FILE_GET = 15     # client -> server: key=sha256 of a stored attachment, id=offset to send from
+    FILE_DATA = 16    # server -> client: key=sha256, id=offset, ack=file size, body=data
+
+
+_TYPES = {int(member): member for member in MessageType}
+_BINARY_BODIES = (MessageType.FILE_CHUNK, MessageType.FILE_DATA, MessageType.HISTORY)  # Every other body is UTF-8 text
+
+
+class ProtocolError(Exception):
+    """A frame could not be decoded."""
+
+
+class Envelope:
+    """One typed protocol message. Unset fields cost nothing on the wire."""
+
+    __slots__ = ("type", "id", "ack", "timestamp", "sender", "receiver", "kind", "key", "body", "flags")
+
+    def __init__(self, type, id=0, ack=0, timestamp=0.0, sender="", receiver="", kind="", key="", body=b"",
+                 flags=0):
+        self.type = type
+        self.id = id
+        self.ack = ack
+        self.timestamp = timestamp
+        self.sender = sender
+        self.receiver = receiver
+        self.kind = kind
+        self.key = key
+        self.body = body.encode() if isinstance(body, str) else body
+        self.flags = flags
+
+    @property
+    def text(self):
+        return bytes(self.body).decode()
+
+    def __repr__(self):
+        return (f"Envelope({self.type.name}, id={self.id}, ack={self.ack}, sender={self.sender!r}, "
+                f"receiver={self.receiver!r}, kind={self.kind!r}, key={self.key!r}, body={len(self.body)}B)")
+
+
+def chat(sender, receiver, text, kind="TEXT", id=0, ack=0):
+    """Build a CHAT envelope stamped with the current time."""
+    return Envelope(MessageType.CHAT, id=id, ack=ack, timestamp=time.time(), sender=sender, receiver=receiver,
+                    kind=kind, body=text)
+
+
+class Codec:
+    """Encodes/decodes envelopes for one connection.
+
+    Layout: version, type, flags, presence bits (one byte each), then only the fields that
+    are present: id and ack as u64, timestamp as f64, sender/receiver/kind/key as
+    u16-length UTF-8, body as u32-length bytes. Bodies are zlib-compressed only when both
+    sides negotiated it (compress=True) and it actually saves space; decoding always
+    honours FLAG_COMPRESSED.
+    """
+
+    def __init__(self, compress=False, level=6):
+        self.compress = compress
+        self.level = level
+
+    def encode(self, envelope, compress=None):
+        flags = envelope.flags & ~FLAG_COMPRESSED
+        body = envelope.body
+        if (self.compress if compress is None else compress) and len(body) >= COMPRESS_THRESHOLD:
+            packed = zlib.compress(body, self.level)
+            if len(packed) < len(body):
+                body = packed
+                flags |= FLAG_COMPRESSED
+
+        present = 0
+        parts = [b""]
+        if envelope.id:
+            present |= _HAS_ID
+            parts.append(_U64.pack(envelope.id))
+        if envelope.ack:
+            present |= _HAS_ACK
+            parts.append(_U64.pack(envelope.ack))
+        if envelope.timestamp:
+            present |= _HAS_TIMESTAMP
+            parts.append(_F64.pack(envelope.timestamp))
+        for bit, value in ((_HAS_SENDER, envelope.sender), (_HAS_RECEIVER, envelope.receiver),
+                           (_HAS_KIND, envelope.kind), (_HAS_KEY, envelope.key)):
+            if value:
+                encoded = value.encode()
+                present |= bit
+                parts.append(_U16.pack(len(encoded)))
+                parts.append(encoded)
+        if body:
+            present |= _HAS_BODY
+            parts.append(_U32.pack(len(body)))
+            parts.append(body)
+
+        parts[0] = _HEADER.pack(PROTOCOL_VERSION, envelope.type, flags, present)
+        return b"".join(parts)
+
+    def decode(self, frame):
+        if isinstance(frame, str):
+            raise ProtocolError("text frame on a binary protocol connection")
+        try:
+            version, type_, flags, present = _HEADER.unpack_from(frame)
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"unsupported protocol version {version}")
+            envelope = Envelope(_TYPES[type_], flags=flags)
+            offset = _HEADER.size
+            if present & _HAS_ID:
+                envelope.id, = _U64.unpack_from(frame, offset)
+                offset += 8
+            if present & _HAS_ACK:
+                envelope.ack, = _U64.unpack_from(frame, offset)
+                offset += 8
+            if present & _HAS_TIMESTAMP:
+                envelope.timestamp, = _F64.unpack_from(frame, offset)
+                offset += 8
+            if present & _HAS_SENDER:
+                envelope.sender, offset = _read_str(frame, offset)
+            if present & _HAS_RECEIVER:
+                envelope.receiver, offset = _read_str(frame, offset)
+            if present & _HAS_KIND:
+                envelope.kind, offset = _read_str(frame, offset)
+            if present & _HAS_KEY:
+                envelope.key, offset = _read_str(frame, offset)
+            if present & _HAS_BODY:
+                length, = _U32.unpack_from(frame, offset)
+                offset += 4
+                # Large bodies (file chunks) are handed out as a view instead of a copy
+                body = frame[offset:offset + length] if length < 4096 else memoryview(frame)[offset:offset + length]
+                if len(body) != length:
+                    raise ProtocolError("truncated body")
+                envelope.body = _inflate(body) if flags & FLAG_COMPRESSED else body
+                if envelope.type not in _BINARY_BODIES:
+                    str(envelope.body, "utf-8")  # Reject bad text here, not wherever .text is first read
+        except KeyError as e:
+            raise ProtocolError(f"unknown message type {e}") from e
+        except (struct.error, UnicodeDecodeError, zlib.error) as e:
+            raise ProtocolError(str(e)) from e
+        return envelope
+
+
+_PLAIN = Codec()
+
+
+def pack_batch(envelopes):
+    """Concatenate uncompressed frames, each u32-length-prefixed.
+
+    The batch travels as one frame body, so a negotiated compressor sees the whole run of
+    messages at once, which compresses far better than each one alone.
+    """
+    parts = []
+    for envelope in envelopes:
+        frame = _PLAIN.encode(envelope)
+        parts.append(_U32.pack(len(frame)))
+        parts.append(frame)
+    return b"".join(parts)
+
+
+def unpack_batch(body):
+    body = bytes(body)
+    envelopes = []
+    offset = 0
+    try:
+        while offset < len(body):
+            length, = _U32.unpack_from(body, offset)
+            offset += 4
+            if offset + length > len(body):
+                raise ProtocolError("truncated batch")
+            envelopes.append(_PLAIN.decode(body[offset:offset + length]))
+            offset += length
+    except struct.error as e:
+        raise ProtocolError(str(e)) from e
+    return envelopes
+
+
+def _read_str(frame, offset):
+    length, = _U16.unpack_from(frame, offset)
+    offset += 2
+    if offset + length > len(frame):
+        raise ProtocolError("truncated string")
+    return frame[offset:offset + length].decode(), offset + length
+
+
+def _inflate(body):
+    inflater = zlib.decompressobj()
+    data = inflater.decompress(body, MAX_BODY_BYTES)
+    if inflater.unconsumed_tail:
+        raise ProtocolError("decompressed body too large")
+    return data
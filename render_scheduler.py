@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+from metrics import Histogram
+
+
+class RenderScheduler:
+    """Coalesces page.update() requests into at most one push per frame interval.
+
+    Handlers mutate controls and call request(); the scheduler flushes all pending changes
+    with a single page.update() no sooner than 1/fps after the previous one. When a
+    stats_control (an ft.Text) is given, it is refreshed once a second with the measured
+    updates/second, request-to-paint latency and update cost.
+    """
+
+    def __init__(self, page, fps=30, stats_control=None):
+        self.page = page
+        self.interval = 1.0 / fps
+        self.stats_control = stats_control
+        self.pending = False
+        self.first_request = 0.0
+        self.last_flush = 0.0
+        self.flush_times = deque()  # Flush timestamps within the last second
+        self.stats = {
+            "requests": 0,
+            "updates": 0,
+            "total_latency_ms": 0.0,
+            "total_cost_ms": 0.0,
+            "max_cost_ms": 0.0,
+        }
+        self.cost_ms = Histogram()
+        self._lock = threading.Lock()
+        self._stats_task = None
+
+    def request(self):
+        """Mark the page dirty; safe to call from the page loop or a handler thread."""
+        with self._lock:
+            self.stats["requests"] += 1
+            if self.pending:
+                return
+            self.pending = True
+            self.first_request = time.perf_counter()
+        self.page.run_task(self._flush_later)
+
+    def start_stats(self):
+        if self.stats_control is not None and self._stats_task is None:
+            self._stats_task = self.page.run_task(self._stats_loop)
+
+    def snapshot(self):
+        updates = self.stats["updates"]
+        now = time.perf_counter()
+        while self.flush_times and self.flush_times[0] < now - 1.0:
+            self.flush_times.popleft()
+        return {
+            **self.stats,
+            "updates_per_second": len(self.flush_times),
+            "avg_latency_ms": self.stats["total_latency_ms"] / updates if updates else 0.0,
+            "avg_cost_ms": self.stats["total_cost_ms"] / updates if updates else 0.0,
+        }
+
+    async def _flush_later(self):
+        delay = self.last_flush + self.interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.flush()
+
+    def flush(self):
+        """Push every pending control change now."""
+        with self._lock:
+            requested = self.first_request if self.pending else None
+            self.pending = False
+        started = time.perf_counter()
+        self.page.update()
+        finished = time.perf_counter()
+
+        cost_ms = (finished - started) * 1000
+        self.last_flush = finished
+        self.flush_times.append(finished)
+        self.stats["updates"] += 1
+        if requested is not None:
+            self.stats["total_latency_ms"] += (finished - requested) * 1000
+        self.stats["total_cost_ms"] += cost_ms
+        self.stats["max_cost_ms"] = max(self.stats["max_cost_ms"], cost_ms)
+        self.cost_ms.observe(cost_ms)
+
+    async def _stats_loop(self):
+        while True:
+            await asyncio.sleep(1.0)
+            snapshot = self.snapshot()
+            text = (f"⚡ {snapshot['updates_per_second']} ups · "
+                    f"{snapshot['avg_latency_ms']:.0f} ms latency · {snapshot['avg_cost_ms']:.1f} ms/update")
+            if self.stats_control.value != text:
+                self.stats_control.value = text
+                self.request()
@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+from chat_bus import create_bus
+from metrics import Histogram, LoopMonitor, MetricsRegistry, loop_metrics
+
+PRIORITY_STEP = 60.0  # Each priority level counts as this many extra seconds of waiting
+WAIT_BUCKETS_S = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Bus traffic:
+#   "inbox"             customer message committed -> the customer waits unless already assigned
+#   "agents"            {"agent", "action": online|heartbeat|offline|release, "max_chats", "customers", "customer"}
+#   "assign:<agent>"    {"customer", "reason": new|sticky|reassigned, "waited"} sent by the router;
+#                       reason "revoked" tells the agent to drop a customer now assigned elsewhere
+
+
+class AgentState:
+    def __init__(self, agent_id, max_chats, now):
+        self.agent_id = agent_id
+        self.max_chats = max_chats
+        self.customers = {}  # customer -> clock() when assigned to this agent
+        self.last_seen = now
+        self.last_assigned = 0.0
+        self.version = 0  # Bumped on every load change; older heap entries are stale
+
+    @property
+    def has_capacity(self):
+        return len(self.customers) < self.max_chats
+
+
+class RoutingScheduler:
+    """Assigns waiting customers to agents; pure bookkeeping, no I/O.
+
+    Waiting customers sit in a heap keyed by when they started waiting, minus
+    PRIORITY_STEP seconds per priority level, so higher priority jumps ahead but everyone
+    ages at the same rate and nobody starves. Agents with free capacity sit in a second
+    heap keyed by (load / max_chats, last assignment time): the least loaded agent gets the
+    next customer, ties going to whoever has waited longest for one. Both heaps use lazy
+    deletion, so every operation is O(log n) however many customers are waiting.
+
+    A customer whose conversation was released recently goes back to the same agent when
+    that agent has room (sticky_ttl). When an agent goes offline or stops heartbeating for
+    agent_timeout seconds, their customers go back to the front of the queue.
+    """
+
+    def __init__(self, sticky_ttl=1800.0, agent_timeout=15.0, priority_step=PRIORITY_STEP, clock=time.monotonic):
+        self.sticky_ttl = sticky_ttl
+        self.agent_timeout = agent_timeout
+        self.priority_step = priority_step
+        self.clock = clock
+
+        self.waiting = []        # heap of (key, seq, customer)
+        self.entries = {}        # customer -> seq of their live heap entry
+        self.wait_started = {}   # customer -> clock() when they started waiting
+        self.reassigning = set() # waiting customers whose agent dropped them
+        self.assigned = {}       # customer -> agent_id
+        self.agents = {}         # agent_id -> AgentState
+        self.available = []      # heap of (load ratio, last_assigned, seq, agent_id, version)
+        self.sticky = {}         # customer -> (agent_id, expires)
+        self._seq = itertools.count()
+
+        self.wait_seconds = Histogram(WAIT_BUCKETS_S)
+        self.stats = {"assignments": 0, "sticky_assignments": 0, "reassignments": 0, "released": 0}
+
+    # 🔹 Customers
+
+    def customer_waiting(self, customer, priority=0):
+        """A customer needs an agent; returns the assignments this makes possible."""
+        if customer in self.assigned or customer in self.entries:
+            return []
+        now = self.clock()
+        self.wait_started[customer] = now
+        self._push_waiting(customer, now - priority * self.priority_step)
+        return self.dispatch()
+
+    def release(self, agent_id, customer):
+        """The agent finished with a customer; they will be routed back to this agent for a while."""
+        agent = self.agents.get(agent_id)
+        if self.assigned.get(customer) != agent_id or agent is None:
+            return []
+        del self.assigned[customer]
+        agent.customers.pop(customer, None)
+        self.sticky[customer] = (agent_id, self.clock() + self.sticky_ttl)
+        self.stats["released"] += 1
+        self._agent_changed(agent)
+        return self.dispatch()
+
+    # 🔹 Agents
+
+    def agent_online(self, agent_id, max_chats, customers=()):
+        """Register an agent or refresh its heartbeat.
+
+        customers is the agent's own list of open conversations, so a restarted router
+        rebuilds its assignments from the next round of heartbeats. The list is reconciled
+        both ways: a customer now assigned to another agent (this one was expired meanwhile)
+        is revoked, and a customer the agent no longer lists goes back to the front of the
+        queue, unless it was assigned too recently for the heartbeat to include it.
+        """
+        now = self.clock()
+        agent = self.agents.get(agent_id)
+        if agent is None:
+            agent = self.agents[agent_id] = AgentState(agent_id, max_chats, now)
+            print(f"🧑‍💼 Agent {agent_id} online (max {max_chats} chats)")
+        agent.last_seen = now
+        changed = agent.max_chats != max_chats
+        agent.max_chats = max_chats
+        revoked = []
+        listed = set(customers)
+        for customer in listed:
+            owner = self.assigned.get(customer)
+            if owner is None:
+                self._cancel_waiting(customer)
+                self.assigned[customer] = agent_id
+                agent.customers[customer] = now
+                changed = True
+            elif owner != agent_id:
+                revoked.append((agent_id, customer, "revoked", 0.0))
+        settled = now - self.agent_timeout
+        for customer in [c for c, assigned_at in agent.customers.items() if c not in listed and assigned_at < settled]:
+            del agent.customers[customer]
+            self._requeue(customer)
+            changed = True
+        if changed or not self.available:
+            self._agent_changed(agent)
+        return revoked + self.dispatch()
+
+    def agent_offline(self, agent_id):
+        """Drop an agent and put their customers back at the front of the queue."""
+        agent = self.agents.pop(agent_id, None)
+        if agent is None:
+            return []
+        print(f"⚠️ Agent {agent_id} offline, reassigning {len(agent.customers)} customers")
+        for customer in agent.customers:
+            self._requeue(customer)
+        return self.dispatch()
+
+    def expire_agents(self):
+        """Take agents that stopped heartbeating offline; returns the resulting assignments."""
+        deadline = self.clock() - self.agent_timeout
+        assignments = []
+        for agent_id in [agent_id for agent_id, agent in self.agents.items() if agent.last_seen < deadline]:
+            assignments.extend(self.agent_offline(agent_id))
+        return assignments
+
+    # 🔹 Matching
+
+    def dispatch(self):
+        """Match waiting customers to agents with capacity, best first.
+
+        Returns [(agent_id, customer, reason, waited_seconds)].
+        """
+        assignments = []
+        while self.waiting:
+            key, seq, customer = self.waiting[0]
+            if self.entries.get(customer) != seq:
+                heapq.heappop(self.waiting)  # Stale entry
+                continue
+            agent, reason = self._pick_agent(customer)
+            if agent is None:
+                break
+            heapq.heappop(self.waiting)
+            del self.entries[customer]
+            if customer in self.reassigning:
+                self.reassigning.discard(customer)
+                reason = "reassigned"
+            waited = self.clock() - self.wait_started.pop(customer)
+            self.wait_seconds.observe(waited)
+
+            self.assigned[customer] = agent.agent_id
+            agent.customers[customer] = agent.last_assigned = self.clock()
+            self._agent_changed(agent)
+            self.stats["assignments"] += 1
+            if reason == "sticky":
+                self.stats["sticky_assignments"] += 1
+            assignments.append((agent.agent_id, customer, reason, waited))
+        return assignments
+
+    def _pick_agent(self, customer):
+        sticky = self.sticky.get(customer)
+        if sticky is not None:
+            agent_id, expires = sticky
+            agent = self.agents.get(agent_id)
+            if expires < self.clock():
+                del self.sticky[customer]
+            elif agent is not None and agent.has_capacity:
+                return agent, "sticky"
+
+        while self.available:
+            _, _, _, agent_id, version = self.available[0]
+            agent = self.agents.get(agent_id)
+            if agent is None or agent.version != version or not agent.has_capacity:
+                heapq.heappop(self.available)  # Stale, offline or full
+                continue
+            return agent, "new"
+        return None, None
+
+    def _agent_changed(self, agent):
+        agent.version += 1
+        if agent.has_capacity:
+            load = len(agent.customers) / agent.max_chats
+            heapq.heappush(self.available, (load, agent.last_assigned, next(self._seq), agent.agent_id, agent.version))
+        if len(self.available) > 4 * len(self.agents) + 64:
+            self._compact_agents()
+
+    def _compact_agents(self):
+        self.available = []
+        for agent in self.agents.values():
+            agent.version += 1
+            if agent.has_capacity:
+                load = len(agent.customers) / agent.max_chats
+                self.available.append((load, agent.last_assigned, next(self._seq), agent.agent_id, agent.version))
+        heapq.heapify(self.available)
+
+    def _push_waiting(self, customer, key):
+        seq = next(self._seq)
+        self.entries[customer] = seq
+        heapq.heappush(self.waiting, (key, seq, customer))
+
+    def _requeue(self, customer):
+        """Put a customer their agent dropped back at the front of the queue."""
+        del self.assigned[customer]
+        self.wait_started[customer] = self.clock()
+        self.reassigning.add(customer)
+        self._push_waiting(customer, -math.inf)
+        self.stats["reassignments"] += 1
+
+    def _cancel_waiting(self, customer):
+        if self.entries.pop(customer, None) is not None:
+            self.wait_started.pop(customer, None)
+            self.reassigning.discard(customer)
+
+    # 🔹 Stats
+
+    def snapshot(self):
+        now = self.clock()
+        waits = [now - self.wait_started[customer] for customer in self.entries]
+        capacity = sum(agent.max_chats for agent in self.agents.values())
+        return {
+            **self.stats,
+            "waiting": len(self.entries),
+            "longest_wait_s": max(waits, default=0.0),
+            "avg_wait_s": self.wait_seconds.sum / self.wait_seconds.count if self.wait_seconds.count else 0.0,
+            "agents": len(self.agents),
+            "capacity": capacity,
+            "active_chats": len(self.assigned),
+            "agent_load": {agent_id: len(agent.customers) for agent_id, agent in self.agents.items()},
+        }
+
+
+class Router:
+    """Runs a RoutingScheduler against the bus. Exactly one router should run per deployment."""
+
+    def __init__(self, bus, scheduler=None, check_interval=1.0):
+        self.bus = bus
+        self.scheduler = scheduler or RoutingScheduler()
+        self.check_interval = check_interval
+        self.task = None
+
+    async def start(self):
+        await self.bus.start()
+        self.bus.subscribe("inbox", self.on_inbox)
+        self.bus.subscribe("agents", self.on_agent)
+        # Customers with unread messages were waiting before this router started
+        for queue_name, size in (await self.bus.queue_sizes()).items():
+            if queue_name.startswith("unread:") and size:
+                await self.publish(self.scheduler.customer_waiting(queue_name[len("unread:"):]))
+        self.task = asyncio.create_task(self.expire_loop())
+        print("🧭 Router started")
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def on_inbox(self, event):
+        await self.publish(self.scheduler.customer_waiting(event["sender"], event.get("priority", 0)))
+
+    async def on_agent(self, event):
+        agent_id, action = event["agent"], event["action"]
+        if action in ("online", "heartbeat"):
+            assignments = self.scheduler.agent_online(agent_id, event.get("max_chats", 5), event.get("customers", ()))
+        elif action == "offline":
+            assignments = self.scheduler.agent_offline(agent_id)
+        elif action == "release":
+            assignments = self.scheduler.release(agent_id, event["customer"])
+        else:
+            print(f"❌ Unknown agent action {action!r}, ignoring...")
+            return
+        await self.publish(assignments)
+
+    async def publish(self, assignments):
+        for agent_id, customer, reason, waited in assignments:
+            await self.bus.publish(f"assign:{agent_id}", {"customer": customer, "reason": reason, "waited": waited})
+            print(f"🎯 {customer} -> {agent_id} ({reason}, waited {waited:.1f}s)")
+
+    async def expire_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.publish(self.scheduler.expire_agents())
+
+
+def routing_metrics(scheduler):
+    def collect():
+        snapshot = scheduler.snapshot()
+        return [
+            ("routing_waiting_customers", "gauge", "Customers waiting for an agent", [({}, snapshot["waiting"])]),
+            ("routing_longest_wait_seconds", "gauge", "Longest current wait", [({}, round(snapshot["longest_wait_s"], 3))]),
+            ("routing_assignments_total", "counter", "Customers assigned to agents",
+             [({"reason": "any"}, snapshot["assignments"]), ({"reason": "sticky"}, snapshot["sticky_assignments"]),
+              ({"reason": "reassigned"}, snapshot["reassignments"])]),
+            ("routing_agents", "gauge", "Agents online", [({}, snapshot["agents"])]),
+            ("routing_active_chats", "gauge", "Assigned conversations", [({}, snapshot["active_chats"])]),
+            ("routing_capacity", "gauge", "Total concurrent chats agents accept", [({}, snapshot["capacity"])]),
+            ("routing_wait_seconds", "histogram", "Wait from first message to assignment", scheduler.wait_seconds),
+        ]
+    return collect
+
+
+async def run_router(bus_kind, metrics_port, metrics_log_interval):
+    router = Router(create_bus(bus_kind))
+    monitor = LoopMonitor()
+    registry = MetricsRegistry()
+    registry.register(routing_metrics(router.scheduler))
+    registry.register(loop_metrics(monitor))
+    await router.start()
+    monitor.start()
+    await registry.start(port=metrics_port, log_interval=metrics_log_interval)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await registry.close()
+        await router.close()
+        await router.bus.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assign waiting customers to agent dashboards.")
+    parser.add_argument("--bus", default="sqlite", choices=["memory", "sqlite"])
+    parser.add_argument("--metrics-port", type=int, default=0)
+    parser.add_argument("--metrics-log-interval", type=float, default=0.0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_router(args.bus, args.metrics_port, args.metrics_log_interval))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,106 @@
 import flet as ft
+import argparse
 import asyncio
-import websockets
-import sqlite3
-
-class chatDatabase:
-    def __init__(self):
-
-        conn = sqlite3.connect('chat_messages.db')
-        cursor = conn.cursor()
-
-        # 🔹 Create table to store chat messages
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS Messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT NOT NULL,
-                receiver TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        conn.commit()
-        conn.close()
-        print("✅ Chat database initialized successfully!")
-chatDatabase()
+import signal
+import sys
+import time
+from broadcast import GroupDirectory, is_audience
+from chat_bus import create_bus
+from connection_server import ConnectionServer, server_metrics
+from lifecycle import DrainController
+from message_search import MessageSearch
+from message_store import ChatHistory, MessageWriter, chatDatabase
+from metrics import LoopMonitor, MetricsRegistry, loop_metrics, queue_metrics, render_metrics, writer_metrics
+from render_scheduler import RenderScheduler
+from routing import Router, routing_metrics
+from sessions import SessionRegistry
+
+MAX_RENDERED_MESSAGES = 300  # Rows kept in chat_box; older/newer ones are re-fetched on scroll
+AGENT_HEARTBEAT = 5.0  # Seconds between heartbeats to the router; it drops agents silent for 15s
+PRESENCE_SWEEP = 10.0  # Seconds between checks for customers of workers that stopped heartbeating
+
+def parse_server_args():
+    parser = argparse.ArgumentParser(description="Customer support admin dashboard.")
+    parser.add_argument("--bus", default="memory", choices=["memory", "sqlite"],
+                        help="memory embeds the WebSocket server; sqlite attaches to connection_server.py workers")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics on 127.0.0.1:PORT/metrics (e.g. 9100); 0 disables")
+    parser.add_argument("--metrics-log-interval", type=float, default=0.0,
+                        help="seconds between JSON metrics log lines; 0 disables")
+    parser.add_argument("--agent", help="join routing under this agent name and only list assigned customers")
+    parser.add_argument("--max-chats", type=int, default=5, help="conversations the router assigns to this agent at once")
+    parser.add_argument("--router", action="store_true",
+                        help="run the assignment router in this dashboard (implied by --agent with --bus memory)")
+    options, _ = parser.parse_known_args(sys.argv[1:])
+    return options
 
 class ServerApp:
     def __init__(self, page: ft.Page):
         self.page = page
         self.page.title = "Customer Support Server"
-        self.active_clients = {}
-        self.message_queues = {}  # ✅ NEW: Store messages for each client
-        self.client_notifications = {}  # ✅ NEW: Track clients with pending messages
+        # 🔹 One session per (customer, worker holding their sockets), plus who has unread messages
+        self.sessions = SessionRegistry()
         self.active_session = None
 
+        # 🗃 One long-lived writer thread batches all message inserts off the event loop
+        self.message_writer = MessageWriter()
+        self.message_writer.start()
+
+        # 📡 Presence, routing and unread queues go through the bus. By default the
+        # connection tier runs embedded in this process; with --bus sqlite the dashboard
+        # attaches to workers started by connection_server.py instead.
+        options = parse_server_args()
+        self.options = options
+        self.bus = create_bus(options.bus)
+        self.connection_server = None
+        if options.bus == "memory":
+            self.connection_server = ConnectionServer(self.bus, message_writer=self.message_writer)
+
+        # 🧭 Multi-agent routing: with --agent this dashboard is one agent among several and
+        # lists only the customers the router assigned to it; without it, it sees everyone.
+        self.agent_id = options.agent
+        self.assigned_customers = set()
+        self.router = None
+        if options.router or (self.agent_id and options.bus == "memory"):
+            self.router = Router(self.bus)
+
+        # 📜 Paginated history for the selected client
+        self.chat_history = ChatHistory()
+        self.rendered_ids = set()  # Message ids currently shown in chat_box
+        self.history_exhausted = False  # Oldest page already rendered
+        self.has_newer = False  # Newest rows were trimmed off the bottom
+        self.history_loading = None  # Client whose page is being fetched
+
+        # 📢 Broadcasts go to everyone online, this agent's customers or a named group
+        self.groups = GroupDirectory()
+
+        # 🔎 Full-text search across every conversation
+        self.message_search = MessageSearch()
+        self.search_args = None  # (query, client) of the results on screen
+        self.search_cursor = None  # Next page of those results, if any
+
         # UI Components
         self.server_status = ft.Text("🔴 Server Offline", color="red")
+        self.render_stats = ft.Text("", size=10, color="grey")
+        # 🎛 All UI pushes are coalesced into at most one page.update() per frame
+        self.renderer = RenderScheduler(self.page, fps=30, stats_control=self.render_stats)
+        self.client_options = {}  # username -> ft.dropdown.Option, updated in place
+
+        # 📊 Metrics are gathered from the components' own counters only when scraped/logged
+        self.loop_monitor = LoopMonitor()
+        if self.connection_server is not None:
+            self.metrics = server_metrics(self.connection_server, self.loop_monitor)
+        else:
+            self.metrics = MetricsRegistry()
+            for source in (writer_metrics(self.message_writer), queue_metrics(self.bus), loop_metrics(self.loop_monitor)):
+                self.metrics.register(source)
+        self.metrics.register(render_metrics(self.renderer))
+        self.metrics.register(lambda: [("online_clients", "gauge", "Customers connected to any worker",
+                                        [({}, len(self.sessions.users()))])])
+        if self.router is not None:
+            self.metrics.register(routing_metrics(self.router.scheduler))
         self.chat_box = ft.Container(
-            content= ft.Column(scroll=True),
+            content= ft.Column(scroll=True, on_scroll=self.on_chat_scroll, on_scroll_interval=100),
             border_radius=10,
             width=self.page.width * 0.6,
             height=self.page.height * 0.6,
@@ -46,12 +109,26 @@ class ServerApp:
         )
         self.message_input = ft.TextField(label="Type a reply...", multiline=True, border_radius=10, bgcolor="grey", dense=True)
         self.send_button = ft.ElevatedButton("Send", on_click=self.send_message, elevation=10,)
+        self.audience_dropdown = ft.Dropdown(label="Broadcast to", options=[], width=220, dense=True,
+                                             border_radius=10, bgcolor="grey", on_focus=self.load_audiences)
+        self.broadcast_button = ft.ElevatedButton("Broadcast", icon=ft.Icons.CAMPAIGN,
+                                                  on_click=self.broadcast_message, elevation=10)
 
         self.history_button = ft.IconButton(
             icon=ft.Icons.HISTORY, 
             tooltip="Load Chat History", 
             on_click=self.load_chat_history
         )
+        self.release_button = ft.IconButton(
+            icon=ft.Icons.TASK_ALT,
+            tooltip="Close Conversation",
+            on_click=self.release_chat,
+            visible=bool(self.agent_id)
+        )
+        self.search_input = ft.TextField(label="Search messages (\"phrase\", prefix*)", dense=True, width=400,
+                                         border_radius=10, on_submit=self.search_messages)
+        self.search_scope = ft.Checkbox(label="Selected client only", value=False)
+        self.search_results = ft.Column(scroll=True, height=150, visible=False)
         self.client_selection_dropdown = ft.Dropdown(
             label="Select Client to Respond",
             options=[],
@@ -70,7 +147,7 @@ class ServerApp:
 
         self.wrap_bottom_control = ft.Container(
             ft.Row(
-                controls=[self.message_input, self.send_button],
+                controls=[self.message_input, self.send_button, self.audience_dropdown, self.broadcast_button],
                 alignment=ft.MainAxisAlignment.SPACE_EVENLY,
                 vertical_alignment=ft.CrossAxisAlignment.CENTER
             ),
@@ -83,7 +160,7 @@ class ServerApp:
         self.wrap_top_control = ft.Container(
             content=ft.Row(
                 controls=[
-                    self.client_selection_dropdown, self.history_button
+                    self.client_selection_dropdown, self.history_button, self.release_button
                 ],
                 alignment=ft.MainAxisAlignment.SPACE_EVENLY,
                 vertical_alignment=ft.CrossAxisAlignment.CENTER
@@ -96,8 +173,10 @@ class ServerApp:
             content=ft.Container(
                 content=ft.Column(
                     controls=[
-                        self.server_status,
+                        ft.Row([self.server_status, self.render_stats], alignment=ft.MainAxisAlignment.CENTER),
                         self.wrap_top_control,
+                        ft.Row([self.search_input, self.search_scope], alignment=ft.MainAxisAlignment.CENTER),
+                        self.search_results,
                         self.chat_box,
                         self.wrap_bottom_control
                     ],
@@ -114,133 +193,326 @@ class ServerApp:
         self.page.update()
 
     async def start_server(self):
-        """Start the WebSocket server using the class-level handle_connection method."""
+        """Attach to the bus and, in embedded mode, start the WebSocket connection tier."""
+        await self.bus.start()
+        self.bus.subscribe("inbox", self.on_inbox)
+        self.bus.subscribe("presence", self.on_presence)
+        for username, node in await self.bus.presence():
+            self.sessions.open(username, conn_id=(username, node), node=node)
+        self.update_client_list()
+        self.page.run_task(self.sweep_presence)
+        await self.load_audiences()
+        if self.router is not None:
+            await self.router.start()
+        if self.agent_id:
+            self.bus.subscribe(f"assign:{self.agent_id}", self.on_assign)
+            self.page.run_task(self.agent_heartbeat)
+
         self.server_status.value = "🟢 Server Online"
         self.server_status.color = "green"
-        self.page.update()
-
-        # Now using self.handle_connection for all connections
-        server = await websockets.serve(self.handle_connection, "localhost", 8765)
-        await server.wait_closed()
+        self.renderer.request()
+        self.renderer.start_stats()
+        self.loop_monitor.start()
+        await self.metrics.start(port=self.options.metrics_port, log_interval=self.options.metrics_log_interval)
 
-    async def handle_connection(self, websocket):
-        """Handles incoming WebSocket connections and authenticates clients before allowing access."""
+        if self.connection_server is None:
+            return
+        # 🚰 SIGTERM/SIGINT drain the embedded server: clients are told to come back staggered
+        lifecycle = DrainController(self.connection_server)
+        lifecycle.install_signal_handlers()
         try:
-            # 🔍 Debugging: Show received authentication details BEFORE processing
-            auth_data = await websocket.recv()
-
-            # ✅ Extract username and session token
-            username, session_token = auth_data.split("|", 1)
-
-            # 🔹 Validate session token
-            conn = sqlite3.connect('session_tokens.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT username FROM Sessions WHERE username = ? AND session_token = ?', (username, session_token))
-            result = cursor.fetchone()
-            conn.close()
-
-            if not result:
-                await websocket.send("AUTH_FAILED")
-                await websocket.close()
-                return  # Stop processing
-
-            # ✅ Authentication successful: Store active connection
-            self.active_clients[username] = websocket
-            print(f"🟢 Authenticated and connected: {username}")
-           
-           # In case not previously initialized, set up defaults
-            if username not in self.message_queues:
-                self.message_queues[username] = []
-            if username not in self.client_notifications:
-                self.client_notifications[username] = False
-
-            # 🔹 Notify client that authentication succeeded
-            await websocket.send("AUTH_SUCCESS")
-            self.update_client_list()
-
-            # 📡 Handle incoming messages
-            async for message in websocket:
-                try:
-                    sender, receiver, message_text = message.split("|", 2)
-                except ValueError:
-                    print("❌ Malformed message received, ignoring...")
-                    continue
-                    
-                # Store the message in the database (keeping your persistence intact)
-                try:
-                    conn = sqlite3.connect('chat_messages.db')
-                    cursor = conn.cursor()
-                    cursor.execute('INSERT INTO Messages (sender, receiver, message) VALUES (?, ?, ?)',
-                       (sender, receiver, message_text))
-                    conn.commit()
-                    conn.close()
-                except Exception as db_error:
-                    print("🔥 Database error:", db_error)
-
-                # --- Safe dictionary initialization begin ---
-                if sender not in self.message_queues:
-                    self.message_queues[sender] = []
-                if sender not in self.client_notifications:
-                    self.client_notifications[sender] = False
-                # --- Safe dictionary initialization end ---
-
-                if self.active_session == sender:
-                    self.chat_box.content.controls.append(
-                        ft.Row(controls=[ft.Text(f"{sender}: {message_text}", color="blue")],
-                               alignment=ft.MainAxisAlignment.START)
-                    )
-                    self.page.update()
-                else:
-                    # Not the active session: queue the message and set a notification flag.
-                    self.message_queues[sender].append(f"{sender}: {message_text}")
-                    self.client_notifications[sender] = True
-                    self.update_client_list()              
-                            
-        except websockets.exceptions.ConnectionClosed:
-            print("⚠️ Connection closed for", username)
-            if username in self.active_clients:  # username from authentication scope
-                self.active_clients.pop(username, None)
-            self.update_client_list()
-
-        except Exception as e:
-            print(f"🔥 Unexpected server error: {e}")
+            await self.connection_server.serve_forever("localhost", 8765)
+        finally:
+            # 🔹 Flush pending inserts before the process goes away
+            await self.message_writer.close()
+        if lifecycle.drain_task is not None:
+            await lifecycle.drain_task
+            lifecycle.restore_signal_handlers()
+            signal.raise_signal(signal.SIGTERM)  # Drained: now exit as the signal asked
+
+    def on_presence(self, event):
+        """A customer connected to or disconnected from some worker."""
+        username, conn_id = event["username"], (event["username"], event["node"])
+        if event["online"]:
+            if self.sessions.get(conn_id) is None:
+                self.sessions.open(username, conn_id=conn_id, node=event["node"])
+                print(f"🟢 Authenticated and connected: {username} (on {event['node']})")
+        elif self.sessions.close(conn_id) is not None:
+            print(f"⚠️ Connection closed for {username} (on {event['node']})")
+        self.refresh_client_option(username)
+
+    async def sweep_presence(self):
+        """Drop customers whose worker crashed: it never publishes their going offline, but
+        its heartbeats stop and the bus expires their presence."""
+        while True:
+            await asyncio.sleep(PRESENCE_SWEEP)
+            checked = time.monotonic()
+            try:
+                live = set(await self.bus.presence())
+            except Exception as e:
+                print("🔥 Presence sweep failed:", e)
+                continue
+            stale = [session for session in list(self.sessions.by_conn.values())
+                     if session.conn_id not in live and session.connected_at < checked]  # Not opened mid-query
+            for session in stale:
+                self.sessions.close(session.conn_id)
+                print(f"⌛ Presence expired for {session.username} (on {session.node})")
+                self.refresh_client_option(session.username)
+
+    async def on_inbox(self, event):
+        """A customer message was committed by a worker."""
+        sender, message_text, row_id = event["sender"], event["text"], event["id"]
+
+        if self.active_session == sender:
+            self.append_chat_row(
+                ft.Row(controls=[ft.Text(f"{sender}: {message_text}", color="blue")],
+                       alignment=ft.MainAxisAlignment.START),
+                row_id
+            )
+            self.renderer.request()
+            await self.bus.drain(f"unread:{sender}")  # Read here, so no longer waiting for anyone
+        else:
+            # Not the active session: the worker queued it as unread; set a notification flag.
+            if self.sessions.mark_unread(sender):
+                self.refresh_client_option(sender)
+
+    def history_row(self, msg):
+        """Build a chat_box row for one (id, sender, receiver, message, timestamp) history record."""
+        msg_id, sender, receiver, message, timestamp = msg
+        return ft.Row(
+            controls=[ft.Text(f"{timestamp} | {sender} → {receiver}: {message}", color="gray")],
+            alignment=ft.MainAxisAlignment.START,
+            data=msg_id
+        )
 
-    def load_chat_history(self, e):
-        """Fetches and displays previous chat messages."""
-        username = "server"  # Change this dynamically based on the logged-in user
+    def append_chat_row(self, row, row_id=None):
+        """Append a live row; row_id is a committed id or the writer's future for a pending insert."""
+        if self.has_newer:
+            # Scrolled back: rows between the window and this one are not rendered, and paging
+            # on from a live row would skip them. It is stored, so a newer page brings it in.
+            return
+        self.chat_box.content.controls.append(row)
+        if asyncio.isfuture(row_id):
+            session = self.active_session
+            row_id.add_done_callback(lambda future: self.note_row_id(row, session, future.result()))
+        elif row_id is not None:
+            self.note_row_id(row, self.active_session, row_id)
+        if len(self.chat_box.content.controls) > MAX_RENDERED_MESSAGES:
+            self.trim_chat_rows(from_top=True)
+
+    def note_row_id(self, row, session, row_id):
+        """Tag a rendered row with its committed id so history pages can skip it."""
+        if row_id is None or session != self.active_session:
+            return
+        row.data = row_id
+        if not any(control is row for control in self.chat_box.content.controls):
+            return  # Trimmed while the insert was pending; history pages bring it back
+        self.rendered_ids.add(row.data)
+
+    def trim_chat_rows(self, from_top):
+        """Keep chat_box within MAX_RENDERED_MESSAGES, dropping rows from one end."""
+        controls = self.chat_box.content.controls
+        excess = len(controls) - MAX_RENDERED_MESSAGES
+        if excess <= 0:
+            return
+        dropped = controls[:excess] if from_top else controls[-excess:]
+        if from_top:
+            del controls[:excess]
+            self.history_exhausted = False  # Dropped rows can be fetched again on scroll up
+        else:
+            del controls[-excess:]
+            self.has_newer = True
+        for row in dropped:
+            self.rendered_ids.discard(row.data)
+
+    def edge_id(self, newest):
+        """Id of the oldest (or newest) committed row currently rendered, if any."""
+        controls = self.chat_box.content.controls
+        for row in (reversed(controls) if newest else controls):
+            if row.data is not None:
+                return row.data
+        return None
+
+    async def load_chat_history(self, e=None):
+        """Prepend the next older page of the selected client's history."""
+        username = self.active_session
+        if not username or self.history_loading == username or self.history_exhausted:
+            return
 
-        conn = sqlite3.connect('chat_messages.db')
-        cursor = conn.cursor()
+        self.history_loading = username
+        try:
+            page = await self.chat_history.load_page(username, before_id=self.edge_id(newest=False))
+            if username != self.active_session:
+                return  # Selection changed while the page was loading
+            self.history_exhausted = len(page) < self.chat_history.page_size
+
+            # 🔹 Pages come newest-first; render oldest at the top and skip rows already shown
+            rows = [self.history_row(msg) for msg in reversed(page) if msg[0] not in self.rendered_ids]
+            self.chat_box.content.controls[0:0] = rows
+            self.rendered_ids.update(row.data for row in rows)
+            self.trim_chat_rows(from_top=False)
+            self.renderer.request()
+        finally:
+            if self.history_loading == username:
+                self.history_loading = None
+        print(f"✅ Loaded {len(rows)} history messages for {username}")
+
+    async def load_newer_history(self):
+        """Re-append rows that were trimmed off the bottom while scrolling back in time."""
+        username = self.active_session
+        newest_id = self.edge_id(newest=True)
+        if not username or self.history_loading == username or newest_id is None:
+            return
 
-        cursor.execute('SELECT sender, receiver, message, timestamp FROM Messages WHERE sender = ? OR receiver = ? ORDER BY timestamp ASC', 
-           (username, username))
-    
-        chat_history = cursor.fetchall()
-        conn.close()
-
-        # 🔹 Display messages in the UI
-        for msg in chat_history:
-            self.chat_box.content.controls.append(ft.Row(
-                controls=[ft.Text(f"{msg[3]} | {msg[0]} → {msg[1]}: {msg[2]}", color="gray")],
-                alignment=ft.MainAxisAlignment.START
+        self.history_loading = username
+        try:
+            page = await self.chat_history.load_page(username, after_id=newest_id)
+            if username != self.active_session:
+                return
+            self.has_newer = len(page) == self.chat_history.page_size
+            rows = [self.history_row(msg) for msg in page if msg[0] not in self.rendered_ids]
+            self.chat_box.content.controls.extend(rows)
+            self.rendered_ids.update(row.data for row in rows)
+            self.trim_chat_rows(from_top=True)
+            self.renderer.request()
+        finally:
+            if self.history_loading == username:
+                self.history_loading = None
+
+    async def on_chat_scroll(self, e):
+        """Stream older pages in at the top edge, newer ones at the bottom edge."""
+        if e.pixels <= e.min_scroll_extent + 5:
+            await self.load_chat_history()
+        elif self.has_newer and e.pixels >= e.max_scroll_extent - 5:
+            await self.load_newer_history()
+
+    async def search_messages(self, e=None):
+        """Run the query in the search box; results replace any previous ones."""
+        query = self.search_input.value.strip()
+        self.search_results.controls.clear()
+        self.search_cursor = None
+        if not query:
+            self.search_results.visible = False
+            self.renderer.request()
+            return
+        client = self.active_session if self.search_scope.value else None
+        self.search_args = (query, client)
+        await self.load_more_results()
+
+    async def load_more_results(self, e=None):
+        """Append the next page of results for the current query."""
+        query, client = self.search_args
+        rows, cursor = await self.message_search.load_results(query, client, cursor=self.search_cursor)
+        if self.search_args != (query, client):
+            return  # A newer search started while this page was loading
+        self.search_cursor = cursor
+
+        controls = self.search_results.controls
+        if controls and controls[-1].data == "more":
+            controls.pop()
+        for msg_id, sender, receiver, _, timestamp, snippet in rows:
+            if is_audience(receiver):
+                # A broadcast belongs to no single conversation; show it without a link
+                controls.append(ft.Text(f"📢 {timestamp} | {sender} → {receiver}: {snippet}", color="grey"))
+                continue
+            customer = receiver if sender == "server" else sender
+            controls.append(ft.TextButton(
+                f"{timestamp} | {sender} → {receiver}: {snippet}",
+                on_click=lambda e, customer=customer: self.page.run_task(self.open_search_result, customer)
             ))
-    
-        self.page.update()
-        print(f"✅ Chat history loaded for {username}")
+        if not controls:
+            controls.append(ft.Text("No messages found.", color="grey"))
+        if cursor is not None:
+            controls.append(ft.TextButton("More results…", on_click=self.load_more_results, data="more"))
+        self.search_results.visible = True
+        self.renderer.request()
+
+    async def open_search_result(self, customer):
+        """Jump to the conversation a search result belongs to."""
+        self.client_selection_dropdown.value = customer
+        await self.activate_chat_session(None)
+
+    async def agent_heartbeat(self):
+        """Tell the router this agent is alive, its capacity and which conversations it holds."""
+        action = "online"
+        while True:
+            await self.bus.publish("agents", {"agent": self.agent_id, "action": action,
+                                              "max_chats": self.options.max_chats,
+                                              "customers": sorted(self.assigned_customers)})
+            action = "heartbeat"
+            await asyncio.sleep(AGENT_HEARTBEAT)
+
+    def on_assign(self, event):
+        """The router gave this agent a waiting customer, or took back one assigned elsewhere."""
+        customer = event["customer"]
+        if event["reason"] == "revoked":
+            # This agent was expired meanwhile and the customer went to someone else
+            if customer in self.assigned_customers:
+                self.close_chat(customer)
+                print(f"↩️ {customer} is now with another agent")
+            return
+        self.assigned_customers.add(customer)
+        self.sessions.mark_unread(customer)
+        self.refresh_client_option(customer)
+        print(f"🎯 Assigned {customer} ({event['reason']}, waited {event['waited']:.0f}s)")
+
+    async def release_chat(self, e):
+        """Close the selected conversation so the router can give this agent the next customer."""
+        customer = self.active_session
+        if customer not in self.assigned_customers:
+            return
+        self.close_chat(customer)
+        await self.bus.publish("agents", {"agent": self.agent_id, "action": "release", "customer": customer})
+
+    def close_chat(self, customer):
+        """Stop listing an assigned customer, clearing the transcript if it is the open one."""
+        self.assigned_customers.discard(customer)
+        if self.active_session == customer:
+            self.active_session = None
+            self.client_selection_dropdown.value = None
+            self.chat_box.content.controls.clear()
+            self.rendered_ids.clear()
+        self.refresh_client_option(customer)
+        self.renderer.request()
+
+    def is_listed(self, username):
+        """Agents list their assigned customers (online or not); a lone dashboard lists who is online."""
+        if self.agent_id:
+            return username in self.assigned_customers
+        return self.sessions.is_online(username)
 
     def update_client_list(self):
-        # Build a mapping from the display text (option.text) to the clean username.
-        self.option_map = {}
-        new_options = []
-        for username in self.active_clients.keys():
-            display_text = f"{username}{' 🔔' if self.client_notifications.get(username, False) else ''}"
-            new_options.append(ft.dropdown.Option(text=display_text))
-            self.option_map[display_text] = username  # store the mapping
-        self.client_selection_dropdown.options = new_options
-        self.page.update()
+        """Bring the dropdown in line with the online sessions (used after a full presence reload)."""
+        for username in list(self.client_options):
+            if not self.is_listed(username):
+                self.refresh_client_option(username)
+        for username in list(self.sessions.users()):
+            self.refresh_client_option(username)
+
+    def refresh_client_option(self, username):
+        """Add, relabel or remove one client's dropdown option without rebuilding the rest."""
+        option = self.client_options.get(username)
+        if not self.is_listed(username):
+            if option is not None:
+                self.client_selection_dropdown.options.remove(option)
+                del self.client_options[username]
+                self.renderer.request()
+            return
 
-    def activate_chat_session(self, e):
-        """When a client is selected in the dropdown, load that client's queued messages."""
+        display_text = f"{username}{' 🔔' if self.sessions.has_unread(username) else ''}"
+        if self.agent_id and not self.sessions.is_online(username):
+            display_text += " 💤"  # Assigned but disconnected; replies wait in the offline queue
+        if option is None:
+            option = ft.dropdown.Option(key=username, text=display_text)
+            self.client_options[username] = option
+            self.client_selection_dropdown.options.append(option)
+        elif option.text == display_text:
+            return
+        option.text = display_text
+        self.renderer.request()
+
+    async def activate_chat_session(self, e):
+        """When a client is selected in the dropdown, show its newest history page and queued messages."""
         if not self.client_selection_dropdown.value:
             return
 
@@ -251,25 +523,33 @@ class ServerApp:
         
         # Clear previous chat window.
         self.chat_box.content.controls.clear()
+        self.rendered_ids.clear()
+        self.history_exhausted = False
+        self.has_newer = False
+
+        # Newest history page first; older pages stream in on scroll
+        await self.load_chat_history()
 
-        # Load queued messages (if any)
-        queued = self.message_queues.get(selected_client, [])
+        # Load queued messages (if any) that were not already committed into that page
+        # (draining the bus queue also clears it for every other dashboard)
+        queued = await self.bus.drain(f"unread:{selected_client}")
         for msg in queued:
-            self.chat_box.content.controls.append(
+            if msg["id"] in self.rendered_ids:
+                continue
+            self.append_chat_row(
                 ft.Row(
-                    controls=[ft.Text(msg, color="blue")],
+                    controls=[ft.Text(msg["text"], color="blue")],
                     alignment=ft.MainAxisAlignment.START
-                )
+                ),
+                msg["id"]
             )
-        # After loading, clear the queue and remove notification.
-        self.message_queues[selected_client] = []
-        self.client_notifications[selected_client] = False
+        # After loading, remove notification.
+        self.sessions.clear_unread(selected_client)
+        self.refresh_client_option(selected_client)
 
-        self.update_client_list()
-    
         # Additionally, force the selected dropdown value to update without icon.
         self.client_selection_dropdown.value = selected_client
-        self.page.update()
+        self.renderer.request()
 
     async def send_message(self, e):
         """When the server clicks Send, dispatch a reply to the active session."""
@@ -283,25 +563,94 @@ class ServerApp:
             return
 
         selected_client = self.client_selection_dropdown.value.replace(" 🔔", "")
-        if selected_client in self.active_clients:
-            try:
-                # Send message to client
-                await self.active_clients[selected_client].send(f"Server: {message}")
-            except Exception as e:
-                print("Error sending to client:", e)
+
+        # Persist the reply first: its stored id travels with it, so a client that also
+        # syncs history can tell the two copies apart
+        row_id = await self.message_writer.submit("server", selected_client, message)
+
+        # Display the message on the server's UI.
+        text = ft.Text(f"Server: {message}", color="green")
+        self.append_chat_row(ft.Row(controls=[text], alignment=ft.MainAxisAlignment.END), row_id)
+        self.message_input.value = ""
+        self.renderer.request()
+
+        stored_id = await row_id
+        if stored_id is None:
+            # Not in the history, so the client could not tell a delivered copy from a synced one
+            text.value, text.color = f"⚠️ Not sent, could not be saved: {message}", "red"
+            self.renderer.request()
+            print(f"🔥 Reply to {selected_client} was not stored, not sending it.")
+            return
+
+        try:
+            # 📬 Queue the reply durably; it stays queued until the client acks it
+            if await self.bus.enqueue(f"outbox:{selected_client}", {"text": message, "id": stored_id}) is None:
+                print(f"🚫 Offline queue full for {selected_client}, reply kept in history only.")
                 return
+            # Nudge every worker holding one of the client's sockets (offline clients get it on reconnect)
+            nodes = {session.node for session in self.sessions.for_user(selected_client)}
+            for node in nodes:
+                await self.bus.publish(f"deliver:{node}", {"receiver": selected_client})
+            if not nodes:
+                print(f"📥 {selected_client} is offline, reply queued for delivery on reconnect.")
+        except Exception as e:
+            print("Error sending to client:", e)
+
+    async def load_audiences(self, e=None):
+        """Fill the broadcast picker; groups are re-read so new ones show up without a restart."""
+        options = [ft.dropdown.Option(key="broadcast:online", text="All online customers")]
+        if self.agent_id:
+            options.append(ft.dropdown.Option(key=f"broadcast:{self.agent_id}", text="My customers"))
+        for name, count in (await self.groups.load_groups()).items():
+            options.append(ft.dropdown.Option(key=f"group:{name}", text=f"Group {name} ({count})"))
+        self.audience_dropdown.options = options
+        self.renderer.request()
+
+    async def broadcast_recipients(self, audience):
+        if audience == "broadcast:online":
+            return sorted(self.sessions.users())
+        if audience.startswith("group:"):
+            return await self.groups.load_members(audience[len("group:"):])
+        return sorted(self.assigned_customers)
+
+    async def broadcast_message(self, e):
+        """Send the typed message to every customer in the chosen audience at once.
+
+        It is stored as one Messages row addressed to the audience plus its recipient set,
+        and published once; each worker encodes it once and fans it out to the recipients it
+        holds. Offline recipients receive it with their history sync on reconnect.
+        """
+        message = self.message_input.value.strip()
+        audience = self.audience_dropdown.value
+        if not message or not audience:
+            print("No broadcast audience selected!")
+            return
+        recipients = await self.broadcast_recipients(audience)
+        if not recipients:
+            print(f"📭 Nobody to broadcast to in {audience}")
+            return
 
-            # Display the message on the server's UI.
-            self.chat_box.content.controls.append(
+        started = time.perf_counter()
+        row_id = await (await self.message_writer.submit("server", audience, message, recipients=recipients))
+        if row_id is None:
+            return  # The writer already reported the database error
+        stored_ms = (time.perf_counter() - started) * 1000
+        await self.bus.publish("broadcast", {"id": row_id, "receiver": audience, "text": message,
+                                             "recipients": recipients})
+        print(f"📢 Broadcast {row_id} to {len(recipients)} recipients in {audience} "
+              f"(stored in {stored_ms:.1f} ms, published in {(time.perf_counter() - started) * 1000 - stored_ms:.1f} ms)")
+
+        self.message_input.value = ""
+        if self.active_session in recipients:
+            self.append_chat_row(
                 ft.Row(
-                    controls=[ft.Text(f"Server: {message}", color="green")],
+                    controls=[ft.Text(f"Server → {audience}: {message}", color="green")],
                     alignment=ft.MainAxisAlignment.END
-                )
+                ),
+                row_id
             )
-            self.message_input.value = ""
-            self.page.update()
-        else:
-            print("Selected client not found in active clients.")
+        self.renderer.request()
 
 if __name__ == "__main__":
+    chatDatabase()
     ft.app(target=ServerApp)
@@ -0,0 +1,209 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import Histogram
+
+SESSION_DB_PATH = 'session_tokens.db'
+
+
+class SessionAuthenticator:
+    """Validates session tokens against an in-memory copy of the Sessions table.
+
+    The table is loaded once into a hash map and kept fresh incrementally: triggers log
+    the id of every inserted, updated or deleted row to SessionChanges, and a refresh
+    re-reads just those rows, so a revoked or rotated token is dropped by the next refresh
+    rather than the next full reload. Unknown credentials are negatively cached for a short TTL
+    so a reconnect storm of bad tokens never reaches SQLite. All database work runs in a
+    worker thread, never on the event loop; what it read is only recorded as seen once it
+    has been applied.
+    """
+
+    def __init__(self, db_path=SESSION_DB_PATH, refresh_interval=2.0, full_reload_interval=300.0,
+                 negative_ttl=5.0, negative_cache_size=10000):
+        self.db_path = db_path
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+        self.negative_ttl = negative_ttl
+        self.negative_cache_size = negative_cache_size
+
+        self.sessions = {}                   # (username, session_token) -> Sessions.id
+        self.by_id = {}                      # Sessions.id -> (username, session_token)
+        self.negative_cache = OrderedDict()  # (username, session_token) -> expiry (LRU order)
+        self.last_change = 0  # Highest SessionChanges.seq applied
+        self.data_version = None
+        self.last_refresh = 0.0
+        self.last_full_reload = 0.0
+        self._conn = None
+        self._refresh_task = None
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "attempts": 0,
+            "successes": 0,
+            "failures": 0,
+            "cache_hits": 0,
+            "negative_hits": 0,
+            "misses": 0,
+            "refreshes": 0,
+            "full_reloads": 0,
+            "total_latency_ms": 0.0,
+            "max_latency_ms": 0.0,
+        }
+        self.latency_ms = Histogram()
+
+    async def load(self):
+        """Create the table/index if needed and load every session into memory."""
+        await self._refresh(force_full=True)
+
+    async def authenticate(self, username, session_token):
+        """Return True when the username/token pair is a valid session."""
+        started = time.perf_counter()
+        key = (username, session_token)
+        self.stats["attempts"] += 1
+
+        if self.data_version is None:
+            await self.load()
+        elif time.monotonic() - self.last_refresh > self.refresh_interval:
+            self._schedule_refresh()  # Serve from memory, refresh in the background
+
+        if key in self.sessions:
+            self.stats["cache_hits"] += 1
+            valid = True
+        elif self._negative_hit(key):
+            self.stats["negative_hits"] += 1
+            valid = False
+        else:
+            # 🔹 Unknown pair: the token may have been issued since the last refresh
+            self.stats["misses"] += 1
+            await self._refresh()
+            valid = key in self.sessions
+            if not valid:
+                self._remember_failure(key)
+
+        self.stats["successes" if valid else "failures"] += 1
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats["total_latency_ms"] += elapsed_ms
+        self.stats["max_latency_ms"] = max(self.stats["max_latency_ms"], elapsed_ms)
+        self.latency_ms.observe(elapsed_ms)
+        return valid
+
+    def snapshot(self):
+        """Auth latency and cache hit-rate counters."""
+        attempts = self.stats["attempts"]
+        hits = self.stats["cache_hits"] + self.stats["negative_hits"]
+        return {
+            **self.stats,
+            "sessions": len(self.sessions),
+            "negative_entries": len(self.negative_cache),
+            "hit_rate": hits / attempts if attempts else 0.0,
+            "avg_latency_ms": self.stats["total_latency_ms"] / attempts if attempts else 0.0,
+        }
+
+    def _negative_hit(self, key):
+        expiry = self.negative_cache.get(key)
+        if expiry is None:
+            return False
+        if expiry < time.monotonic():
+            del self.negative_cache[key]
+            return False
+        self.negative_cache.move_to_end(key)
+        return True
+
+    def _remember_failure(self, key):
+        self.negative_cache[key] = time.monotonic() + self.negative_ttl
+        self.negative_cache.move_to_end(key)
+        while len(self.negative_cache) > self.negative_cache_size:
+            self.negative_cache.popitem(last=False)
+
+    def _schedule_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+
+    async def _refresh(self, force_full=False):
+        """Pull changes from SQLite in a worker thread and apply them on the loop."""
+        if time.monotonic() - self.last_full_reload > self.full_reload_interval:
+            force_full = True
+        changes = await asyncio.to_thread(self._fetch_changes, force_full)
+        self.last_refresh = time.monotonic()
+        if changes is None:
+            return
+
+        full, rows, changed_ids, version, last_change = changes
+        self.stats["refreshes"] += 1
+        if full:
+            self.stats["full_reloads"] += 1
+            self.last_full_reload = self.last_refresh
+            self.sessions, self.by_id = {}, {}
+        for row_id in changed_ids:  # Forget the old pair; the current row, if any, is in rows
+            key = self.by_id.pop(row_id, None)
+            if key is not None:
+                self.sessions.pop(key, None)
+        for row_id, username, session_token in rows:
+            key = (username, session_token)
+            self.sessions[key] = row_id
+            self.by_id[row_id] = key
+            self.negative_cache.pop(key, None)
+        # 🔹 Only now is this version seen: a cancelled refresh leaves it to be read again
+        self.data_version, self.last_change = version, last_change
+
+    def _fetch_changes(self, force_full):
+        """Runs in a worker thread. Returns (full_reload, rows, changed_ids, data_version,
+        last_change), or None when nothing changed."""
+        with self._lock:
+            return self._fetch_changes_locked(force_full)
+
+    def _fetch_changes_locked(self, force_full):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS Sessions (
+                    id INTEGER PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    session_token TEXT NOT NULL
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_username_token '
+                               'ON Sessions (username, session_token)')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS SessionChanges (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id INTEGER NOT NULL,
+                    changed REAL NOT NULL
+                )
+            ''')
+            for event, row in (("INSERT", "new"), ("UPDATE", "old"), ("DELETE", "old")):
+                self._conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS sessions_log_{event.lower()} AFTER {event} ON Sessions BEGIN
+                        INSERT INTO SessionChanges (session_id, changed)
+                        VALUES ({row}.id, (julianday('now') - 2440587.5) * 86400.0);
+                    END
+                ''')
+            self._conn.commit()
+
+        cursor = self._conn.cursor()
+        version = cursor.execute('PRAGMA data_version').fetchone()[0]
+        if not force_full and version == self.data_version:
+            return None
+
+        cursor.execute('BEGIN')  # One snapshot for the rows and the change log position
+        try:
+            last_change = cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM SessionChanges').fetchone()[0]
+            if not force_full:
+                changed_ids = [row[0] for row in cursor.execute(
+                    'SELECT DISTINCT session_id FROM SessionChanges WHERE seq > ?', (self.last_change,))]
+                rows = cursor.execute('''
+                    SELECT id, username, session_token FROM Sessions
+                    WHERE id IN (SELECT session_id FROM SessionChanges WHERE seq > ?)
+                ''', (self.last_change,)).fetchall()
+                return False, rows, changed_ids, version, last_change
+            rows = cursor.execute('SELECT id, username, session_token FROM Sessions').fetchall()
+        finally:
+            cursor.execute('COMMIT')
+
+        # A full reload needs no older log entries; every reader does one each full_reload_interval
+        cursor.execute('DELETE FROM SessionChanges WHERE changed < ?', (time.time() - 2 * self.full_reload_interval,))
+        self._conn.commit()
+        return True, rows, [], version, last_change
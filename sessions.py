@@ -0,0 +1,129 @@
+import itertools
+import sys
+import time
+from collections import OrderedDict
+
+
+class Session:
+    """One open connection of a user. Slots keep every connection the same small size."""
+
+    __slots__ = ("conn_id", "username", "node", "websocket", "codec", "outbound", "sent_seq", "acked_seq", "lock",
+                 "connected_at", "last_activity")
+
+    def __init__(self, conn_id, username, node=None, websocket=None, codec=None, outbound=None):
+        self.conn_id = conn_id
+        self.username = username
+        self.node = node  # Worker holding the socket
+        self.websocket = websocket
+        self.codec = codec  # Negotiated for this connection
+        self.outbound = outbound  # OutboundQueue drained by this connection's writer task
+        self.sent_seq = 0  # Last outbox seq written to this socket
+        self.acked_seq = 0  # Last outbox seq this socket acknowledged
+        self.lock = None  # asyncio.Lock serialising outbox flushes, made on first use
+        self.connected_at = self.last_activity = time.monotonic()
+
+    def __repr__(self):
+        return f"Session({self.conn_id!r}, {self.username!r}, node={self.node!r})"
+
+
+class SessionRegistry:
+    """Every open session, indexed by connection id, by user and by last activity, plus
+    the users with unread messages.
+
+    A user may hold several sessions (tabs, devices); each is added and removed on its own,
+    so closing one never disturbs the others. Lookups and updates are O(1), and finding
+    idle sessions only touches the ones returned.
+    """
+
+    def __init__(self):
+        self.by_conn = {}  # conn_id -> Session
+        self.by_user = {}  # username -> {conn_id: Session}, oldest connection first
+        self.by_activity = OrderedDict()  # conn_id -> Session, least recently active first
+        self.unread = set()  # Users with messages no agent has read yet
+        self.ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self.by_conn)
+
+    def open(self, username, conn_id=None, **fields):
+        """Register a new session; conn_id defaults to the next number from this registry."""
+        session = Session(next(self.ids) if conn_id is None else conn_id, username, **fields)
+        self.by_conn[session.conn_id] = session
+        self.by_user.setdefault(username, {})[session.conn_id] = session
+        self.by_activity[session.conn_id] = session
+        return session
+
+    def close(self, conn_id):
+        """Forget one session; returns it, or None if it was already gone."""
+        session = self.by_conn.pop(conn_id, None)
+        if session is None:
+            return None
+        del self.by_activity[conn_id]
+        sessions = self.by_user[session.username]
+        del sessions[conn_id]
+        if not sessions:
+            del self.by_user[session.username]
+        return session
+
+    def get(self, conn_id):
+        return self.by_conn.get(conn_id)
+
+    def for_user(self, username):
+        return list(self.by_user.get(username, {}).values())
+
+    def is_online(self, username):
+        return username in self.by_user
+
+    def users(self):
+        return self.by_user.keys()
+
+    def touch(self, session):
+        """Record activity on a session (any frame from its client)."""
+        session.last_activity = time.monotonic()
+        self.by_activity.move_to_end(session.conn_id)
+
+    def idle(self, max_idle):
+        """Sessions with no activity in the last max_idle seconds, least recently active first."""
+        cutoff = time.monotonic() - max_idle
+        idle = []
+        for session in self.by_activity.values():
+            if session.last_activity > cutoff:
+                break
+            idle.append(session)
+        return idle
+
+    # 🔹 Unread flags are per user and outlive the user's sessions
+
+    def mark_unread(self, username):
+        """Flag a user; returns False if they were already flagged."""
+        if username in self.unread:
+            return False
+        self.unread.add(username)
+        return True
+
+    def clear_unread(self, username):
+        """Unflag a user; returns False if they were not flagged."""
+        if username not in self.unread:
+            return False
+        self.unread.discard(username)
+        return True
+
+    def has_unread(self, username):
+        return username in self.unread
+
+    def memory(self):
+        """Bytes the registry holds per session: the Session objects plus their index entries.
+
+        Excludes what sessions point to (socket, codec, queue), which RSS measurements cover.
+        """
+        count = len(self.by_conn)
+        sessions = sum(sys.getsizeof(session) for session in self.by_conn.values())
+        indexes = (sys.getsizeof(self.by_conn) + sys.getsizeof(self.by_user) + sys.getsizeof(self.by_activity)
+                   + sum(sys.getsizeof(user_sessions) for user_sessions in self.by_user.values()))
+        return {
+            "sessions": count,
+            "users": len(self.by_user),
+            "session_bytes": sessions / count if count else 0.0,
+            "index_bytes": indexes / count if count else 0.0,
+            "bytes_per_session": (sessions + indexes) / count if count else 0.0,
+        }
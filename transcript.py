@@ -0,0 +1,151 @@
+MAX_RENDERED_ROWS = 120  # Controls that exist at once, whatever the transcript length
+PAGE_ROWS = 40  # Rows re-materialized per scroll to either edge
+MAX_BUFFERED_MESSAGES = 5000  # Older ones are forgotten here (stored ones stay in the history cache)
+MEDIA_MARGIN_ROWS = 5  # Media this close to the screen keep their previews, so short scrolls don't flicker
+DEFAULT_VISIBLE_ROWS = 15  # Assumed before the first scroll event tells us the viewport size
+
+
+class Transcript:
+    """A conversation kept as plain (sender, text, kind, sha) tuples, of which only a window
+    of at most max_rows exists as controls.
+
+    While the window shows the newest messages, new ones are rendered as they arrive and
+    the oldest rows are released; scrolling to either edge rebuilds a page of rows from the
+    buffer and releases as many at the other end. Every step touches a bounded number of
+    controls, so the cost of showing a message does not grow with the conversation.
+    """
+
+    def __init__(self, controls, build_row, max_rows=MAX_RENDERED_ROWS, page_rows=PAGE_ROWS,
+                 max_buffered=MAX_BUFFERED_MESSAGES):
+        self.controls = controls  # The scrolling column's controls: the rendered window
+        self.build_row = build_row  # (sender, text, kind) -> control
+        self.max_rows = max_rows
+        self.page_rows = page_rows
+        self.max_buffered = max_buffered
+        self.items = []
+        self.base = 0  # Position of items[0] in the whole conversation; grows as old items are forgotten
+        self.first = 0  # Position of controls[0]
+        self.following = True  # The window ends at the newest message
+        self.visible = None  # (first, stop) positions estimated from the last scroll, None while following
+        self.visible_rows = DEFAULT_VISIBLE_ROWS
+        self.stats = {"materialized": 0, "released": 0, "forgotten": 0}
+
+    def __len__(self):
+        return self.base + len(self.items)
+
+    @property
+    def end(self):
+        """Position just past the last rendered row."""
+        return self.first + len(self.controls)
+
+    def append(self, sender, text, kind="TEXT", sha=None):
+        """Buffer one message; returns its row if the window is following, else None."""
+        self.items.append((sender, text, kind, sha))
+        if not self.following or self.end != len(self) - 1:
+            self._forget_overflow()
+            return None
+        row = self.build_row(sender, text, kind)
+        self.controls.append(row)
+        self.stats["materialized"] += 1
+        self._release(len(self.controls) - self.max_rows, from_top=True)
+        self._forget_overflow()
+        return row
+
+    def extend(self, items):
+        """Buffer many messages, building rows only for the ones that end up in the window."""
+        items = list(items)
+        self.items.extend(items)
+        if self.following:
+            start = max(self.end, len(self) - self.max_rows)
+            self._release(len(self.controls) - (self.max_rows - (len(self) - start)), from_top=True)
+            if not self.controls:
+                self.first = start
+            self.controls.extend(self._build(start, len(self)))
+        self._forget_overflow()
+
+    def older(self):
+        """Render the page above the window (after scrolling to its top); returns rows added."""
+        start = max(self.base, self.first - self.page_rows)
+        if start == self.first:
+            return 0
+        self.controls[0:0] = self._build(start, self.first)
+        added, self.first = self.first - start, start
+        self.visible = (start, start + self.visible_rows)  # The column stays scrolled to its top
+        self._release(len(self.controls) - self.max_rows, from_top=False)
+        return added
+
+    def newer(self):
+        """Render the page below the window (after scrolling to its bottom); returns rows added."""
+        stop = min(len(self), self.end + self.page_rows)
+        added = stop - self.end
+        self.controls.extend(self._build(self.end, stop))
+        self._release(len(self.controls) - self.max_rows, from_top=True)
+        self.following = self.end == len(self)
+        return added
+
+    def scrolled(self, pixels, min_extent, max_extent, viewport):
+        """Track what is on screen from a scroll event of the transcript column.
+
+        Rows are assumed to be of similar height, so the visible span is an estimate; it is
+        only used to decide which media get previews, padded by MEDIA_MARGIN_ROWS.
+        """
+        height = max_extent - min_extent + viewport
+        if not self.controls or height <= 0:
+            return
+        per_pixel = len(self.controls) / height
+        first = self.first + int((pixels - min_extent) * per_pixel)
+        self.visible_rows = max(1, round(viewport * per_pixel))
+        self.visible = (first, first + self.visible_rows)
+        self.following = self.end == len(self) and pixels >= max_extent - 5
+
+    def on_screen(self):
+        """(first, stop) positions of the rows to treat as visible, margin included."""
+        if self.following or self.visible is None:
+            first, stop = len(self) - self.visible_rows, len(self)
+        else:
+            first, stop = self.visible
+        return first - MEDIA_MARGIN_ROWS, stop + MEDIA_MARGIN_ROWS
+
+    def sha_at(self, position):
+        """Content hash recorded for a media item, or None if unknown or forgotten."""
+        if self.base <= position < len(self):
+            return self.items[position - self.base][3]
+        return None
+
+    def remember_sha(self, position, sha):
+        """Record a media item's content hash once computed, so it is never hashed again."""
+        if self.base <= position < len(self):
+            sender, text, kind, _ = self.items[position - self.base]
+            self.items[position - self.base] = (sender, text, kind, sha)
+
+    def rendered(self):
+        """(position, row) for every row in the window."""
+        return enumerate(self.controls, self.first)
+
+    def _build(self, start, stop):
+        rows = [self.build_row(sender, text, kind) for sender, text, kind, _ in self.items[start - self.base:stop - self.base]]
+        self.stats["materialized"] += len(rows)
+        return rows
+
+    def _release(self, count, from_top):
+        if count <= 0:
+            return
+        if from_top:
+            del self.controls[:count]
+            self.first += count
+        else:
+            del self.controls[-count:]
+            self.following = False
+        self.stats["released"] += count
+
+    def _forget_overflow(self):
+        """Drop the oldest buffered messages a page at a time once over max_buffered."""
+        excess = len(self.items) - self.max_buffered
+        if excess < self.page_rows:
+            return
+        del self.items[:excess]
+        self.base += excess
+        self.stats["forgotten"] += excess
+        if self.first < self.base:  # Scrolled far back while the conversation ran on
+            self._release(min(self.base - self.first, len(self.controls)), from_top=True)
+            self.first = max(self.first, self.base)